@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import numpy as np
+import cv2
+from matplotlib import cm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.map_colorizer import MapColorizer
+
+FRAME_WIDTH = 960
+FRAME_HEIGHT = 540
+
+def float_colorize_and_blend(frame, bf_map):
+    # Colorization and compositing as done before the LUT colorizer
+    bf_map = np.rot90(bf_map, k=-1)
+    bf_map = np.flipud(bf_map)
+    bf_map = (bf_map - bf_map.min()) / (bf_map.max() - bf_map.min() + 1e-6)
+    bf_map = np.power(bf_map, 20.0)
+    bf_map[bf_map < 0.4] = 0
+    bf_map = cv2.resize(bf_map, (FRAME_WIDTH, FRAME_HEIGHT))
+    bf_color = (cm.jet(bf_map)[:, :, :3] * 255).astype(np.uint8)
+    return cv2.addWeighted(frame, 0.7, bf_color, 0.3, 0)
+
+def lut_colorize_and_blend(colorizer, frame, bf_map):
+    index_map, bf_color = colorizer.colorize(bf_map)
+    return colorizer.blend(frame, bf_color, index_map)
+
+def make_map(shape, rng):
+    xs, ys = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+    peak = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+    return np.exp(-((xs - peak[0]) ** 2 + (ys - peak[1]) ** 2) / 4.0) + 0.05 * rng.random(shape)
+
+def measure(function, iterations):
+    function()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1000.0
+
+def main(iterations=200):
+    rng = np.random.default_rng(0)
+    colorizer = MapColorizer(FRAME_WIDTH, FRAME_HEIGHT)
+    frame = rng.integers(0, 255, (FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+
+    print(f"{'grid':>10} {'float + cm.jet [ms]':>20} {'uint8 LUT [ms]':>16} {'speedup':>8}")
+    for shape in [(14, 8), (33, 19), (131, 76)]:
+        bf_map = make_map(shape, rng)
+        old = measure(lambda: float_colorize_and_blend(frame.copy(), bf_map), iterations)
+        new = measure(lambda: lut_colorize_and_blend(colorizer, frame.copy(), bf_map), iterations)
+        print(f"{shape[0]:>4}x{shape[1]:<5} {old:>20.3f} {new:>16.3f} {old / new:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+from beamformer_map import create_beamformer
+from background_map_calculator import BackgroundMapCalculator
+from beamforming.recording import load_recording
+from beamforming.replay_samples_source import ReplaySamplesSource
+from beamforming.source_tracking import SourceTracker
+from detection.event_detector import EventDetector, NoiseFloorDetector, SpectralFluxDetector
+from recorders.video_event_recorder import VideoEventRecorder
+from utils.map_colorizer import MapColorizer
+from utils.metrics import metrics
+from video.frame_source import FileFrameSource, SyntheticFrameSource
+
+RESULTS_VERSION = 2
+FRAME_WIDTH = 960
+FRAME_HEIGHT = 540
+FRAMERATE = 15
+MIC_FILE = os.path.join(ROOT, "resources", "array_16.xml")
+BEAMFORMER_CONFIG = dict(horizonatal_fov=66, vertical_fov=41, z=0.5)
+# Fixed instead of the local user_settings.json, so runs on different machines do the same work.
+# The frequency is the one of the synthetic recording's tone
+BENCHMARK_SETTINGS = {"sound_threshold": 1.0, "frequency": 1000, "bandwidth": 1, "event_sound_threshold": 2.0}
+
+# (result path, higher is better) compared against a baseline run with the same method, search mode, increment and block size
+REGRESSION_CHECKS = (
+    (("maps_per_second",), True),
+    (("stages", "beamforming", "p95"), False),
+    (("stages", "map_latency", "p95"), False),
+    (("stages", "blend", "mean"), False),
+    (("stages", "frame_compress", "mean"), False),
+    (("stages", "clip_encode", "mean"), False),
+    (("peak_rss_mb",), False),
+)
+
+class BenchmarkSettings:
+    # Read-only stand-in for UserSettings, which writes the file back on load
+    def __init__(self, settings):
+        self._settings = dict(settings)
+
+    def get(self, key, default=None):
+        return self._settings.get(key, default)
+
+    def to_dict(self):
+        return self._settings.copy()
+
+def make_synthetic_recording(seconds, sample_freq=48000, num_channels=16, seed=0):
+    # Noise with a 1 kHz tone every other second, for runs without a recording
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_freq)) / sample_freq
+    tone = 3000 * np.sin(2 * np.pi * 1000 * t) * (np.floor(t) % 2 == 0)
+    data = rng.normal(0, 300, (len(t), num_channels)) + tone[:, np.newaxis]
+    return np.clip(data, -32768, 32767).astype(np.int16), float(sample_freq)
+
+def create_frame_source(video_path):
+    if video_path:
+        return FileFrameSource(video_path, FRAME_WIDTH, FRAME_HEIGHT, FRAMERATE)
+    return SyntheticFrameSource(FRAME_WIDTH, FRAME_HEIGHT, FRAMERATE)
+
+def run_config(config):
+    # Runs in a process of its own, so the peak RSS belongs to this configuration alone
+    if config["audio"]:
+        data, sample_freq = load_recording(config["audio"])
+    else:
+        data, sample_freq = make_synthetic_recording(30)
+    if data.ndim != 2 or data.shape[1] != 16:
+        raise ValueError(f"Recording must have 16 channels, got shape {data.shape}")
+
+    buffer_seconds = config["event_buffer_seconds"]
+    post_seconds = config["event_post_seconds"]
+    source = ReplaySamplesSource(
+        data, sample_freq, block_size=config["block_size"], buffer_seconds=buffer_seconds + post_seconds + 3
+    )
+    settings = BenchmarkSettings(BENCHMARK_SETTINGS)
+
+    # Steering vectors for the selected band and the level bands are computed before the clock starts
+    setup_start = time.perf_counter()
+    beamformer_config = dict(BEAMFORMER_CONFIG, increment=config["increment"], mic_file=MIC_FILE, method=config["method"])
+    if config["method"] == "frequency":
+        beamformer_config.update(block_size=config["block_size"], steering_cache_dir=config["steering_cache_dir"],
+                                 search_mode=config["search_mode"])
+    beamformer = create_beamformer(beamformer_config, samples_generator=source)
+    calculator = BackgroundMapCalculator(
+        beamformer, settings, FRAME_WIDTH, FRAME_HEIGHT, trigger_samples=config["trigger_samples"],
+        source_tracker=SourceTracker()
+    )
+    source.wait_for_samples(config["block_size"], timeout=5.0)
+    calculator.compute_map()
+    setup_seconds = time.perf_counter() - setup_start
+
+    detector = EventDetector(
+        source, [NoiseFloorDetector(margin_db=12.0), SpectralFluxDetector(on_flux=6.0, low_freq=200.0)],
+        attack_blocks=1, release_blocks=10
+    )
+    # Clips are spooled only, events are triggered on a fixed schedule so every run encodes the same work
+    recorder = VideoEventRecorder(
+        resolution=(FRAME_WIDTH, FRAME_HEIGHT), backend_url=None, api_key="", sound_generator=source,
+        buffer_seconds=buffer_seconds, post_seconds=post_seconds, max_post_seconds=post_seconds,
+        spool_dir=os.path.join(config["work_dir"], f"spool_{os.getpid()}")
+    )
+    colorizer = MapColorizer(FRAME_WIDTH, FRAME_HEIGHT)
+    frame_source = create_frame_source(config["video"])
+
+    metrics.enable()
+    detector.start()
+    calculator.start()
+    frame_source.start()
+    start_time = time.monotonic()
+    end_time = start_time + config["duration"]
+    next_event_time = start_time + buffer_seconds
+    last_event_time = end_time - post_seconds - 1.0
+    sequence = 0
+    frames = 0
+
+    # Same per-frame work as SonicSenseApp.update_frame, without Tk
+    while time.monotonic() < end_time:
+        frame, timestamp, sequence = frame_source.wait_for_frame(sequence, timeout=1.0)
+        if frame is None:
+            continue
+        with metrics.timer("frame_loop"):
+            snapshot = calculator.get_latest_snapshot()
+            if snapshot is not None:
+                with metrics.timer("blend"):
+                    frame = colorizer.blend(frame, snapshot.bf_color, snapshot.bf_map)
+                    frame = colorizer.draw_sources(frame, snapshot.sources)
+            frame.flags.writeable = False
+            if next_event_time <= timestamp <= last_event_time:
+                recorder.trigger_event(timestamp)
+                next_event_time = timestamp + config["event_interval"]
+            recorder.update(frame, snapshot, event_threshold=float("inf"), timestamp=timestamp)
+        frames += 1
+
+    elapsed = time.monotonic() - start_time
+    frame_source.stop()
+    calculator.stop()
+    detector.stop()
+    recorder.stop()
+    source.stop()
+
+    report = metrics.to_dict()
+    return {
+        "method": config["method"],
+        "search_mode": config["search_mode"],
+        "increment": config["increment"],
+        "block_size": config["block_size"],
+        "settings": settings.to_dict(),
+        "grid_shape": list(beamformer.map_shape),
+        "grid_points": int(np.prod(beamformer.map_shape)),
+        "setup_seconds": setup_seconds,
+        "duration": elapsed,
+        "maps": calculator.generation,
+        "maps_per_second": calculator.generation / elapsed,
+        "skipped_updates": calculator.skipped_updates,
+        "frames": frames,
+        "frames_per_second": frames / elapsed,
+        "clips": recorder.event_count,
+        "dropped_clips": recorder.dropped_clips,
+        "clip_seconds": buffer_seconds + post_seconds,
+        "audio": source.get_stats(),
+        "stages": report["stages"],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_value(result, path):
+    for key in path:
+        if not isinstance(result, dict) or result.get(key) is None:
+            return None
+        result = result[key]
+    return result
+
+def compare(results, baseline, tolerance):
+    baseline_runs = {
+        (run.get("method", "frequency"), run.get("search_mode", "full"), run["increment"], run["block_size"]): run
+        for run in baseline["results"]
+    }
+    regressions = []
+    for run in results:
+        old_run = baseline_runs.get((run["method"], run["search_mode"], run["increment"], run["block_size"]))
+        # Runs from before the settings were fixed, or with other ones, did different work
+        if old_run is None or old_run.get("settings") != run["settings"]:
+            continue
+        for path, higher_is_better in REGRESSION_CHECKS:
+            new, old = get_value(run, path), get_value(old_run, path)
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(
+                    f"{run['method']} ({run['search_mode']}), increment {run['increment']}, block {run['block_size']}: "
+                    f"{'.'.join(path)} {old:.4g} -> {new:.4g} ({change:+.0%})"
+                )
+    return regressions
+
+def format_ms(run, stage, field):
+    value = get_value(run, ("stages", stage, field))
+    return f"{value * 1000:.2f}" if value is not None else "-"
+
+def print_table(results):
+    print(f"{'method':>11} {'search':>12} {'incr':>6} {'block':>6} {'grid':>9} {'maps/s':>7} {'latency p95 [ms]':>17} "
+          f"{'beamform p95 [ms]':>18} {'overlay [ms]':>13} {'encode [ms]':>12} {'RSS [MB]':>9}")
+    for run in results:
+        grid = "x".join(str(size) for size in run["grid_shape"])
+        print(f"{run['method']:>11} {run['search_mode']:>12} {run['increment']:>6} {run['block_size']:>6} {grid:>9} {run['maps_per_second']:>7.2f} "
+              f"{format_ms(run, 'map_latency', 'p95'):>17} {format_ms(run, 'beamforming', 'p95'):>18} "
+              f"{format_ms(run, 'blend', 'mean'):>13} {format_ms(run, 'clip_encode', 'mean'):>12} "
+              f"{run['peak_rss_mb']:>9.1f}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replays recorded audio and video through the map, overlay and event pipeline")
+    parser.add_argument("--audio", help="16 channel WAV or acoular HDF5 recording, synthetic noise if omitted")
+    parser.add_argument("--video", help="Video file for the frames, a synthetic pattern if omitted")
+    parser.add_argument("--method", choices=["frequency", "time_domain"], default="frequency")
+    parser.add_argument("--search-mode", choices=["full", "hierarchical", "tracked"], default="full",
+                        help="Search mode of the frequency method")
+    parser.add_argument("--increments", type=float, nargs="+", default=[0.05, 0.025, 0.01])
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--duration", type=float, default=15.0, help="Seconds of real-time replay per configuration")
+    parser.add_argument("--trigger-samples", type=int, default=4096)
+    parser.add_argument("--event-interval", type=float, default=6.0)
+    parser.add_argument("--event-buffer-seconds", type=float, default=2.0)
+    parser.add_argument("--event-post-seconds", type=float, default=3.0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier version to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Relative change reported as a regression")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for increment in args.increments:
+            for block_size in args.block_sizes:
+                config = dict(
+                    audio=args.audio, video=args.video, method=args.method, search_mode=args.search_mode,
+                    increment=increment, block_size=block_size, duration=args.duration, trigger_samples=args.trigger_samples,
+                    event_interval=args.event_interval, event_buffer_seconds=args.event_buffer_seconds,
+                    event_post_seconds=args.event_post_seconds, work_dir=work_dir,
+                    steering_cache_dir=os.path.join(work_dir, "steering")
+                )
+                print(f"Running increment {increment}, block size {block_size} ...", flush=True)
+                with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as executor:
+                    results.append(executor.submit(run_config, config).result())
+
+    print_table(results)
+    report = {
+        "version": RESULTS_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": get_git_commit(),
+        "host": {
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+        },
+        "inputs": {"audio": args.audio, "video": args.video, "duration": args.duration},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,30 @@
 import threading
 import time
 import numpy as np
-from matplotlib import cm
-import cv2
 import acoular as ac
+from utils.map_colorizer import MapColorizer
+from map_snapshot import MapSnapshot
+from utils.metrics import metrics
+from beamforming.source_tracking import find_peaks
 
 class BackgroundMapCalculator:
-    def __init__(self, beamformer, user_settings, frame_width, frame_height, update_interval=0.5):
+    def __init__(self, beamformer, user_settings, frame_width, frame_height, update_interval=0.5, trigger_samples=None,
+                 source_tracker=None):
 
         self.beamformer = beamformer
         self.user_settings = user_settings
+        # With trigger_samples set, a map is computed whenever that many new samples have been
+        # captured, otherwise maps are paced to one per update_interval against a deadline
         self.update_interval = update_interval
+        self.trigger_samples = trigger_samples
         self.frame_width = frame_width
         self.frame_height = frame_height
-        self.bf_map = None
-        self.bf_map_unnormalized = None
-        self.db_values = None
-        self.bf_color = None
+        self.colorizer = MapColorizer(frame_width, frame_height)
+        # With a SourceTracker, every map's peaks are followed over time and published as the snapshot's sources
+        self.source_tracker = source_tracker
+        self.snapshot = None
+        self.generation = 0
+        self.skipped_updates = 0
         self.lock = threading.Lock()
         self.running = False
         self.thread = None
@@ -33,40 +41,104 @@ class BackgroundMapCalculator:
             self.thread.join()
 
     def _run(self):
-        while self.running:
+        self.run_paced(lambda: not self.running, self._publish)
+
+    def _publish(self, result, sample_index, latency):
+        bf_map, unnormalized_bf_map, bf_color, db_values, band_levels, sources = result
+        with self.lock:
+            self.generation += 1
+            self.snapshot = MapSnapshot(
+                self.generation, bf_map, unnormalized_bf_map, bf_color, db_values, band_levels,
+                sample_index=sample_index, latency=latency, sources=sources
+            )
+        if latency is not None:
+            metrics.observe("map_latency", latency)
+
+    def run_paced(self, should_stop, publish):
+        samples_generator = self.beamformer.mch_generator
+        next_deadline = time.monotonic()
+        next_trigger_index = samples_generator.sample_index + (self.trigger_samples or 0)
+
+        while not should_stop():
+            if self.trigger_samples:
+                if not samples_generator.wait_for_samples(next_trigger_index, timeout=0.5):
+                    continue
+                # When maps fall behind the audio, intermediate triggers are dropped and only the newest is served
+                sample_index = samples_generator.sample_index
+                missed = (sample_index - next_trigger_index) // self.trigger_samples
+                if missed > 0:
+                    self.skipped_updates += missed
+                next_trigger_index = sample_index + self.trigger_samples
+            else:
+                sample_index = samples_generator.sample_index
+
             try:
-                bf_map = self.beamformer.get_current_map(
-                    self.user_settings.get("sound_threshold"),
-                    frequency=self.user_settings.get("frequency"),
-                    bandwidth=self.user_settings.get("bandwidth")
-                )
-                unnormalized_bf_map = bf_map.copy()
-                bf_map = np.rot90(bf_map, k=-1)
-                bf_map = np.flipud(bf_map)
-                bf_map = (bf_map - bf_map.min()) / (bf_map.max() - bf_map.min() + 1e-6)
-
-                gamma = 20.0
-                bf_map = np.power(bf_map, gamma)
-                threshold = 0.4
-                bf_map[bf_map < threshold] = 0
-
-                bf_map = cv2.resize(bf_map, (self.frame_width, self.frame_height))
-                bf_color = cm.jet(bf_map)[:, :, :3]
-                bf_color = (bf_color * 255).astype(np.uint8)
-
-                with self.lock:
-                    self.bf_map = bf_map
-                    self.db_values = ac.L_p(unnormalized_bf_map)
-                    self.bf_color = bf_color
-                    self.bf_map_unnormalized = unnormalized_bf_map
+                result = self.compute_map()
+                capture_time = samples_generator.sample_time(sample_index)
+                latency = time.monotonic() - capture_time if capture_time is not None else None
+                publish(result, sample_index, latency)
             except Exception as e:
                 print(f"[MapCalculator] Error: {e}")
 
-            time.sleep(self.update_interval)
+            if not self.trigger_samples:
+                next_deadline += self.update_interval
+                now = time.monotonic()
+                if now > next_deadline:
+                    missed = int((now - next_deadline) / self.update_interval)
+                    self.skipped_updates += missed
+                    next_deadline = now
+                else:
+                    time.sleep(next_deadline - now)
+
+    def compute_map(self):
+        with metrics.timer("beamforming"):
+            bf_map = self.beamformer.get_current_map(
+                self.user_settings.get("sound_threshold"),
+                frequency=self.user_settings.get("frequency"),
+                bandwidth=self.user_settings.get("bandwidth")
+            )
+            band_levels = self.beamformer.get_band_levels(self.user_settings.get("bandwidth"))
+        unnormalized_bf_map = bf_map.copy()
+        db_values = ac.L_p(unnormalized_bf_map)
+        sources = []
+        if self.source_tracker is not None:
+            with metrics.timer("source_tracking"):
+                sources = self.track_sources(unnormalized_bf_map, db_values)
+        with metrics.timer("colorize"):
+            index_map, bf_color = self.colorizer.colorize(bf_map)
+
+        return index_map, unnormalized_bf_map, bf_color, db_values, band_levels, sources
+
+    def track_sources(self, bf_map, db_values):
+        # Peaks above the threshold (the map is zero below it), at least min_separation apart
+        tracker = self.source_tracker
+        xs, ys = self.beamformer.map_axes
+        cell_size = max(xs[1] - xs[0] if len(xs) > 1 else 0.0, ys[1] - ys[0] if len(ys) > 1 else 0.0) or 1.0
+        min_distance = max(1, int(round(tracker.min_separation / cell_size)))
+        rows, cols, _ = find_peaks(bf_map, tracker.max_sources, min_distance=min_distance)
+        sources = tracker.update(
+            np.column_stack((xs[rows], ys[cols], db_values[rows, cols])), time.monotonic()
+        )
+
+        # Display position as a fraction of the frame, the colorizer shows x_max on the left and y_max on top
+        for source in sources:
+            source["u"] = float((xs[-1] - source["x"]) / (xs[-1] - xs[0])) if len(xs) > 1 else 0.5
+            source["v"] = float((ys[-1] - source["y"]) / (ys[-1] - ys[0])) if len(ys) > 1 else 0.5
+        # Beamformers with ROI-restricted updates recompute the next map around the confirmed tracks
+        if hasattr(self.beamformer, "set_focus"):
+            self.beamformer.set_focus(tracker.focus_points())
+        return sources
+
+    def get_latest_snapshot(self):
+        # Snapshots are immutable, consumers keep the reference and compare generations
+        return self.snapshot
 
     def get_latest_map(self):
-        with self.lock:
-            if self.bf_map is not None and self.bf_color is not None:
-                return self.bf_map.copy(), self.bf_map_unnormalized.copy(), self.bf_color.copy(), self.db_values.copy()
-            else:
-                return None, None, None, None
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None, None, None, None
+        return snapshot.as_tuple()
+
+    def get_latest_band_levels(self):
+        snapshot = self.snapshot
+        return snapshot.band_levels if snapshot is not None else None
@@ -0,0 +1,42 @@
+import argparse
+import time
+from beamforming.batch_processor import BatchProcessor, create_batch_config
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Beamforms a recorded session offline into a time series of maps and peaks")
+    parser.add_argument("recording", help="Multichannel WAV or acoular HDF5 recording")
+    parser.add_argument("output_dir", help="Directory for levels.b2nd, peaks.csv and manifest.json, rerun to resume")
+    parser.add_argument("--mic-file", default="resources/array_16.xml")
+    parser.add_argument("--fov", type=float, nargs=2, default=[66, 41], metavar=("HORIZONTAL", "VERTICAL"))
+    parser.add_argument("--z", type=float, default=0.5, help="Distance of the map plane in meters")
+    parser.add_argument("--increment", type=float, default=0.05, help="Grid spacing in meters")
+    parser.add_argument("--frequency", type=float, default=1000)
+    parser.add_argument("--bandwidth", type=int, default=1, help="Bands per octave, 0 for a single bin")
+    parser.add_argument("--block-size", type=int, default=1024)
+    parser.add_argument("--map-blocks", type=int, default=4, help="Blocks between two maps")
+    parser.add_argument("--averaging-blocks", type=int, default=16, help="Time constant of the CSM average in blocks")
+    parser.add_argument("--warmup-blocks", type=int, default=None,
+                        help="Blocks averaged before a chunk's first map, 24 x --averaging-blocks by default")
+    parser.add_argument("--chunk-seconds", type=float, default=60.0)
+    parser.add_argument("--peaks", type=int, default=3, help="Peaks listed per map")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, all cores by default")
+    parser.add_argument("--steering-cache-dir", default="cache/steering")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    config = create_batch_config(
+        args.recording, mic_file=args.mic_file, horizontal_fov=args.fov[0], vertical_fov=args.fov[1], z=args.z,
+        increment=args.increment, frequency=args.frequency, bandwidth=args.bandwidth, block_size=args.block_size,
+        map_blocks=args.map_blocks, averaging_blocks=args.averaging_blocks,
+        warmup_blocks=args.warmup_blocks, chunk_seconds=args.chunk_seconds,
+        max_peaks=args.peaks, steering_cache_dir=args.steering_cache_dir
+    )
+    start_time = time.monotonic()
+    manifest = BatchProcessor(config, args.output_dir, workers=args.workers).run()
+    elapsed = time.monotonic() - start_time
+    print(f"[Batch] {manifest['num_frames']} maps of {manifest['duration']:.1f}s audio in {elapsed:.1f}s "
+          f"({manifest['duration'] / elapsed:.1f}x real time)")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,36 @@
 from acoular import (
     MicGeom,
-    BeamformerBase, PowerSpectra, SteeringVector
+    SteeringVector, L_p
 )
 from utils.helper_service import HelperService
 import numpy as np
-from beamforming.shared_buffer_samples_generator import SharedBufferSamplesGenerator
+import threading
+from beamforming.csm_accumulator import CsmAccumulator
+from beamforming.steering_cache import SteeringCache
+from beamforming.beamforming_kernels import beamform_band, get_band_indices
+from beamforming.grid_refinement import GridRefiner
+
+BAND_FREQUENCIES = (250, 500, 1000, 2000, 4000)
+
+def create_beamformer(beamformer_config, samples_generator=None):
+    # method "frequency" (default) is the CSM beamformer below, "time_domain" the low-latency delay-and-sum.
+    # Imported on demand, numba is only loaded when a deployment selects it
+    config = dict(beamformer_config)
+    method = config.pop("method", "frequency")
+    if method == "time_domain":
+        from beamforming.time_domain_beamformer import TimeDomainBeamformer
+        return TimeDomainBeamformer(**config, samples_generator=samples_generator)
+    if method != "frequency":
+        raise ValueError(f"Unknown beamforming method '{method}'")
+    return BeamformerMap(**config, samples_generator=samples_generator)
 
 class BeamformerMap:
     def __init__(self, horizonatal_fov, vertical_fov, z,
-                 mic_file='resources/array_16.xml', increment=0.01):
+                 mic_file='resources/array_16.xml', increment=0.01,
+                 block_size=1024, csm_averaging_blocks=16, steering_cache_dir='cache/steering',
+                 band_frequencies=BAND_FREQUENCIES, search_mode='full',
+                 refine_increment=0.005, refine_peaks=3, refine_window_cells=1, full_refresh_interval=10,
+                 samples_generator=None):
 
         mic_array = MicGeom(file=mic_file)
         self.mic_grid = HelperService.getRectGridBasedOnCameraFOV(
@@ -18,25 +40,191 @@ class BeamformerMap:
         )
 
         self.steeringVector = SteeringVector(grid=self.mic_grid, mics=mic_array)
-        self.mch_generator = SharedBufferSamplesGenerator(
+        self.block_size = block_size
+        if samples_generator is None:
+            samples_generator = BeamformerMap.create_samples_generator(block_size=block_size)
+        self.mch_generator = samples_generator
+        self.sample_freq = samples_generator.sample_freq
+
+        # Every captured block is transformed once and folded into a long-lived CSM,
+        # map requests only have to run the steering step against it
+        self.csm_accumulator = CsmAccumulator(
+            num_channels=16,
+            sample_freq=self.sample_freq,
+            block_size=block_size,
+            averaging_blocks=csm_averaging_blocks
+        )
+        self.mch_generator.add_block_listener(self.csm_accumulator.push_block)
+        self.steering_cache = SteeringCache(
+            self.steeringVector,
+            self.csm_accumulator.freqs,
+            cache_dir=steering_cache_dir
+        )
+
+        self.band_frequencies = tuple(band_frequencies)
+        self._band_maps = {}
+        self._band_lock = threading.Lock()
+
+        # 'hierarchical' evaluates the grid above, then refines windows around its
+        # strongest peaks at refine_increment and returns the merged fine map.
+        # 'tracked' does the same every full_refresh_interval maps, in between only the
+        # windows around the positions passed to set_focus (the tracked sources) are beamformed
+        if search_mode not in ('full', 'hierarchical', 'tracked'):
+            raise ValueError(f"Unknown search mode '{search_mode}'")
+        self.search_mode = search_mode
+        self.grid_refiner = None
+        self.latest_peaks = []
+        self.full_refresh_interval = full_refresh_interval
+        self.focus_points = []
+        self.full_refreshes = 0
+        self._base_map = None
+        self._base_key = None
+        self._maps_since_refresh = 0
+        self._tracked_band_levels = None
+        if search_mode in ('hierarchical', 'tracked'):
+            self.grid_refiner = GridRefiner(
+                self.mic_grid,
+                self.steeringVector,
+                fine_increment=refine_increment,
+                window_cells=refine_window_cells,
+                max_peaks=refine_peaks
+            )
+
+    @staticmethod
+    def create_samples_generator(block_size=1024, buffer_blocks=100, shared_memory=False, buffer_seconds=None):
+        # Imported here, sounddevice needs PortAudio and replayed sources don't
+        from beamforming.shared_buffer_samples_generator import SharedBufferSamplesGenerator
+        sample_freq = 48000
+        if buffer_seconds is not None:
+            buffer_blocks = max(buffer_blocks, int(np.ceil(buffer_seconds * sample_freq / block_size)))
+        return SharedBufferSamplesGenerator(
                 device=0,
                 num_channels=16,
-                sample_freq=48000,
+                sample_freq=sample_freq,
                 precision='int16',
                 numsamples=7000,
-                buffer_blocks=100,
-                buffer_block_size=1024
+                buffer_blocks=buffer_blocks,
+                buffer_block_size=block_size,
+                shared_memory=shared_memory
         )
 
     def get_current_map(self, threshold, frequency=1000, bandwidth=1):
         try:
-            ps = PowerSpectra(source=self.mch_generator, block_size=1024, window='Hanning', cached=False)
-            bf = BeamformerBase(freq_data=ps, steer=self.steeringVector, cached=False)
+            if self.search_mode == 'tracked':
+                bf_map = self._tracked_map(frequency, bandwidth)
+            else:
+                bf_map = self._grid_map(frequency, bandwidth)
+                if self.grid_refiner is not None:
+                    bf_map = self._refine_map(bf_map, frequency, bandwidth)
 
-            bf_map = bf.synthetic(frequency, bandwidth)
             bf_map[bf_map < threshold] = 0
-            return bf_map.reshape(self.mic_grid.nxsteps, self.mic_grid.nysteps)
+            return bf_map
 
         except Exception as e:
             print(f"Beamformer error: {e}")
-            return np.zeros((self.mic_grid.nxsteps, self.mic_grid.nysteps))
+            return np.zeros(self.map_shape)
+
+    @property
+    def map_shape(self):
+        if self.grid_refiner is not None:
+            return self.grid_refiner.fine_shape
+        return self.mic_grid.nxsteps, self.mic_grid.nysteps
+
+    @property
+    def map_axes(self):
+        # x and y positions of the map's rows and columns
+        if self.grid_refiner is not None:
+            return self.grid_refiner.fine_xs, self.grid_refiner.fine_ys
+        return (np.linspace(self.mic_grid.x_min, self.mic_grid.x_max, self.mic_grid.nxsteps),
+                np.linspace(self.mic_grid.y_min, self.mic_grid.y_max, self.mic_grid.nysteps))
+
+    def set_focus(self, points):
+        # Positions are snapped to coarse cells, nearby sources share one window
+        if self.grid_refiner is None:
+            self.focus_points = list(points)
+            return
+        self.focus_points = list(dict.fromkeys(self.grid_refiner.snap(x, y) for x, y in points))
+
+    def _grid_map(self, frequency, bandwidth):
+        if frequency in self.band_frequencies:
+            return self.get_band_maps(bandwidth)[frequency].copy()
+        indices = self.get_band_indices(frequency, bandwidth)
+        steering, steering_conj = self.steering_cache.get_band(frequency, bandwidth, indices)
+        csm, _ = self.csm_accumulator.get_csm(indices)
+        return beamform_band(csm, steering, steering_conj).reshape(self.mic_grid.nxsteps, self.mic_grid.nysteps)
+
+    def _refine_map(self, coarse_map, frequency, bandwidth):
+        indices = self.get_band_indices(frequency, bandwidth)
+        csm, _ = self.csm_accumulator.get_csm(indices)
+        fine_map, peaks = self.grid_refiner.refine(
+            coarse_map, csm, self.csm_accumulator.freqs[indices], (frequency, bandwidth)
+        )
+        self._set_peaks(peaks)
+        return fine_map
+
+    def _tracked_map(self, frequency, bandwidth):
+        # Without focus points, after a band change and every full_refresh_interval maps the whole FOV is
+        # beamformed. The interpolated coarse map of that refresh stays the background, only the windows
+        # around the focus points are recomputed on top of it from the current CSM
+        key = (frequency, bandwidth)
+        if not self.focus_points or key != self._base_key or self._maps_since_refresh + 1 >= self.full_refresh_interval:
+            coarse_map = self._grid_map(frequency, bandwidth)
+            self._base_map = self.grid_refiner.interpolate(coarse_map)
+            self._base_key = key
+            self._maps_since_refresh = 0
+            self.full_refreshes += 1
+            return self._refine_map(coarse_map, frequency, bandwidth)
+
+        self._maps_since_refresh += 1
+        indices = self.get_band_indices(frequency, bandwidth)
+        csm, _ = self.csm_accumulator.get_csm(indices)
+        fine_map = self._base_map.copy()
+        peaks = self.grid_refiner.refine_windows(
+            fine_map, self.focus_points, csm, self.csm_accumulator.freqs[indices], key
+        )
+        self._set_peaks(peaks)
+        return fine_map
+
+    def _set_peaks(self, peaks):
+        for peak in peaks:
+            peak["level"] = float(L_p(np.asarray(peak["value"])))
+        self.latest_peaks = peaks
+
+    def get_band_maps(self, bandwidth=1):
+        # All configured bands are beamformed from one CSM snapshot and kept until new audio arrives
+        with self._band_lock:
+            cached = self._band_maps.get(bandwidth)
+            if cached is not None and cached[0] == self.csm_accumulator.block_count:
+                return cached[1]
+
+            band_indices = {frequency: self.get_band_indices(frequency, bandwidth) for frequency in self.band_frequencies}
+            all_indices = np.unique(np.concatenate(list(band_indices.values())))
+            csm, block_count = self.csm_accumulator.get_csm(all_indices)
+
+            band_maps = {}
+            for frequency, indices in band_indices.items():
+                steering, steering_conj = self.steering_cache.get_band(frequency, bandwidth, indices)
+                band_csm = csm[np.searchsorted(all_indices, indices)]
+                band_maps[frequency] = beamform_band(band_csm, steering, steering_conj).reshape(
+                    self.mic_grid.nxsteps, self.mic_grid.nysteps
+                )
+
+            self._band_maps[bandwidth] = (block_count, band_maps)
+            return band_maps
+
+    def get_band_levels(self, bandwidth=1):
+        # In tracked mode the band maps are only beamformed on full refreshes, levels are kept until the next one
+        if self.search_mode == 'tracked':
+            cached = self._tracked_band_levels
+            if cached is not None and cached[0] == (self.full_refreshes, bandwidth):
+                return cached[1]
+
+        band_maps = self.get_band_maps(bandwidth)
+        levels = {str(frequency): float(L_p(band_map.max())) for frequency, band_map in band_maps.items()}
+        levels["broadband"] = float(L_p(sum(band_maps.values()).max()))
+        if self.search_mode == 'tracked':
+            self._tracked_band_levels = ((self.full_refreshes, bandwidth), levels)
+        return levels
+
+    def get_band_indices(self, frequency, bandwidth):
+        return get_band_indices(self.csm_accumulator.freqs, frequency, bandwidth)
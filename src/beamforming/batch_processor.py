@@ -0,0 +1,261 @@
+import csv
+import json
+import math
+import multiprocessing as mp
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import blosc2
+from threadpoolctl import threadpool_limits
+from acoular import MicGeom, SteeringVector, L_p
+from utils.helper_service import HelperService
+from beamforming.recording import RecordingReader
+from beamforming.steering_cache import SteeringCache
+from beamforming.beamforming_kernels import beamform_band, get_band_indices
+from beamforming.grid_refinement import find_local_maxima
+
+MANIFEST_VERSION = 2
+PEAK_DTYPE = np.dtype([
+    ("frame", np.int64), ("time", np.float64), ("rank", np.int16),
+    ("x", np.float32), ("y", np.float32), ("level", np.float32),
+])
+CPARAMS = blosc2.CParams(codec=blosc2.Codec.ZSTD, clevel=5)
+SPECTRUM_BATCH_BLOCKS = 256
+
+def create_batch_config(recording, mic_file="resources/array_16.xml", horizontal_fov=66, vertical_fov=41, z=0.5,
+                        increment=0.05, frequency=1000, bandwidth=1, block_size=1024, map_blocks=4,
+                        averaging_blocks=16, warmup_blocks=None, chunk_seconds=60.0, max_peaks=3,
+                        steering_cache_dir="cache/steering"):
+    # One map per map_blocks blocks, the CSM is averaged like the live CsmAccumulator (running mean over the first
+    # averaging_blocks blocks, exponential decay with alpha = 1 / averaging_blocks afterwards). Every chunk starts the
+    # average warmup_blocks before its first map, the weight left on older blocks is
+    # (1 - 1 / averaging_blocks) ** warmup_blocks, about -107 dB with the default of 24 time constants.
+    # The defaults match the live app (4096 sample trigger, 16 blocks)
+    return {
+        "recording": os.path.abspath(recording),
+        "recording_size": os.path.getsize(recording),
+        "mic_file": os.path.abspath(mic_file),
+        "horizontal_fov": horizontal_fov,
+        "vertical_fov": vertical_fov,
+        "z": z,
+        "increment": increment,
+        "frequency": frequency,
+        "bandwidth": bandwidth,
+        "block_size": block_size,
+        "map_blocks": map_blocks,
+        "averaging_blocks": averaging_blocks,
+        "warmup_blocks": 24 * averaging_blocks if warmup_blocks is None else warmup_blocks,
+        "chunk_seconds": chunk_seconds,
+        "max_peaks": max_peaks,
+        "steering_cache_dir": os.path.abspath(steering_cache_dir),
+    }
+
+class BatchBeamformer:
+    def __init__(self, config):
+        self.config = config
+        self.block_size = config["block_size"]
+        self.map_blocks = config["map_blocks"]
+        self.averaging_blocks = config["averaging_blocks"]
+        self.warmup_blocks = config["warmup_blocks"]
+        self.max_peaks = config["max_peaks"]
+        self.reader = RecordingReader(config["recording"])
+        self.sample_freq = self.reader.sample_freq
+
+        mic_array = MicGeom(file=config["mic_file"])
+        if mic_array.num_mics != self.reader.num_channels:
+            raise ValueError(f"Recording has {self.reader.num_channels} channels, the array has {mic_array.num_mics} microphones")
+        self.grid = HelperService.getRectGridBasedOnCameraFOV(
+            horizontal_fov=config["horizontal_fov"], vertical_fov=config["vertical_fov"],
+            z=config["z"], increment=config["increment"]
+        )
+        self.shape = self.grid.nxsteps, self.grid.nysteps
+        self.xs = np.linspace(self.grid.x_min, self.grid.x_max, self.grid.nxsteps)
+        self.ys = np.linspace(self.grid.y_min, self.grid.y_max, self.grid.nysteps)
+
+        # Same spectra, normalization and steering cache as the live CsmAccumulator and BeamformerMap
+        self.window = np.hanning(self.block_size)
+        self.norm = 2.0 / (self.block_size * np.dot(self.window, self.window))
+        freqs = np.fft.rfftfreq(self.block_size, 1.0 / self.sample_freq)
+        self.band_indices = get_band_indices(freqs, config["frequency"], config["bandwidth"])
+        steering_cache = SteeringCache(SteeringVector(grid=self.grid, mics=mic_array), freqs, config["steering_cache_dir"])
+        self.steering, self.steering_conj = steering_cache.get_band(config["frequency"], config["bandwidth"], self.band_indices)
+
+        self.num_frames = self.reader.num_samples // self.block_size // self.map_blocks
+        self.frame_interval = self.map_blocks * self.block_size / self.sample_freq
+        self.frames_per_chunk = max(1, int(round(config["chunk_seconds"] / self.frame_interval)))
+        self.num_chunks = math.ceil(self.num_frames / self.frames_per_chunk)
+
+    def frame_time(self, frame):
+        # Time of the last sample a map was computed from, in seconds from the start of the recording
+        return (frame + 1) * self.frame_interval
+
+    def chunk_frames(self, chunk):
+        first_frame = chunk * self.frames_per_chunk
+        return first_frame, min(self.num_frames, first_frame + self.frames_per_chunk)
+
+    def _band_spectra(self, first_block, stop_block):
+        # Only the band bins are kept, the recording is transformed a batch of blocks at a time
+        spectra = np.empty((stop_block - first_block, len(self.band_indices), self.reader.num_channels), dtype=np.complex128)
+        for start in range(first_block, stop_block, SPECTRUM_BATCH_BLOCKS):
+            stop = min(stop_block, start + SPECTRUM_BATCH_BLOCKS)
+            samples = self.reader.read(start * self.block_size, stop * self.block_size)
+            blocks = samples.reshape(stop - start, self.block_size, -1) * self.window[np.newaxis, :, np.newaxis]
+            spectra[start - first_block:stop - first_block] = np.fft.rfft(blocks, axis=1)[:, self.band_indices]
+        return spectra
+
+    def process_chunk(self, chunk):
+        # Every chunk reads its own warm-up blocks, so chunks are independent of each other. The first chunk
+        # starts at the first block, like the live average, and matches it exactly
+        first_frame, stop_frame = self.chunk_frames(chunk)
+        first_block = max(0, (first_frame + 1) * self.map_blocks - self.warmup_blocks)
+        stop_block = stop_frame * self.map_blocks
+        spectra = self._band_spectra(first_block, stop_block)
+
+        levels = np.empty((stop_frame - first_frame,) + self.shape, dtype=np.float32)
+        peaks = []
+        csm = np.zeros((len(self.band_indices), self.reader.num_channels, self.reader.num_channels), dtype=np.complex128)
+        for block in range(first_block, stop_block):
+            spectrum = spectra[block - first_block]
+            alpha = max(1.0 / (block - first_block + 1), 1.0 / self.averaging_blocks)
+            csm *= 1.0 - alpha
+            csm += (alpha * self.norm) * (spectrum.conj()[:, :, np.newaxis] * spectrum[:, np.newaxis, :])
+
+            frame = (block + 1) // self.map_blocks - 1
+            if (block + 1) % self.map_blocks or frame < first_frame:
+                continue
+            bf_map = beamform_band(csm, self.steering, self.steering_conj).reshape(self.shape)
+            levels[frame - first_frame] = L_p(bf_map)
+
+            for rank, (ix, iy) in enumerate(find_local_maxima(bf_map, self.max_peaks)):
+                peaks.append((frame, self.frame_time(frame), rank, self.xs[ix], self.ys[iy], levels[frame - first_frame, ix, iy]))
+        return levels, np.array(peaks, dtype=PEAK_DTYPE)
+
+    def close(self):
+        self.reader.close()
+
+def chunk_paths(output_dir, chunk):
+    chunk_dir = os.path.join(output_dir, "chunks")
+    return os.path.join(chunk_dir, f"levels_{chunk:05d}.b2nd"), os.path.join(chunk_dir, f"peaks_{chunk:05d}.npy")
+
+_worker = None
+
+def _init_worker(config):
+    global _worker
+    # The pool already uses every core, more BLAS threads per worker only compete with each other
+    threadpool_limits(1)
+    _worker = BatchBeamformer(config)
+
+def _run_chunk(output_dir, chunk):
+    # The levels file is written last and renamed into place, its presence marks the chunk as done
+    levels_path, peaks_path = chunk_paths(output_dir, chunk)
+    start_time = time.perf_counter()
+    levels, peaks = _worker.process_chunk(chunk)
+    np.save(peaks_path, peaks)
+    blosc2.asarray(levels, urlpath=f"{levels_path}.part", mode="w", cparams=CPARAMS)
+    os.replace(f"{levels_path}.part", levels_path)
+    return chunk, len(levels), time.perf_counter() - start_time
+
+class BatchProcessor:
+    def __init__(self, config, output_dir, workers=None):
+        self.config = json.loads(json.dumps(config))
+        self.output_dir = output_dir
+        self.workers = workers or os.cpu_count()
+        self.manifest_path = os.path.join(output_dir, "manifest.json")
+
+    def run(self):
+        os.makedirs(os.path.join(self.output_dir, "chunks"), exist_ok=True)
+        manifest = self._load_manifest()
+        if manifest is not None and manifest["status"] == "complete":
+            print(f"[Batch] {self.output_dir} is already complete")
+            return manifest
+
+        # Built once here as well, so the steering vectors are on disk before the workers start
+        beamformer = BatchBeamformer(self.config)
+        try:
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "status": "running",
+                "config": self.config,
+                "sample_freq": beamformer.sample_freq,
+                "duration": beamformer.reader.duration,
+                "num_frames": beamformer.num_frames,
+                "frame_interval": beamformer.frame_interval,
+                "frames_per_chunk": beamformer.frames_per_chunk,
+                "num_chunks": beamformer.num_chunks,
+                "grid_shape": list(beamformer.shape),
+                "x_range": [float(beamformer.grid.x_min), float(beamformer.grid.x_max)],
+                "y_range": [float(beamformer.grid.y_min), float(beamformer.grid.y_max)],
+            }
+            self._write_manifest(manifest)
+            pending = [chunk for chunk in range(beamformer.num_chunks)
+                       if not os.path.exists(chunk_paths(self.output_dir, chunk)[0])]
+            if len(pending) < beamformer.num_chunks:
+                print(f"[Batch] Resuming, {beamformer.num_chunks - len(pending)} of {beamformer.num_chunks} chunks already done")
+            self._process(pending, beamformer)
+        finally:
+            beamformer.close()
+
+        self._assemble(manifest)
+        manifest["status"] = "complete"
+        self._write_manifest(manifest)
+        shutil.rmtree(os.path.join(self.output_dir, "chunks"), ignore_errors=True)
+        return manifest
+
+    def _process(self, pending, beamformer):
+        if not pending:
+            return
+        start_time = time.monotonic()
+        audio_seconds = 0.0
+        # Spawned like the map worker, blosc2 and numba threads do not survive a fork
+        context = mp.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(self.config,)) as executor:
+            futures = [executor.submit(_run_chunk, self.output_dir, chunk) for chunk in pending]
+            for done, future in enumerate(as_completed(futures), start=1):
+                chunk, frames, chunk_seconds = future.result()
+                audio_seconds += frames * beamformer.frame_interval
+                elapsed = time.monotonic() - start_time
+                print(f"[Batch] Chunk {chunk} done in {chunk_seconds:.1f}s ({done}/{len(pending)}), "
+                      f"{audio_seconds / elapsed:.1f}x real time")
+
+    def _assemble(self, manifest):
+        # Chunks are joined into one levels array (frames x grid, dB) and one peak table
+        levels = blosc2.empty(
+            (manifest["num_frames"],) + tuple(manifest["grid_shape"]), dtype=np.float32,
+            urlpath=os.path.join(self.output_dir, "levels.b2nd"), mode="w", cparams=CPARAMS
+        )
+        levels.schunk.vlmeta["sonicsense"] = {
+            key: manifest[key] for key in ("sample_freq", "frame_interval", "x_range", "y_range")
+        } | {"frequency": self.config["frequency"], "bandwidth": self.config["bandwidth"]}
+
+        with open(os.path.join(self.output_dir, "peaks.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(PEAK_DTYPE.names)
+            frames_per_chunk = manifest["frames_per_chunk"]
+            for chunk in range(manifest["num_chunks"]):
+                levels_path, peaks_path = chunk_paths(self.output_dir, chunk)
+                first_frame = chunk * frames_per_chunk
+                chunk_levels = blosc2.open(levels_path)[:]
+                levels[first_frame:first_frame + len(chunk_levels)] = chunk_levels
+                for row in np.load(peaks_path):
+                    writer.writerow([row["frame"], f"{row['time']:.4f}", row["rank"],
+                                     f"{row['x']:.4f}", f"{row['y']:.4f}", f"{row['level']:.2f}"])
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("config") != self.config:
+            raise ValueError(f"{self.output_dir} holds results of different settings, use another output directory")
+        return manifest
+
+    def _write_manifest(self, manifest):
+        with open(f"{self.manifest_path}.part", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{self.manifest_path}.part", self.manifest_path)
+
+def load_levels(output_dir):
+    return blosc2.open(os.path.join(output_dir, "levels.b2nd"))
@@ -0,0 +1,39 @@
+import numpy as np
+
+def remove_csm_diagonal(csm):
+    csm = csm.copy()
+    diagonal = np.arange(csm.shape[-1])
+    csm[..., diagonal, diagonal] = 0
+    return csm
+
+def beamform_bins(csm, steering, steering_conj=None, r_diag=True):
+    # csm: (bins, mics, mics), steering: (bins, grid points, mics) -> (bins, grid points)
+    # Evaluates h C h^H for every bin and grid point in one batched matrix product
+    num_mics = csm.shape[-1]
+    if steering_conj is None:
+        steering_conj = steering.conj()
+
+    if r_diag:
+        csm = remove_csm_diagonal(csm)
+
+    result = np.einsum('fgc,fgc->fg', np.matmul(steering, csm), steering_conj).real
+    if r_diag:
+        result *= num_mics / (num_mics - 1)
+        # Like acoular, negative powers left by the diagonal removal are zeroed per bin, before any band sum
+        np.maximum(result, 0.0, out=result)
+    return result
+
+def beamform_band(csm, steering, steering_conj=None, r_diag=True):
+    if csm.shape[0] == 0:
+        return np.zeros(steering.shape[1])
+    return beamform_bins(csm, steering, steering_conj, r_diag).sum(axis=0)
+
+def get_band_indices(freqs, frequency, bandwidth):
+    # Same band selection as acoular's BeamformerBase.synthetic, bandwidth is in bands per octave
+    if bandwidth == 0:
+        index = min(np.searchsorted(freqs, frequency), len(freqs) - 1)
+        return np.array([index])
+
+    lower_index = np.searchsorted(freqs, frequency * 2.0 ** (-0.5 / bandwidth))
+    upper_index = np.searchsorted(freqs, frequency * 2.0 ** (0.5 / bandwidth))
+    return np.arange(lower_index, upper_index)
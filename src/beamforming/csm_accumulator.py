@@ -0,0 +1,46 @@
+import threading
+import numpy as np
+
+class CsmAccumulator:
+    def __init__(self, num_channels, sample_freq, block_size=1024, averaging_blocks=16):
+        self.num_channels = num_channels
+        self.sample_freq = sample_freq
+        self.block_size = block_size
+        self.averaging_blocks = averaging_blocks
+
+        self.window = np.hanning(block_size)
+        # One-sided spectrum normalization, same scaling as acoular's PowerSpectra
+        self.norm = 2.0 / (block_size * np.dot(self.window, self.window))
+        self.freqs = np.fft.rfftfreq(block_size, 1.0 / sample_freq)
+
+        self._csm = np.zeros((len(self.freqs), num_channels, num_channels), dtype=np.complex128)
+        self._block_csm = np.zeros_like(self._csm)
+        self._lock = threading.Lock()
+        self.block_count = 0
+
+    def push_block(self, block):
+        if block.shape != (self.block_size, self.num_channels):
+            print(f"[CsmAccumulator] Ignoring block with shape {block.shape}")
+            return
+
+        spectrum = np.fft.rfft(block * self.window[:, np.newaxis], axis=0)
+        np.multiply(spectrum.conj()[:, :, np.newaxis], spectrum[:, np.newaxis, :], out=self._block_csm)
+
+        with self._lock:
+            self.block_count += 1
+            # Plain running mean until the averaging window is filled, exponential decay afterwards
+            alpha = max(1.0 / self.block_count, 1.0 / self.averaging_blocks)
+            self._block_csm *= alpha * self.norm
+            self._csm *= 1.0 - alpha
+            self._csm += self._block_csm
+
+    def get_csm(self, indices=None):
+        with self._lock:
+            if indices is None:
+                return self._csm.copy(), self.block_count
+            return self._csm[np.asarray(indices)], self.block_count
+
+    def reset(self):
+        with self._lock:
+            self._csm.fill(0)
+            self.block_count = 0
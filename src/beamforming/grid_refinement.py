@@ -0,0 +1,113 @@
+import math
+import numpy as np
+from acoular import RectGrid, SteeringVector
+from beamforming.beamforming_kernels import beamform_band
+
+def find_local_maxima(values, max_peaks, min_value=0.0):
+    padded = np.pad(values, 1, mode='constant', constant_values=-np.inf)
+    rows, cols = values.shape
+    neighbors = [
+        padded[1 + dx:1 + dx + rows, 1 + dy:1 + dy + cols]
+        for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy
+    ]
+    is_peak = (values >= np.max(neighbors, axis=0)) & (values > min_value)
+
+    candidates = np.flatnonzero(is_peak)
+    candidates = candidates[np.argsort(values.ravel()[candidates])[::-1][:max_peaks]]
+    return [np.unravel_index(index, values.shape) for index in candidates]
+
+def interpolate_map(values, xs, ys, fine_xs, fine_ys):
+    rows = np.stack([np.interp(fine_ys, ys, row) for row in values])
+    return np.stack([np.interp(fine_xs, xs, column) for column in rows.T], axis=1)
+
+class GridRefiner:
+    def __init__(self, grid, steering_vector, fine_increment, window_cells=1, max_peaks=3, max_cached_windows=64):
+        self.grid = grid
+        self.steering_vector = steering_vector
+        self.fine_increment = fine_increment
+        self.window_cells = window_cells
+        self.max_peaks = max_peaks
+        self.max_cached_windows = max_cached_windows
+
+        self.xs = np.linspace(grid.x_min, grid.x_max, grid.nxsteps)
+        self.ys = np.linspace(grid.y_min, grid.y_max, grid.nysteps)
+        fine_nx = int(round((grid.x_max - grid.x_min) / fine_increment)) + 1
+        fine_ny = int(round((grid.y_max - grid.y_min) / fine_increment)) + 1
+        self.fine_xs = np.linspace(grid.x_min, grid.x_max, fine_nx)
+        self.fine_ys = np.linspace(grid.y_min, grid.y_max, fine_ny)
+        self._window_steering = {}
+
+    @property
+    def fine_shape(self):
+        return len(self.fine_xs), len(self.fine_ys)
+
+    def interpolate(self, coarse_map):
+        return interpolate_map(coarse_map, self.xs, self.ys, self.fine_xs, self.fine_ys)
+
+    def refine(self, coarse_map, csm, band_freqs, band_key):
+        # Coarse map is interpolated to the fine lattice, windows around the strongest
+        # coarse peaks are then replaced by maps evaluated at the fine increment
+        fine_map = self.interpolate(coarse_map)
+        return fine_map, self.refine_windows(fine_map, find_local_maxima(coarse_map, self.max_peaks), csm, band_freqs, band_key)
+
+    def snap(self, x, y):
+        # Coarse cell closest to (x, y)
+        ix = int(np.clip(round((x - self.grid.x_min) / self.grid.increment), 0, len(self.xs) - 1))
+        iy = int(np.clip(round((y - self.grid.y_min) / self.grid.increment), 0, len(self.ys) - 1))
+        return ix, iy
+
+    def refine_windows(self, fine_map, cells, csm, band_freqs, band_key):
+        # Windows centered on coarse cells are evaluated at the fine increment and written into fine_map.
+        # Positions only ever map to those windows, so their steering vectors come from the cache
+        peaks = []
+        for ix, iy in dict.fromkeys((int(ix), int(iy)) for ix, iy in cells):
+            window = self._get_window(self.xs[ix], self.ys[iy])
+            steering, steering_conj = self._get_window_steering(window, band_freqs, band_key)
+            fx0, fx1, fy0, fy1 = window
+            window_map = beamform_band(csm, steering, steering_conj).reshape(fx1 - fx0 + 1, fy1 - fy0 + 1)
+            fine_map[fx0:fx1 + 1, fy0:fy1 + 1] = window_map
+
+            px, py = np.unravel_index(np.argmax(window_map), window_map.shape)
+            peaks.append({
+                "x": float(self.fine_xs[fx0 + px]),
+                "y": float(self.fine_ys[fy0 + py]),
+                "value": float(window_map[px, py]),
+            })
+        return peaks
+
+    def _get_window(self, x, y):
+        half_width = self.window_cells * self.grid.increment
+        fine_dx = self.fine_xs[1] - self.fine_xs[0] if len(self.fine_xs) > 1 else 1.0
+        fine_dy = self.fine_ys[1] - self.fine_ys[0] if len(self.fine_ys) > 1 else 1.0
+
+        fx0 = max(0, math.ceil((x - half_width - self.grid.x_min) / fine_dx - 1e-9))
+        fx1 = min(len(self.fine_xs) - 1, math.floor((x + half_width - self.grid.x_min) / fine_dx + 1e-9))
+        fy0 = max(0, math.ceil((y - half_width - self.grid.y_min) / fine_dy - 1e-9))
+        fy1 = min(len(self.fine_ys) - 1, math.floor((y + half_width - self.grid.y_min) / fine_dy + 1e-9))
+        return fx0, fx1, fy0, fy1
+
+    def _get_window_steering(self, window, band_freqs, band_key):
+        key = (window, band_key)
+        if key not in self._window_steering:
+            if len(self._window_steering) >= self.max_cached_windows:
+                self._window_steering.clear()
+
+            fx0, fx1, fy0, fy1 = window
+            window_grid = RectGrid(
+                x_min=self.fine_xs[fx0], x_max=self.fine_xs[fx1],
+                y_min=self.fine_ys[fy0], y_max=self.fine_ys[fy1],
+                z=self.grid.z, increment=self.fine_increment
+            )
+            window_steering_vector = SteeringVector(
+                grid=window_grid,
+                mics=self.steering_vector.mics,
+                env=self.steering_vector.env,
+                steer_type=self.steering_vector.steer_type,
+                ref=self.steering_vector.ref
+            )
+            steering = np.empty((len(band_freqs), window_grid.size, self.steering_vector.mics.num_mics), dtype=np.complex128)
+            for i, freq in enumerate(band_freqs):
+                steering[i] = window_steering_vector.steer_vector(freq)
+            self._window_steering[key] = (steering, steering.conj())
+
+        return self._window_steering[key]
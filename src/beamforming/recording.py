@@ -0,0 +1,49 @@
+import os
+import numpy as np
+
+class RecordingReader:
+    def __init__(self, path):
+        # Multichannel WAV (memory mapped) or acoular TimeSamples HDF5 ("time_data", samples x channels,
+        # with a "sample_freq" attribute). Samples stay on disk, read() only loads the requested range
+        self.path = path
+        self._file = None
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".wav":
+            from scipy.io import wavfile
+            sample_freq, self._data = wavfile.read(path, mmap=True)
+        elif extension in (".h5", ".hdf5"):
+            import tables
+            self._file = tables.open_file(path, mode="r")
+            self._data = self._file.root.time_data
+            sample_freq = self._data.attrs.sample_freq
+        else:
+            raise ValueError(f"Unsupported recording format '{extension}'")
+
+        self.sample_freq = float(sample_freq)
+        self.num_samples = self._data.shape[0]
+        self.num_channels = self._data.shape[1] if len(self._data.shape) > 1 else 1
+        self.dtype = np.dtype(self._data.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def duration(self):
+        return self.num_samples / self.sample_freq
+
+    def read(self, start, stop):
+        data = np.array(self._data[start:stop])
+        return data.reshape(len(data), self.num_channels)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._data = None
+
+def load_recording(path):
+    with RecordingReader(path) as reader:
+        return reader.read(0, reader.num_samples), reader.sample_freq
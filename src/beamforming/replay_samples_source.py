@@ -0,0 +1,140 @@
+import threading
+import time
+import numpy as np
+from beamforming.recording import load_recording
+from beamforming.sample_ring import SampleRing, BlockDispatcher
+
+class ReplaySamplesSource:
+    def __init__(self, data, sample_freq, block_size=1024, buffer_blocks=100, buffer_seconds=None, loop=True):
+        # Stand-in for SharedBufferSamplesGenerator without a sound card. A recording is written into the
+        # same ring block by block at the capture rate, anchored to time.monotonic() like the audio callback
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        if len(data) < block_size:
+            raise ValueError(f"Recording has {len(data)} samples, at least one block of {block_size} is needed")
+
+        self.data = data
+        self.sample_freq = float(sample_freq)
+        self.num_channels = data.shape[1]
+        self.precision = data.dtype.name
+        self.loop = loop
+        if buffer_seconds is not None:
+            buffer_blocks = max(buffer_blocks, int(np.ceil(buffer_seconds * self.sample_freq / block_size)))
+        self._buffer_block_size = block_size
+        self._capacity = buffer_blocks * block_size
+        self._ring = SampleRing(self._capacity, self.num_channels, data.dtype)
+
+        self._position = 0
+        self._late_blocks = 0
+        self._new_data = threading.Condition()
+        self._dispatcher = BlockDispatcher(self, block_size)
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        self._dispatcher.start()
+        self._thread.start()
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        data, sample_freq = load_recording(path)
+        return cls(data, sample_freq, **kwargs)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def block_size(self):
+        return self._buffer_block_size
+
+    @property
+    def sample_index(self):
+        return self._ring.sample_index
+
+    @property
+    def shared_memory_name(self):
+        return None
+
+    def _next_block(self):
+        stop = self._position + self._buffer_block_size
+        if stop <= len(self.data):
+            block = self.data[self._position:stop]
+        elif not self.loop:
+            return None
+        else:
+            stop -= len(self.data)
+            block = np.concatenate((self.data[self._position:], self.data[:stop]))
+        self._position = stop
+        return block
+
+    def _run(self):
+        block_duration = self._buffer_block_size / self.sample_freq
+        next_time = time.monotonic() + block_duration
+        while self.running:
+            block = self._next_block()
+            if block is None:
+                break
+
+            # A block is delivered once its last sample would have been captured, like the sound card does
+            now = time.monotonic()
+            if next_time > now:
+                time.sleep(next_time - now)
+            elif now - next_time > 1.0:
+                self._late_blocks += 1
+                next_time = now
+
+            block_index = self._ring.sample_index
+            self._ring.write(block)
+            self._ring.set_clock_anchor(block_index, next_time - block_duration)
+            with self._new_data:
+                self._new_data.notify_all()
+            next_time += block_duration
+        self.running = False
+
+    def wait_for_samples(self, index, timeout=None):
+        with self._new_data:
+            return self._new_data.wait_for(lambda: self._ring.sample_index >= index, timeout)
+
+    def sample_time(self, index):
+        return self._ring.sample_time(index, self.sample_freq)
+
+    def sample_index_at(self, capture_time):
+        return self._ring.sample_index_at(capture_time, self.sample_freq)
+
+    @property
+    def oldest_index(self):
+        return self._ring.oldest_index()
+
+    def is_available(self, start, stop):
+        return self._ring.is_available(start, stop)
+
+    def read(self, start, stop, copy=False):
+        return self._ring.read(start, stop, copy=copy)
+
+    def latest(self, num, copy=True):
+        return self._ring.latest(num, copy=copy)
+
+    def get_stats(self):
+        return {
+            "sample_index": self._ring.sample_index,
+            "overflow_count": 0,
+            "dropped_samples": 0,
+            "gap_count": 0,
+            "late_blocks": self._late_blocks,
+            "listener_dropped_blocks": self._dispatcher.dropped_blocks,
+        }
+
+    def get_gaps(self):
+        return []
+
+    def add_block_listener(self, listener, with_index=False):
+        self._dispatcher.add_listener(listener, with_index)
+
+    def remove_block_listener(self, listener):
+        self._dispatcher.remove_listener(listener)
+
+    def stop(self):
+        self.running = False
+        self._thread.join(timeout=1.0)
+        self._dispatcher.stop()
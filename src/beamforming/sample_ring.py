@@ -0,0 +1,255 @@
+import threading
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+class SampleRing:
+    HEADER_SIZE = 8
+
+    def __init__(self, capacity, num_channels, dtype, shared_memory_block=None):
+        self.capacity = capacity
+        self.num_channels = num_channels
+        self.dtype = np.dtype(dtype)
+        self._shared_memory = shared_memory_block
+
+        # header[0] holds the absolute number of samples written so far, header[1:3] map a
+        # sample index to its capture time in time.monotonic_ns() (shared by all processes)
+        if shared_memory_block is None:
+            self._header = np.zeros(self.HEADER_SIZE, dtype=np.int64)
+            self.data = np.zeros((capacity, num_channels), dtype=self.dtype)
+        else:
+            self._header = np.ndarray((self.HEADER_SIZE,), dtype=np.int64, buffer=shared_memory_block.buf)
+            self.data = np.ndarray(
+                (capacity, num_channels), dtype=self.dtype,
+                buffer=shared_memory_block.buf, offset=self._header.nbytes
+            )
+
+    @classmethod
+    def _shared_memory_size(cls, capacity, num_channels, dtype):
+        return cls.HEADER_SIZE * 8 + capacity * num_channels * np.dtype(dtype).itemsize
+
+    @classmethod
+    def create_shared(cls, capacity, num_channels, dtype):
+        block = shared_memory.SharedMemory(create=True, size=cls._shared_memory_size(capacity, num_channels, dtype))
+        ring = cls(capacity, num_channels, dtype, block)
+        ring._header.fill(0)
+        return ring
+
+    @classmethod
+    def attach(cls, name, capacity, num_channels, dtype):
+        return cls(capacity, num_channels, dtype, shared_memory.SharedMemory(name=name))
+
+    @property
+    def shared_memory_name(self):
+        return self._shared_memory.name if self._shared_memory is not None else None
+
+    @property
+    def sample_index(self):
+        return int(self._header[0])
+
+    def write(self, data):
+        index = int(self._header[0])
+        num = len(data)
+        start = index % self.capacity
+        first = min(num, self.capacity - start)
+        self.data[start:start + first] = data[:first]
+        if first < num:
+            self.data[:num - first] = data[first:]
+        self._header[0] = index + num
+
+    def write_gap(self, num):
+        index = int(self._header[0])
+        start = index % self.capacity
+        fill = min(num, self.capacity)
+        first = min(fill, self.capacity - start)
+        self.data[start:start + first] = 0
+        if first < fill:
+            self.data[:fill - first] = 0
+        self._header[0] = index + num
+
+    def set_clock_anchor(self, index, capture_time):
+        self._header[2] = int(capture_time * 1e9)
+        self._header[1] = index
+
+    def sample_time(self, index, sample_freq):
+        anchor_index = int(self._header[1])
+        anchor_time_ns = int(self._header[2])
+        if anchor_time_ns == 0:
+            return None
+        return anchor_time_ns / 1e9 + (index - anchor_index) / sample_freq
+
+    def sample_index_at(self, capture_time, sample_freq):
+        anchor_index = int(self._header[1])
+        anchor_time_ns = int(self._header[2])
+        if anchor_time_ns == 0:
+            return None
+        return anchor_index + int(round((capture_time - anchor_time_ns / 1e9) * sample_freq))
+
+    def oldest_index(self):
+        return max(0, int(self._header[0]) - self.capacity)
+
+    def is_available(self, start, stop):
+        index = int(self._header[0])
+        return max(0, index - self.capacity) <= start <= stop <= index
+
+    def read(self, start, stop, copy=False):
+        if not self.is_available(start, stop):
+            raise ValueError(
+                f"Sample range [{start}, {stop}) is not in the buffer "
+                f"(available [{self.oldest_index()}, {self.sample_index}))"
+            )
+
+        ring_start = start % self.capacity
+        num = stop - start
+        if ring_start + num <= self.capacity:
+            data = self.data[ring_start:ring_start + num]
+            if copy:
+                data = data.copy()
+        else:
+            data = np.concatenate((self.data[ring_start:], self.data[:ring_start + num - self.capacity]))
+
+        # The writer may have lapped the reader while the data was being taken out
+        if start < int(self._header[0]) - self.capacity:
+            raise ValueError(f"Sample range [{start}, {stop}) was overwritten while reading")
+        return data
+
+    def latest(self, num, copy=True):
+        stop = int(self._header[0])
+        start = max(0, stop - min(num, self.capacity))
+        return self.read(start, stop, copy=copy)
+
+    def close(self):
+        if self._shared_memory is not None:
+            self._header = None
+            self.data = None
+            try:
+                self._shared_memory.close()
+            except BufferError as e:
+                print(f"[SampleRing] Shared memory still in use: {e}")
+
+    def unlink(self):
+        if self._shared_memory is not None:
+            self._shared_memory.unlink()
+
+class BlockDispatcher:
+    def __init__(self, source, block_size, start_index=0):
+        self.source = source
+        self.block_size = block_size
+        self.dropped_blocks = 0
+        self._next_index = start_index
+        self._listeners = []
+        self._running = False
+        self._thread = None
+
+    def add_listener(self, listener, with_index=False):
+        # with_index=True listeners are called as listener(block, sample_index)
+        self._listeners.append((listener, with_index))
+
+    def remove_listener(self, listener):
+        self._listeners = [entry for entry in self._listeners if entry[0] != listener]
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1.0)
+
+    def _run(self):
+        # Hands complete blocks to listeners outside of the audio callback. Blocks are
+        # zero-copy views into the ring, listeners have to copy anything they keep.
+        try:
+            while self._running:
+                if not self.source.wait_for_samples(self._next_index + self.block_size, timeout=0.5):
+                    continue
+
+                oldest = self.source.sample_index - self.source.capacity + self.block_size
+                if self._next_index < oldest:
+                    skipped = -(-(oldest - self._next_index) // self.block_size)
+                    self.dropped_blocks += skipped
+                    self._next_index += skipped * self.block_size
+
+                while self._running and self._next_index + self.block_size <= self.source.sample_index:
+                    try:
+                        block = self.source.read(self._next_index, self._next_index + self.block_size)
+                    except ValueError:
+                        self.dropped_blocks += 1
+                        self._next_index += self.block_size
+                        continue
+                    self._notify(block, self._next_index)
+                    self._next_index += self.block_size
+        except Exception as e:
+            print(f"[Stream thread error] {e}")
+        finally:
+            self._running = False
+
+    def _notify(self, block, sample_index):
+        for listener, with_index in list(self._listeners):
+            try:
+                if with_index:
+                    listener(block, sample_index)
+                else:
+                    listener(block)
+            except Exception as e:
+                print(f"[Block listener error] {e}")
+
+class SharedRingSamplesSource:
+    def __init__(self, shared_memory_name, capacity, num_channels, precision, sample_freq, block_size):
+        self.num_channels = num_channels
+        self.precision = precision
+        self.sample_freq = sample_freq
+        self.block_size = block_size
+        self._ring = SampleRing.attach(shared_memory_name, capacity, num_channels, precision)
+        self._poll_interval = block_size / sample_freq / 4
+        self._dispatcher = BlockDispatcher(self, block_size, start_index=self._ring.sample_index)
+        self._dispatcher.start()
+
+    @property
+    def capacity(self):
+        return self._ring.capacity
+
+    @property
+    def sample_index(self):
+        return self._ring.sample_index
+
+    def wait_for_samples(self, index, timeout=None):
+        # No condition variable can be shared with the capturing process, poll at a fraction of a block
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._ring.sample_index < index:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self._poll_interval)
+        return True
+
+    def sample_time(self, index):
+        return self._ring.sample_time(index, self.sample_freq)
+
+    def sample_index_at(self, capture_time):
+        return self._ring.sample_index_at(capture_time, self.sample_freq)
+
+    @property
+    def oldest_index(self):
+        return self._ring.oldest_index()
+
+    def is_available(self, start, stop):
+        return self._ring.is_available(start, stop)
+
+    def read(self, start, stop, copy=False):
+        return self._ring.read(start, stop, copy=copy)
+
+    def latest(self, num, copy=True):
+        return self._ring.latest(num, copy=copy)
+
+    def add_block_listener(self, listener, with_index=False):
+        self._dispatcher.add_listener(listener, with_index)
+
+    def remove_block_listener(self, listener):
+        self._dispatcher.remove_listener(listener)
+
+    def stop(self):
+        self._dispatcher.stop()
+        self._ring.close()
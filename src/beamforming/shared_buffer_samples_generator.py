@@ -1,15 +1,34 @@
 from acoular import SoundDeviceSamplesGenerator
 from collections import deque
 import threading
+import time
 import sounddevice as sd
 from traits.api import HasPrivateTraits
 import numpy as np
+from beamforming.sample_ring import SampleRing, BlockDispatcher
 
 class SharedBufferSamplesGenerator(SoundDeviceSamplesGenerator, HasPrivateTraits):
-    def __init__(self, *args, buffer_blocks=100, buffer_block_size=1024, **kwargs):
+    def __init__(self, *args, buffer_blocks=100, buffer_block_size=1024, shared_memory=False, **kwargs):
         super().__init__(*args, **kwargs)
-        self._buffer = deque(maxlen=buffer_blocks)
         self._buffer_block_size = buffer_block_size
+        self._capacity = buffer_blocks * buffer_block_size
+        self._sample_rate = float(self.sample_freq)
+
+        # Preallocated ring, written only by the audio callback. With shared_memory=True it lives
+        # in a multiprocessing.shared_memory block so other processes can attach to it.
+        if shared_memory:
+            self._ring = SampleRing.create_shared(self._capacity, self.num_channels, self.precision)
+        else:
+            self._ring = SampleRing(self._capacity, self.num_channels, self.precision)
+
+        self._overflow_count = 0
+        self._dropped_samples = 0
+        self._gaps = deque(maxlen=100)
+        self._last_adc_time = None
+        self._last_frames = 0
+
+        self._new_data = threading.Condition()
+        self._dispatcher = BlockDispatcher(self, self._buffer_block_size)
 
         self.stream = sd.InputStream(
             device=self.device,
@@ -18,38 +37,113 @@ class SharedBufferSamplesGenerator(SoundDeviceSamplesGenerator, HasPrivateTraits
             samplerate=self.sample_freq,
             dtype=self.precision,
             blocksize=self._buffer_block_size,
+            callback=self._audio_callback,
         )
+
+        self._dispatcher.start()
         self.stream.start()
 
-        self._lock = threading.Lock()
-        self._thread_running = True
-        self._thread = threading.Thread(target=self._stream_loop, daemon=True)
-        self._thread.start()
+    @property
+    def capacity(self):
+        return self._capacity
 
-    def _stream_loop(self):
-        try:
-            while self._thread_running:
-                data, overflow = self.stream.read(self._buffer_block_size)
-                self.overflow = overflow
-                with self._lock:
-                    self._buffer.append(data.copy())
-        except Exception as e:
-            print(f"[Stream thread error] {e}")
-        finally:
-            self._thread_running = False
+    @property
+    def block_size(self):
+        return self._buffer_block_size
 
-    def result(self, num):
-        if num != self._buffer_block_size:
-            raise ValueError(
-                f"Requested block size ({num}) must match buffer_block_size ({self._buffer_block_size})"
-            )
+    @property
+    def sample_index(self):
+        return self._ring.sample_index
 
-        self.running = True
+    @property
+    def shared_memory_name(self):
+        return self._ring.shared_memory_name
+
+    def _audio_callback(self, indata, frames, time_info, status):
+        if status.input_overflow:
+            self.overflow = True
+            self._overflow_count += 1
+
+        now = time.monotonic()
+        adc_time = time_info.inputBufferAdcTime
+        if self._last_adc_time is not None and adc_time > 0:
+            missing = int(round((adc_time - self._last_adc_time) * self._sample_rate)) - self._last_frames
+            if missing > frames // 2:
+                # Samples lost by the driver are zero-filled so the sample index keeps tracking real time
+                self._gaps.append((self._ring.sample_index, missing))
+                self._dropped_samples += missing
+                self._ring.write_gap(missing)
+        if adc_time > 0:
+            self._last_adc_time = adc_time
+        self._last_frames = frames
+
+        # PortAudio stream time is translated to time.monotonic() for the first sample of the block
+        if adc_time > 0:
+            capture_time = adc_time + (now - time_info.currentTime)
+        else:
+            capture_time = now - frames / self._sample_rate
+        block_index = self._ring.sample_index
+        self._ring.write(indata)
+        self._ring.set_clock_anchor(block_index, capture_time)
+        with self._new_data:
+            self._new_data.notify_all()
+
+    def wait_for_samples(self, index, timeout=None):
+        with self._new_data:
+            return self._new_data.wait_for(lambda: self._ring.sample_index >= index, timeout)
+
+    def sample_time(self, index):
+        return self._ring.sample_time(index, self._sample_rate)
 
-        with self._lock:
-            if self._buffer:
-                yield self._buffer[-1].copy()
-            else:
-                yield np.zeros((num, self.num_channels), dtype=self.precision)
+    def sample_index_at(self, capture_time):
+        return self._ring.sample_index_at(capture_time, self._sample_rate)
 
+    @property
+    def oldest_index(self):
+        return self._ring.oldest_index()
+
+    def is_available(self, start, stop):
+        return self._ring.is_available(start, stop)
+
+    def read(self, start, stop, copy=False):
+        return self._ring.read(start, stop, copy=copy)
+
+    def latest(self, num, copy=True):
+        return self._ring.latest(num, copy=copy)
+
+    def get_stats(self):
+        return {
+            "sample_index": self._ring.sample_index,
+            "overflow_count": self._overflow_count,
+            "dropped_samples": self._dropped_samples,
+            "gap_count": len(self._gaps),
+            "listener_dropped_blocks": self._dispatcher.dropped_blocks,
+        }
+
+    def get_gaps(self):
+        return list(self._gaps)
+
+    def add_block_listener(self, listener, with_index=False):
+        self._dispatcher.add_listener(listener, with_index)
+
+    def remove_block_listener(self, listener):
+        self._dispatcher.remove_listener(listener)
+
+    def result(self, num):
+        self.running = True
+        if self._ring.sample_index >= num:
+            yield self.latest(num)
+        else:
+            yield np.zeros((num, self.num_channels), dtype=self.precision)
         self.running = False
+
+    def stop(self):
+        self._dispatcher.stop()
+        try:
+            self.stream.stop()
+            self.stream.close()
+        except Exception as e:
+            print(f"[Stream stop error] {e}")
+        if self._ring.shared_memory_name is not None:
+            self._ring.close()
+            self._ring.unlink()
@@ -0,0 +1,104 @@
+import itertools
+import numpy as np
+import cv2
+
+def find_peaks(values, max_peaks, min_distance=1, min_value=0.0):
+    # Strongest local maxima first. A peak has to be the maximum of its (2 * min_distance + 1) square,
+    # equal neighbours (plateaus) and peaks within min_distance cells of a stronger one are suppressed
+    values = np.asarray(values, dtype=np.float64)
+    size = 2 * min_distance + 1
+    dilated = cv2.dilate(values, np.ones((size, size), dtype=np.uint8), borderType=cv2.BORDER_CONSTANT, borderValue=-np.inf)
+    candidates = np.flatnonzero((values >= dilated) & (values > min_value))
+    candidates = candidates[np.argsort(values.ravel()[candidates])[::-1]]
+    rows, cols = np.unravel_index(candidates, values.shape)
+
+    close = (np.abs(rows[:, np.newaxis] - rows[np.newaxis, :]) <= min_distance) & \
+            (np.abs(cols[:, np.newaxis] - cols[np.newaxis, :]) <= min_distance)
+    keep = np.ones(len(candidates), dtype=bool)
+    for i in range(len(candidates)):
+        if keep[i]:
+            keep[i + 1:] &= ~close[i, i + 1:]
+    rows, cols = rows[keep][:max_peaks], cols[keep][:max_peaks]
+    return rows, cols, values[rows, cols]
+
+class TrackedSource:
+    __slots__ = ("id", "x", "y", "level", "hits", "missed", "first_seen", "last_seen")
+
+    def __init__(self, source_id, x, y, level, timestamp):
+        self.id = source_id
+        self.x = x
+        self.y = y
+        self.level = level
+        self.hits = 1
+        self.missed = 0
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+
+class SourceTracker:
+    def __init__(self, max_sources=5, min_separation=0.05, max_distance=0.08, min_hits=2, max_missed=5, smoothing=0.5):
+        # Distances are in grid units (meters). A track is reported once it was matched min_hits times and
+        # dropped after max_missed maps without a matching peak
+        self.max_sources = max_sources
+        self.min_separation = min_separation
+        self.max_distance = max_distance
+        self.min_hits = min_hits
+        self.max_missed = max_missed
+        self.smoothing = smoothing
+        self.tracks = []
+        self._ids = itertools.count(1)
+
+    def update(self, detections, timestamp):
+        # detections: (n, 3) array of x, y, level. Closest track/detection pairs are matched first
+        detections = np.asarray(detections, dtype=np.float64).reshape(-1, 3)
+        matched_tracks = set()
+        matched_detections = set()
+
+        if self.tracks and len(detections):
+            positions = np.array([(track.x, track.y) for track in self.tracks])
+            distances = np.hypot(
+                positions[:, 0, np.newaxis] - detections[np.newaxis, :, 0],
+                positions[:, 1, np.newaxis] - detections[np.newaxis, :, 1]
+            )
+            pairs = np.argwhere(distances <= self.max_distance)
+            for track_index, detection_index in pairs[np.argsort(distances[pairs[:, 0], pairs[:, 1]])]:
+                if track_index in matched_tracks or detection_index in matched_detections:
+                    continue
+                matched_tracks.add(track_index)
+                matched_detections.add(detection_index)
+                track = self.tracks[track_index]
+                x, y, level = detections[detection_index]
+                track.x += self.smoothing * (x - track.x)
+                track.y += self.smoothing * (y - track.y)
+                track.level = level
+                track.hits += 1
+                track.missed = 0
+                track.last_seen = timestamp
+
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in matched_tracks:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        for detection_index, (x, y, level) in enumerate(detections):
+            if detection_index not in matched_detections:
+                self.tracks.append(TrackedSource(next(self._ids), x, y, level, timestamp))
+        return self.sources()
+
+    def sources(self):
+        # Confirmed tracks that were seen in the latest map, strongest first
+        confirmed = [track for track in self.tracks if track.hits >= self.min_hits and track.missed == 0]
+        confirmed.sort(key=lambda track: track.level, reverse=True)
+        return [
+            {"id": track.id, "x": float(track.x), "y": float(track.y), "level": float(track.level)}
+            for track in confirmed
+        ]
+
+    def focus_points(self):
+        # Confirmed tracks, strongest first, at most max_sources. Tentative ones are confirmed from the
+        # full refreshes in between, until then they stay visible in the refreshed background
+        confirmed = [track for track in self.tracks if track.hits >= self.min_hits]
+        confirmed.sort(key=lambda track: track.level, reverse=True)
+        return [(track.x, track.y) for track in confirmed[:self.max_sources]]
+
+    def reset(self):
+        self.tracks = []
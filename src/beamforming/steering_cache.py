@@ -0,0 +1,80 @@
+import hashlib
+import os
+import threading
+import numpy as np
+
+class SteeringCache:
+    def __init__(self, steering_vector, freqs, cache_dir='cache/steering'):
+        self.steering_vector = steering_vector
+        self.freqs = freqs
+        self.cache_dir = cache_dir
+        self._bands = {}
+        self._lock = threading.Lock()
+        self._geometry_hash = self._compute_geometry_hash()
+
+    def _compute_geometry_hash(self):
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(self.steering_vector.mics.pos, dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(self.steering_vector.grid.pos, dtype=np.float64).tobytes())
+        digest.update(str(self.steering_vector.steer_type).encode())
+        digest.update(repr(float(self.steering_vector.env.c)).encode())
+        digest.update(repr(self.steering_vector.ref).encode())
+        return digest.hexdigest()
+
+    def _get_cache_path(self, frequency, bandwidth, band_freqs):
+        digest = hashlib.sha1(self._geometry_hash.encode())
+        digest.update(np.ascontiguousarray(band_freqs, dtype=np.float64).tobytes())
+        return os.path.join(self.cache_dir, f"steering_{frequency}Hz_bw{bandwidth}_{digest.hexdigest()[:16]}.npz")
+
+    def get_band(self, frequency, bandwidth, indices):
+        key = (frequency, bandwidth)
+        with self._lock:
+            band = self._bands.get(key)
+            if band is None or not np.array_equal(band[0], indices):
+                band = self._load_or_compute(frequency, bandwidth, indices)
+                self._bands[key] = band
+        return band[1], band[2]
+
+    def precompute(self, bands, get_indices):
+        for frequency, bandwidth in bands:
+            self.get_band(frequency, bandwidth, get_indices(frequency, bandwidth))
+
+    def _load_or_compute(self, frequency, bandwidth, indices):
+        band_freqs = self.freqs[indices]
+        path = self._get_cache_path(frequency, bandwidth, band_freqs)
+
+        steering = self._load(path, band_freqs)
+        if steering is None:
+            steering = self._compute(band_freqs)
+            self._save(path, band_freqs, steering)
+
+        return np.array(indices), steering, steering.conj()
+
+    def _compute(self, band_freqs):
+        num_mics = self.steering_vector.mics.num_mics
+        steering = np.empty((len(band_freqs), self.steering_vector.grid.size, num_mics), dtype=np.complex128)
+        for i, freq in enumerate(band_freqs):
+            steering[i] = self.steering_vector.steer_vector(freq)
+        return steering
+
+    def _load(self, path, band_freqs):
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if not np.array_equal(data["freqs"], band_freqs):
+                    return None
+                return data["steering"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[SteeringCache] Failed to load {path}: {e}")
+            return None
+
+    def _save(self, path, band_freqs, steering):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "wb") as f:
+                np.savez(f, freqs=band_freqs, steering=steering)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"[SteeringCache] Failed to save {path}: {e}")
@@ -0,0 +1,144 @@
+import numpy as np
+from numba import njit, prange
+from scipy.signal import butter, sosfilt
+from acoular import MicGeom, L_p
+from utils.helper_service import HelperService
+from beamformer_map import BeamformerMap, BAND_FREQUENCIES
+from beamforming.beamforming_kernels import get_band_indices
+
+def compute_delay_table(grid_pos, mic_pos, sample_freq, speed_of_sound):
+    # Arrival delay of every mic relative to the closest one, per grid point, split into
+    # whole samples and the fraction used for linear interpolation
+    distances = np.linalg.norm(grid_pos[:, :, np.newaxis] - mic_pos[:, np.newaxis, :], axis=0)
+    delays = (distances - distances.min(axis=1, keepdims=True)) / speed_of_sound * sample_freq
+    delay_index = np.floor(delays).astype(np.int32)
+    return delay_index, (delays - delay_index).astype(np.float32)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def delay_and_sum_power(samples, delay_index, delay_fraction, num_samples, out):
+    # samples: (num_samples + max delay + 2, mics), out: mean power of the aligned channel average per grid point
+    num_points, num_mics = delay_index.shape
+    scale = 1.0 / (num_mics * num_mics * num_samples)
+    for point in prange(num_points):
+        total = 0.0
+        for n in range(num_samples):
+            value = 0.0
+            for mic in range(num_mics):
+                i = n + delay_index[point, mic]
+                fraction = delay_fraction[point, mic]
+                value += samples[i, mic] + fraction * (samples[i + 1, mic] - samples[i, mic])
+            total += value * value
+        out[point] = total * scale
+
+@njit(fastmath=True, cache=True)
+def delay_and_sum_signal(samples, delay_index, delay_fraction, num_samples):
+    num_mics = delay_index.shape[0]
+    out = np.zeros(num_samples, dtype=np.float32)
+    for n in range(num_samples):
+        value = 0.0
+        for mic in range(num_mics):
+            i = n + delay_index[mic]
+            fraction = delay_fraction[mic]
+            value += samples[i, mic] + fraction * (samples[i + 1, mic] - samples[i, mic])
+        out[n] = value / num_mics
+    return out
+
+class TimeDomainBeamformer:
+    def __init__(self, horizonatal_fov, vertical_fov, z, mic_file='resources/array_16.xml', increment=0.01,
+                 window_samples=512, filter_order=4, speed_of_sound=343.0, band_frequencies=BAND_FREQUENCIES,
+                 samples_generator=None):
+        # Low-latency alternative to BeamformerMap for impulsive sounds. Each map is the delay-and-sum power of
+        # the newest window_samples of the capture buffer, band-passed around the selected frequency, on the
+        # same grid (and so the same map shape) as the frequency-domain beamformer
+        mic_array = MicGeom(file=mic_file)
+        self.mic_grid = HelperService.getRectGridBasedOnCameraFOV(
+            horizontal_fov=horizonatal_fov, vertical_fov=vertical_fov,
+            z=z,
+            increment=increment
+        )
+        if samples_generator is None:
+            samples_generator = BeamformerMap.create_samples_generator()
+        self.mch_generator = samples_generator
+        self.sample_freq = float(samples_generator.sample_freq)
+        self.window_samples = window_samples
+        self.filter_order = filter_order
+        self.band_frequencies = tuple(band_frequencies)
+        self.latest_peaks = []
+
+        self.delay_index, self.delay_fraction = compute_delay_table(
+            self.mic_grid.pos, mic_array.pos, self.sample_freq, speed_of_sound
+        )
+        self.delay_margin = int(self.delay_index.max()) + 2
+        self._power = np.zeros(self.mic_grid.size, dtype=np.float64)
+        self._filters = {}
+        self._peak_signal = None
+
+        self.window = np.hanning(window_samples)
+        self.norm = 2.0 / (window_samples * np.dot(self.window, self.window))
+        self.freqs = np.fft.rfftfreq(window_samples, 1.0 / self.sample_freq)
+
+        # Compiled here (or loaded from numba's cache), not on the first map
+        samples = np.zeros((window_samples + self.delay_margin, mic_array.num_mics), dtype=np.float32)
+        delay_and_sum_power(samples, self.delay_index, self.delay_fraction, window_samples, self._power)
+        delay_and_sum_signal(samples, self.delay_index[0], self.delay_fraction[0], window_samples)
+
+    @property
+    def map_shape(self):
+        return self.mic_grid.nxsteps, self.mic_grid.nysteps
+
+    @property
+    def map_axes(self):
+        return (np.linspace(self.mic_grid.x_min, self.mic_grid.x_max, self.mic_grid.nxsteps),
+                np.linspace(self.mic_grid.y_min, self.mic_grid.y_max, self.mic_grid.nysteps))
+
+    def _get_filter(self, frequency, bandwidth):
+        # Bandwidth in bands per octave like the frequency-domain beamformer. A single bin has no meaning
+        # for a window this short, bandwidth 0 falls back to third octaves
+        key = (frequency, bandwidth)
+        if key not in self._filters:
+            bands_per_octave = bandwidth if bandwidth > 0 else 3
+            low = frequency * 2.0 ** (-0.5 / bands_per_octave)
+            high = min(frequency * 2.0 ** (0.5 / bands_per_octave), 0.45 * self.sample_freq)
+            sos = butter(self.filter_order, [low, high], btype="bandpass", fs=self.sample_freq, output="sos")
+            # Enough lead-in for the filter to settle before the window starts
+            warmup = int(np.ceil(4 * self.sample_freq / low))
+            self._filters[key] = (sos, warmup)
+        return self._filters[key]
+
+    def get_current_map(self, threshold, frequency=1000, bandwidth=1):
+        try:
+            sos, warmup = self._get_filter(frequency, bandwidth)
+            length = self.window_samples + self.delay_margin
+            if self.mch_generator.sample_index < warmup + length:
+                return np.zeros(self.map_shape)
+            raw = self.mch_generator.latest(warmup + length).astype(np.float32)
+            samples = np.ascontiguousarray(sosfilt(sos, raw, axis=0)[warmup:], dtype=np.float32)
+
+            delay_and_sum_power(samples, self.delay_index, self.delay_fraction, self.window_samples, self._power)
+            # The unfiltered output towards the strongest point gives the band levels
+            peak = int(np.argmax(self._power))
+            self._peak_signal = delay_and_sum_signal(
+                raw[warmup:], self.delay_index[peak], self.delay_fraction[peak], self.window_samples
+            )
+
+            bf_map = self._power.reshape(self.map_shape).copy()
+            bf_map[bf_map < threshold] = 0
+            return bf_map
+
+        except Exception as e:
+            print(f"Beamformer error: {e}")
+            return np.zeros(self.map_shape)
+
+    def get_band_levels(self, bandwidth=1):
+        if self._peak_signal is None:
+            # Until the first window is filled. L_p wants an array, newer acoular releases reject plain floats
+            silence = float(L_p(np.zeros(1))[0])
+            return {**{str(frequency): silence for frequency in self.band_frequencies}, "broadband": silence}
+        spectrum = np.fft.rfft(self._peak_signal * self.window)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * self.norm
+        levels = {
+            str(frequency): float(L_p(power[get_band_indices(self.freqs, frequency, bandwidth)].sum()))
+            for frequency in self.band_frequencies
+        }
+        levels["broadband"] = float(L_p(power.sum()))
+        return levels
@@ -0,0 +1,71 @@
+import collections
+import time
+import tkinter as tk
+import numpy as np
+import cv2
+from PIL import Image, ImageTk
+
+class DisplayRenderer:
+    def __init__(self, parent, width, height, framerate, stats_window=1.0):
+        # One PhotoImage for the whole run, every frame is pasted into it. A plain Tk label shows it,
+        # CTkImage would create and rescale a new image per frame
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        self.stats_window = stats_window
+
+        self.photo = ImageTk.PhotoImage("RGB", (width, height))
+        self.label = tk.Label(parent, image=self.photo, bg="black", borderwidth=0, highlightthickness=0)
+        self._resized = np.empty((height, width, 3), dtype=np.uint8)
+
+        self.last_sequence = None
+        self.last_capture_time = None
+        self.frames_rendered = 0
+        self.frames_skipped = 0
+        self._render_times = collections.deque()
+        self._latencies = collections.deque()
+
+    def render(self, frame, capture_time, sequence=None):
+        if sequence is not None and self.last_sequence is not None and sequence - self.last_sequence > 1:
+            # The display fell behind the camera, the frames in between were never shown
+            self.frames_skipped += sequence - self.last_sequence - 1
+        self.last_sequence = sequence
+        self.last_capture_time = capture_time
+
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            cv2.resize(frame, (self.width, self.height), dst=self._resized, interpolation=cv2.INTER_LINEAR)
+            frame = self._resized
+        self.photo.paste(Image.fromarray(frame))
+
+        now = time.monotonic()
+        self.frames_rendered += 1
+        self._render_times.append(now)
+        self._latencies.append(now - capture_time)
+        while self._render_times and now - self._render_times[0] > self.stats_window:
+            self._render_times.popleft()
+            self._latencies.popleft()
+
+    def next_delay_ms(self, poll_ms=5):
+        # Wake up right after the next frame is due on the capture clock, poll briefly if it is late
+        if self.last_capture_time is None:
+            return poll_ms
+        due = self.last_capture_time + 1.0 / self.framerate - time.monotonic()
+        return max(poll_ms, int(due * 1000) + 2)
+
+    @property
+    def fps(self):
+        if len(self._render_times) < 2:
+            return 0.0
+        return (len(self._render_times) - 1) / (self._render_times[-1] - self._render_times[0])
+
+    @property
+    def latency(self):
+        return float(np.mean(self._latencies)) if self._latencies else None
+
+    def get_stats(self):
+        return {
+            "fps": self.fps,
+            "latency": self.latency,
+            "frames_rendered": self.frames_rendered,
+            "frames_skipped": self.frames_skipped,
+        }
@@ -10,8 +10,7 @@ class SettingsWindow(ctk.CTkToplevel):
         self.changed_settings = {
             "frequency": settings.get("frequency"),
             "sound_threshold": settings.get("sound_threshold"),
-            "bandwidth": settings.get("bandwidth"),
-            "event_sound_threshold": settings.get("event_sound_threshold")
+            "bandwidth": settings.get("bandwidth")
         }
         self.settings = settings
         
@@ -19,7 +18,6 @@ class SettingsWindow(ctk.CTkToplevel):
         self.options_config = {
             "frequency": ["250", "500", "1000", "2000", "4000"],
             "sound_threshold": ["0.5", "1.0", "2.0", "5.0", "10.0"],
-            "event_sound_threshold": ["0.5", "1.0", "2.0", "5.0", "10.0"],
             "bandwidth": ["0", "1", "2", "3"]
         }
 
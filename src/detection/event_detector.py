@@ -0,0 +1,205 @@
+import threading
+import time
+import numpy as np
+from utils.metrics import metrics
+
+class DetectionEvent:
+    def __init__(self, kind, sample_index, timestamp, detectors, values):
+        # kind is "start" or "end", timestamp is the capture time (time.monotonic()) of the block
+        self.kind = kind
+        self.sample_index = sample_index
+        self.timestamp = timestamp
+        self.detectors = detectors
+        self.values = values
+
+class BandEnergyDetector:
+    def __init__(self, low_freq, high_freq, on_level=-40.0, off_level=None, name="band_energy"):
+        # Energy between low_freq and high_freq in dBFS
+        self.name = name
+        self.low_freq = low_freq
+        self.high_freq = high_freq
+        self.on_threshold = on_level
+        self.off_threshold = on_level - 3.0 if off_level is None else off_level
+        self._band = slice(0, 0)
+
+    def prepare(self, freqs, block_duration):
+        self._band = slice(np.searchsorted(freqs, self.low_freq), np.searchsorted(freqs, self.high_freq, side="right"))
+
+    def measure(self, power, level, active):
+        return 10 * np.log10(power[self._band].sum() + 1e-20)
+
+class SpectralFluxDetector:
+    def __init__(self, on_flux=6.0, off_flux=None, low_freq=0.0, high_freq=None, name="spectral_flux"):
+        # Mean positive change of the log spectrum between consecutive blocks, in dB. Reacts to onsets
+        # (impulsive sounds) and ignores steady noise no matter how loud it is
+        self.name = name
+        self.low_freq = low_freq
+        self.high_freq = high_freq
+        self.on_threshold = on_flux
+        self.off_threshold = on_flux / 2 if off_flux is None else off_flux
+        self._band = slice(0, 0)
+        self._previous = None
+
+    def prepare(self, freqs, block_duration):
+        high_freq = freqs[-1] if self.high_freq is None else self.high_freq
+        self._band = slice(np.searchsorted(freqs, self.low_freq), np.searchsorted(freqs, high_freq, side="right"))
+        self._previous = None
+
+    def measure(self, power, level, active):
+        spectrum_db = 10 * np.log10(power[self._band] + 1e-20)
+        previous, self._previous = self._previous, spectrum_db
+        if previous is None:
+            return 0.0
+        return float(np.maximum(spectrum_db - previous, 0).mean())
+
+class NoiseFloorDetector:
+    def __init__(self, margin_db=12.0, release_margin_db=None, rise_seconds=10.0, active_rise_seconds=60.0,
+                 fall_seconds=0.5, name="noise_floor"):
+        # Broadband level above an adaptive noise floor. The floor follows quiet periods quickly and rises
+        # slowly, even slower during an event, so a new steady noise becomes the floor instead of an endless event
+        self.name = name
+        self.on_threshold = margin_db
+        self.off_threshold = margin_db / 2 if release_margin_db is None else release_margin_db
+        self.rise_seconds = rise_seconds
+        self.active_rise_seconds = active_rise_seconds
+        self.fall_seconds = fall_seconds
+        self.noise_floor = None
+        self._rise_alpha = 0.0
+        self._active_rise_alpha = 0.0
+        self._fall_alpha = 1.0
+
+    def prepare(self, freqs, block_duration):
+        self._rise_alpha = min(1.0, block_duration / self.rise_seconds)
+        self._active_rise_alpha = min(1.0, block_duration / self.active_rise_seconds)
+        self._fall_alpha = min(1.0, block_duration / self.fall_seconds)
+        self.noise_floor = None
+
+    def measure(self, power, level, active):
+        if self.noise_floor is None:
+            self.noise_floor = level
+        excess = level - self.noise_floor
+        if excess <= 0:
+            alpha = self._fall_alpha
+        else:
+            alpha = self._active_rise_alpha if active else self._rise_alpha
+        self.noise_floor += alpha * excess
+        return excess
+
+class EventDetector:
+    def __init__(self, source, detectors, attack_blocks=1, release_blocks=10, channels=None):
+        # Runs on every capture block (block listener), one small FFT per block instead of a beamforming pass.
+        # A detector becomes active after attack_blocks blocks above its on threshold and inactive after
+        # release_blocks blocks below its off threshold. An event lasts while any detector is active.
+        self.source = source
+        self.detectors = list(detectors)
+        self.attack_blocks = attack_blocks
+        self.release_blocks = release_blocks
+        self.channels = None if channels is None else np.asarray(channels)
+
+        self.block_size = source.block_size
+        self.sample_freq = float(source.sample_freq)
+        self.window = np.hanning(self.block_size).astype(np.float32)
+        self.norm = 2.0 / (self.block_size * np.dot(self.window, self.window))
+        self.freqs = np.fft.rfftfreq(self.block_size, 1.0 / self.sample_freq)
+        self.full_scale = float(np.iinfo(source.precision).max) if np.issubdtype(np.dtype(source.precision), np.integer) else 1.0
+        for detector in self.detectors:
+            detector.prepare(self.freqs, self.block_size / self.sample_freq)
+
+        self._active = [False] * len(self.detectors)
+        self._above = [0] * len(self.detectors)
+        self._below = [0] * len(self.detectors)
+        self.active = False
+        self.latest_values = {}
+        self.latest_level = None
+
+        self._listeners = []
+        self._lock = threading.Lock()
+        self.block_count = 0
+        self.event_count = 0
+        self.processing_time = 0.0
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.source.add_block_listener(self.push_block, with_index=True)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.source.remove_block_listener(self.push_block)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def push_block(self, block, sample_index=None):
+        start_time = time.perf_counter()
+        if self.channels is not None:
+            block = block[:, self.channels]
+        samples = block.astype(np.float32) * (1.0 / self.full_scale)
+
+        # Channel-averaged power spectrum and broadband level, both relative to full scale
+        spectrum = np.fft.rfft(samples * self.window[:, np.newaxis], axis=0)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=1) * self.norm
+        level = 10 * np.log10(np.mean(samples * samples) + 1e-20)
+
+        values = {}
+        for i, detector in enumerate(self.detectors):
+            value = detector.measure(power, level, self._active[i])
+            values[detector.name] = value
+            self._update_state(i, detector, value)
+
+        with self._lock:
+            self.latest_values = values
+            self.latest_level = level
+            self.block_count += 1
+            self.processing_time += time.perf_counter() - start_time
+        metrics.observe("detector", time.perf_counter() - start_time)
+
+        active = any(self._active)
+        if active != self.active:
+            self.active = active
+            if active:
+                self.event_count += 1
+            self._emit("start" if active else "end", sample_index, values)
+
+    def _update_state(self, i, detector, value):
+        if not self._active[i]:
+            self._above[i] = self._above[i] + 1 if value > detector.on_threshold else 0
+            if self._above[i] >= self.attack_blocks:
+                self._active[i] = True
+                self._below[i] = 0
+        else:
+            self._below[i] = self._below[i] + 1 if value < detector.off_threshold else 0
+            if self._below[i] >= self.release_blocks:
+                self._active[i] = False
+                self._above[i] = 0
+
+    def _emit(self, kind, sample_index, values):
+        timestamp = None
+        if sample_index is not None:
+            timestamp = self.source.sample_time(sample_index)
+        if timestamp is None:
+            timestamp = time.monotonic()
+        active_detectors = [detector.name for detector, active in zip(self.detectors, self._active) if active]
+        event = DetectionEvent(kind, sample_index, timestamp, active_detectors, values)
+        for listener in list(self._listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"[EventDetector listener error] {e}")
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "active": self.active,
+                "block_count": self.block_count,
+                "event_count": self.event_count,
+                "level": self.latest_level,
+                "values": dict(self.latest_values),
+                "average_block_time": self.processing_time / self.block_count if self.block_count else None,
+            }
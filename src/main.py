@@ -1,10 +1,6 @@
-from beamformer_map import BeamformerMap
-from utils.helper_service import HelperService
-import subprocess
+from beamformer_map import BeamformerMap, create_beamformer
 import cv2
 import time
-import os
-import signal
 import customtkinter as ctk
 from PIL import Image
 import json
@@ -12,11 +8,22 @@ from components.settings_window import SettingsWindow
 import threading
 from webrtc_tracks import OpenCVVideoStreamTrack
 import asyncio
-from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer, RTCIceCandidate
 import websockets
 from recorders.video_event_recorder import VideoEventRecorder
+from detection.event_detector import EventDetector, NoiseFloorDetector, SpectralFluxDetector
 from background_map_calculator import BackgroundMapCalculator
+from process_map_calculator import ProcessMapCalculator
 from user_settings import UserSettings
+from utils.map_colorizer import MapColorizer
+from beamforming.source_tracking import SourceTracker
+from video.frame_source import create_frame_source
+from components.display_renderer import DisplayRenderer
+from utils.metrics import metrics, MetricsServer, JsonMetricsLogger
+from streaming.shared_encoder import SharedVideoEncoder
+from streaming.session_manager import WebRTCSessionManager
+from streaming.map_channel import MapChannelBroadcaster
+
+DEFAULT_SESSION_ID = "default"
 
 class SonicSenseApp:
     def __init__(self, root):
@@ -31,71 +38,112 @@ class SonicSenseApp:
         self.signaling_url = "wss://sonic-sense-signaling.gonemesis.org"
         self.backend_url = "https://sonic-sense-backend.gonemesis.org"
         self.backend_api_key = ""
+        self.max_viewers = 4
+        # "overlay" burns the map into the streamed video, "datachannel" streams clean video and sends
+        # the raw map over a WebRTC data channel, so viewers draw (and toggle) it themselves
+        self.webrtc_map_mode = "overlay"
+        self.map_broadcaster = MapChannelBroadcaster() if self.webrtc_map_mode == "datachannel" else None
+        # "picamera2", "opencv" (device=...), "file" (path=...) or "synthetic"
+        self.frame_source_config = dict(kind="picamera2")
+        # "process" moves beamforming to its own core, "thread" keeps it in the GUI process
+        self.map_calculator_mode = "thread"
+        self.event_buffer_seconds = 2
+        self.event_post_seconds = 10
+        self.event_max_post_seconds = 20
+        # Per-stage timings and counters on http://127.0.0.1:<port>/metrics, json_log_path adds a rotating JSON log
+        self.metrics_config = dict(enabled=False, port=9108, json_log_path=None)
+        # method "frequency" beamforms the averaged CSM of the selected band, "time_domain" runs delay-and-sum
+        # on the newest few milliseconds of audio and shows impulsive sounds (knocks, bangs) with less delay
+        # search_mode="tracked" (frequency method) beamforms fine windows around the tracked sources every map
+        # and the whole FOV only every full_refresh_interval maps
+        self.beamformer_config = dict(horizonatal_fov=66, vertical_fov=41, z=0.5, increment=0.05, method="frequency")
+        self.map_trigger_samples = 1024 if self.beamformer_config["method"] == "time_domain" else 4096
+        # Up to max_sources peaks per map, min_separation and max_distance (a track's jump between maps) in meters
+        self.source_tracker_config = dict(max_sources=5, min_separation=0.05, max_distance=0.08)
         self.set_root_attributes()
-
-        HelperService.ensure_v4l2loopback_device_exists()
+        self.start_metrics()
 
         # GUI elements
-        self.video_label = ctk.CTkLabel(root, text="")
+        self.display_renderer = DisplayRenderer(root, self.displayed_frame_width, self.displayed_frame_height, self.framerate)
+        self.video_label = self.display_renderer.label
         self.video_label.pack(fill=ctk.BOTH, expand=True)
         self.settings_window = None
         self.settings_button = self.create_settings_button()
         self.settings_button.place(relx=0.98, rely=0.95, anchor="se")
 
         self.update_count = 1
+        self.last_map_generation = None
 
         self.max_value_label = ctk.CTkLabel(self.root, text="Max: N/A", font=ctk.CTkFont(size=20))
         self.max_value_label.place(relx=0.96, rely=0.02, anchor="ne")
 
         self.fps_label = ctk.CTkLabel(self.root, text=f"FPS: N/A", font=ctk.CTkFont(size=20))
         self.fps_label.place(relx=0.96, rely=0.06, anchor="ne")
-        self.fps_duration = 0
 
         self.frequency_label = ctk.CTkLabel(self.root, text=f"Freq: {int(self.settings.get('frequency'))} Hz", font=ctk.CTkFont(size=20))
         self.frequency_label.place(relx=0.01, rely=0.02, anchor="nw")
 
-        pipeline_cmd = (
-            f"libcamera-vid -t 0 --width 4608 --height 2592 --framerate {self.framerate} "
-            f"--codec yuv420 --nopreview -o - | "
-            f"ffmpeg -hide_banner -loglevel warning -f rawvideo -pix_fmt yuv420p -s 4608x2592 -i - "
-            f"-vf scale={self.frame_width}:{self.frame_height} "
-            f"-f v4l2 /dev/video10"
-        )
-
-        self.pipeline_process = subprocess.Popen(
-            pipeline_cmd,
-            shell=True,
-            preexec_fn=os.setsid,
-            stdout=subprocess.DEVNULL
+        # Frames come straight from the camera at display resolution, timestamped on the monotonic clock
+        self.frame_source = create_frame_source(
+            self.frame_source_config["kind"], self.frame_width, self.frame_height, self.framerate,
+            **{key: value for key, value in self.frame_source_config.items() if key != "kind"}
         )
-
-        # Camera warm-up time
-        time.sleep(2)
-
-        self.video_capture = cv2.VideoCapture("/dev/video10", cv2.CAP_V4L2)
-        self.video_capture.set(cv2.CAP_PROP_FPS, self.framerate)
-        if not self.video_capture.isOpened():
-            print("❌ Could not open /dev/video10")
+        try:
+            self.frame_source.start()
+        except RuntimeError as e:
+            print(f"❌ Could not start frame source: {e}")
             self.cleanup()
             exit()
 
-        self.beamformer = BeamformerMap(horizonatal_fov=66, vertical_fov=41, z=0.5, increment=0.05)
+        # The capture buffer keeps a whole event clip (pre-roll, post-roll and some headroom) of audio
+        self.mch_generator = BeamformerMap.create_samples_generator(
+            shared_memory=self.map_calculator_mode == "process",
+            buffer_seconds=self.event_buffer_seconds + self.event_max_post_seconds + 3
+        )
+        # Events are detected on every audio block, far cheaper than a beamforming pass
+        self.event_detector = EventDetector(
+            self.mch_generator,
+            [NoiseFloorDetector(margin_db=12.0), SpectralFluxDetector(on_flux=6.0, low_freq=200.0)],
+            attack_blocks=1,
+            release_blocks=10
+        )
         self.event_recorder = VideoEventRecorder(
             resolution=(self.frame_width, self.frame_height),
             backend_url=self.backend_url,
             api_key=self.backend_api_key,
-            sound_generator=self.beamformer.mch_generator,
-        )
-        self.background_map_calculator = BackgroundMapCalculator(
-            beamformer=self.beamformer,
-            user_settings=self.settings,
-            frame_width=self.frame_width,
-            frame_height=self.frame_height,
-            update_interval=0.1
+            sound_generator=self.mch_generator,
+            buffer_seconds=self.event_buffer_seconds,
+            post_seconds=self.event_post_seconds,
+            max_post_seconds=self.event_max_post_seconds,
+            event_detector=self.event_detector,
         )
+        self.event_detector.start()
+        if self.map_calculator_mode == "process":
+            self.background_map_calculator = ProcessMapCalculator(
+                beamformer_config=self.beamformer_config,
+                samples_generator=self.mch_generator,
+                user_settings=self.settings,
+                frame_width=self.frame_width,
+                frame_height=self.frame_height,
+                update_interval=0.1,
+                trigger_samples=self.map_trigger_samples,
+                source_tracker_config=self.source_tracker_config
+            )
+        else:
+            self.beamformer = create_beamformer(self.beamformer_config, samples_generator=self.mch_generator)
+            self.background_map_calculator = BackgroundMapCalculator(
+                beamformer=self.beamformer,
+                user_settings=self.settings,
+                frame_width=self.frame_width,
+                frame_height=self.frame_height,
+                update_interval=0.1,
+                trigger_samples=self.map_trigger_samples,
+                source_tracker=SourceTracker(**self.source_tracker_config)
+            )
         self.background_map_calculator.start()
+        self.map_colorizer = MapColorizer(self.frame_width, self.frame_height)
 
-        self.webrtc_track = OpenCVVideoStreamTrack(self)
+        self.webrtc_track = OpenCVVideoStreamTrack(framerate=self.framerate)
         self.update_frame()
         threading.Thread(target=self.start_webrtc_loop, daemon=True).start()
 
@@ -124,42 +172,108 @@ class SonicSenseApp:
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def update_frame(self):
-        start_time = time.time()
-        ret, frame = self.video_capture.read()
-        if ret:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            bf_map, bf_map_unnormalized, bf_color, db_values = self.background_map_calculator.get_latest_map()
-            if bf_map is not None and bf_color is not None:
-                frame = cv2.addWeighted(frame, 0.7, bf_color, 0.3, 0)
-                if(self.update_count % 3 == 0):
-                    self.update_max_value_label(db_values)
-
-            image = Image.fromarray(frame)
-            ctk_image = ctk.CTkImage(light_image=image, size=(self.displayed_frame_width, self.displayed_frame_height))
-
-            self.video_label.configure(image=ctk_image, text="")
-            self.video_label.image = ctk_image
+        frame, capture_time = self.frame_source.read()
+        if frame is not None:
+            loop_start = time.perf_counter()
+            map_snapshot = self.background_map_calculator.get_latest_snapshot()
+            stream_frame = frame
+            if map_snapshot is not None:
+                if self.map_broadcaster is not None:
+                    # Viewers get the clean frame, the overlay is only blended into a copy for the display
+                    stream_frame = frame.copy()
+                    stream_frame.flags.writeable = False
+                with metrics.timer("blend"):
+                    frame = self.map_colorizer.blend(frame, map_snapshot.bf_color, map_snapshot.bf_map)
+                    frame = self.map_colorizer.draw_sources(frame, map_snapshot.sources)
+                if map_snapshot.generation != self.last_map_generation:
+                    self.last_map_generation = map_snapshot.generation
+                    self.update_max_value_label(map_snapshot.db_values, map_snapshot.sources)
+                    if self.map_broadcaster is not None:
+                        self.map_broadcaster.publish(map_snapshot)
+
+            # The composed frame is shared by reference with the stream and the recorder
+            frame.flags.writeable = False
+
+            with metrics.timer("display"):
+                self.display_renderer.render(frame, capture_time, self.frame_source.sequence)
 
             if hasattr(self, 'webrtc_track'):
-                self.webrtc_track.frame = frame.copy()
-            self.event_recorder.update(frame, bf_map_unnormalized, event_threshold=self.settings.get("event_sound_threshold"))
+                self.webrtc_track.push_frame(stream_frame, capture_time)
+            # Events come from the block-rate detector, the recorder's map threshold is not used
+            self.event_recorder.update(frame, map_snapshot, timestamp=capture_time)
 
-            self.fps_duration += (time.time() - start_time) + 0.06
+            # Displayed frames per second and capture-to-display latency, measured over the last second
             if self.update_count % 10 == 0:
-                fps = 10 / self.fps_duration
-                self.fps_duration = 0
-                self.fps_label.configure(text=f"FPS: {fps:.2f}")
+                latency = self.display_renderer.latency
+                latency_text = f" | {latency * 1000:.0f} ms" if latency is not None else ""
+                self.fps_label.configure(text=f"FPS: {self.display_renderer.fps:.2f}{latency_text}")
                 self.frequency_label.configure(text=f"Freq: {int(self.settings.get('frequency'))} Hz")
-            
-        self.update_count += 1
-        self.root.after(60, self.update_frame)
+            self.update_count += 1
+            metrics.observe("frame_loop", time.perf_counter() - loop_start)
+
+        self.root.after(self.display_renderer.next_delay_ms(), self.update_frame)
+
+    def start_metrics(self):
+        self.metrics_server = None
+        self.metrics_logger = None
+        if not self.metrics_config["enabled"]:
+            return
+        metrics.enable()
+        metrics.register_collector(self.collect_metrics)
+        self.metrics_server = MetricsServer(metrics, port=self.metrics_config["port"])
+        self.metrics_server.start()
+        if self.metrics_config["json_log_path"]:
+            self.metrics_logger = JsonMetricsLogger(metrics, self.metrics_config["json_log_path"])
+            self.metrics_logger.start()
+
+    def collect_metrics(self):
+        # Only runs when metrics are scraped or logged
+        values = {}
+        components = (
+            ("audio", "mch_generator"),
+            ("recorder", "event_recorder"),
+            ("detector", "event_detector"),
+            ("display", "display_renderer"),
+            ("webrtc_track", "webrtc_track"),
+            ("webrtc_encoder", "video_encoder"),
+            ("webrtc_map", "map_broadcaster"),
+            ("webrtc_peer", "session_manager"),
+        )
+        for prefix, attribute in components:
+            component = getattr(self, attribute, None)
+            if component is not None:
+                values.update({f"{prefix}_{key}": value for key, value in component.get_stats().items()})
+
+        if hasattr(self, 'frame_source'):
+            values["camera_frames"] = self.frame_source.frame_count
+            values["camera_failed_reads"] = self.frame_source.failed_reads
+        calculator = getattr(self, 'background_map_calculator', None)
+        if calculator is not None:
+            values["map_skipped_updates"] = getattr(calculator, "skipped_updates", 0)
+            snapshot = calculator.snapshot
+            if snapshot is not None:
+                values["map_generation"] = snapshot.generation
+                values["map_age_seconds"] = time.monotonic() - snapshot.timestamp
+                if snapshot.latency is not None:
+                    values["map_latency_seconds"] = snapshot.latency
+        return values
 
     def open_settings_window(self):
         self.settings_window = SettingsWindow(self.root, self.settings)
         self.settings_window.after(300, lambda: self.settings_window.wm_attributes('-fullscreen', 'true'))
 
-    def update_max_value_label(self, bf_map_unnormalized):
+    def update_max_value_label(self, bf_map_unnormalized, sources=()):
+        # Tracked sources come strongest first, without any the global maximum of the map is shown
+        if sources:
+            strongest = sources[0]
+            max_val = max(0.0, strongest["level"] - 20.0)
+            scaled_x = int(strongest["u"] * self.displayed_frame_width)
+            scaled_y = int(strongest["v"] * self.displayed_frame_height)
+            self.max_value_label.configure(
+                text=f"Max: {max_val:.2f} dB @ ({scaled_x}, {scaled_y}) | Sources: {len(sources)}"
+            )
+            return
+
         max_loc = cv2.minMaxLoc(bf_map_unnormalized)[3]
         max_val = bf_map_unnormalized[max_loc[1], max_loc[0]]
         map_h, map_w = bf_map_unnormalized.shape
@@ -179,28 +293,37 @@ class SonicSenseApp:
 
     def cleanup(self):
         print("Cleaning up...")
-        self.background_map_calculator.stop()
-        if self.video_capture:
-            self.video_capture.release()
-        os.killpg(os.getpgid(self.pipeline_process.pid), signal.SIGTERM)
+        if self.metrics_logger is not None:
+            self.metrics_logger.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if hasattr(self, 'event_detector'):
+            self.event_detector.stop()
+        if hasattr(self, 'event_recorder'):
+            self.event_recorder.stop()
+        if hasattr(self, 'background_map_calculator'):
+            self.background_map_calculator.stop()
+        if hasattr(self, 'mch_generator'):
+            self.mch_generator.stop()
+        self.frame_source.stop()
 
     def start_webrtc_loop(self):
         asyncio.run(self.run_webrtc())
 
     async def run_webrtc(self):
-        self.pc = self.create_peer_connection()
+        # Every viewer gets its own peer connection, the video is encoded once for all of them
+        self.video_encoder = SharedVideoEncoder(self.webrtc_track, framerate=self.framerate)
+        self.session_manager = WebRTCSessionManager(
+            self.video_encoder, source_track=self.webrtc_track, max_sessions=self.max_viewers,
+            map_broadcaster=self.map_broadcaster
+        )
+        if self.map_broadcaster is not None:
+            self.map_broadcaster.attach_loop(asyncio.get_running_loop())
 
         async with websockets.connect(self.signaling_url) as websocket:
             print(f"\n---- CONNECTED TO SIGNALING SERVER -----\n")
 
-            offer = await self.pc.createOffer()
-            await self.pc.setLocalDescription(offer)
-
-            await websocket.send(json.dumps({
-                "type": "offer",
-                "sdp": self.pc.localDescription.sdp,
-                "sdpType": self.pc.localDescription.type
-            }))
+            await self.send_offer(websocket, DEFAULT_SESSION_ID)
 
             async for message in websocket:
                 try:
@@ -209,59 +332,36 @@ class SonicSenseApp:
                 except Exception as e:
                     print(f"Error processing message: {e}")
 
+    async def send_offer(self, websocket, session_id):
+        description = await self.session_manager.create_offer(session_id)
+        if description is None:
+            await websocket.send(json.dumps({"type": "session-rejected", "sessionId": session_id}))
+            return
+        await websocket.send(json.dumps({
+            "type": "offer",
+            "sdp": description.sdp,
+            "sdpType": description.type,
+            "sessionId": session_id
+        }))
+
     async def handle_rtc_message(self, data, websocket):
+        # Messages without a session ID belong to the single viewer of older signaling servers
+        session_id = data.get("sessionId", DEFAULT_SESSION_ID)
+
         if data["type"] == "answer":
-            print(f"\n---- RECEIVED SDP ANSWER -----\n")
-            answer = RTCSessionDescription(sdp=data["sdp"], type=data["type"])
-            await self.pc.setRemoteDescription(answer)
+            print(f"\n---- RECEIVED SDP ANSWER ({session_id}) -----\n")
+            await self.session_manager.handle_answer(session_id, data["sdp"], data["type"])
 
         elif data["type"] == "request-offer":
-            print(f"\n---- RECEIVED OFFER REQUEST -----\n")
-            await self.pc.close()
-            self.pc = self.create_peer_connection()
-            offer = await self.pc.createOffer()
-            await self.pc.setLocalDescription(offer)
-            await websocket.send(json.dumps({
-                "type": "offer",
-                "sdp": self.pc.localDescription.sdp,
-                "sdpType": self.pc.localDescription.type
-            }))
+            print(f"\n---- RECEIVED OFFER REQUEST ({session_id}) -----\n")
+            await self.send_offer(websocket, session_id)
 
         elif data["type"] == "candidate":
-            candidate_dict = data["candidate"]
-            candidate = self.dict_to_candidate(candidate_dict)
-            if candidate.ip:
-                print(f"\n---- RECEIVED CANDIDATE -----\n")
-                await self.pc.addIceCandidate(candidate)
-                print(data)
-
-    def dict_to_candidate(self, data):
-        return RTCIceCandidate(
-            component=data["component"],
-            foundation=data["foundation"],
-            ip=data["ip"],
-            port=data["port"],
-            priority=data["priority"],
-            protocol=data["protocol"],
-            type=data["type"],
-            relatedAddress=data.get("relatedAddress"),
-            relatedPort=data.get("relatedPort"),
-            sdpMid=data["sdpMid"],      
-            sdpMLineIndex=data["sdpMLineIndex"],
-            tcpType=data.get("tcpType"),
-        )
-    
-    def create_peer_connection(self):
-        config = RTCConfiguration([
-            RTCIceServer(urls=["stun:stun.l.google.com:19302"]),
-            RTCIceServer(urls=["stun:stun1.l.google.com:19302"]),
-            RTCIceServer(urls=["stun:stun2.l.google.com:19302"]),
-            RTCIceServer(urls=["stun:stun3.l.google.com:19302"]),
-            RTCIceServer(urls=["stun:stun4.l.google.com:19302"]),
-        ])
-        pc = RTCPeerConnection(configuration=config)
-        pc.addTrack(self.webrtc_track)
-        return pc
+            await self.session_manager.add_candidate(session_id, data["candidate"])
+
+        elif data["type"] == "leave":
+            print(f"\n---- VIEWER LEFT ({session_id}) -----\n")
+            await self.session_manager.close_session(session_id)
 
 if __name__ == "__main__":
     root = ctk.CTk()
@@ -0,0 +1,24 @@
+import time
+
+class MapSnapshot:
+    def __init__(self, generation, bf_map, bf_map_unnormalized, bf_color, db_values, band_levels=None, timestamp=None,
+                 sample_index=None, latency=None, sources=None):
+        self.generation = generation
+        self.bf_map = bf_map
+        self.bf_map_unnormalized = bf_map_unnormalized
+        self.bf_color = bf_color
+        self.db_values = db_values
+        self.band_levels = band_levels
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        # Newest captured audio sample the map was computed from and its age when the map was published
+        self.sample_index = sample_index
+        self.latency = latency
+        # Tracked sources, strongest first: dicts with id, x, y (grid meters), level (dB) and u, v (frame fractions)
+        self.sources = tuple(sources) if sources else ()
+
+        # Snapshots are shared between consumers without copying, so they must never change
+        for array in (bf_map, bf_map_unnormalized, bf_color, db_values):
+            array.flags.writeable = False
+
+    def as_tuple(self):
+        return self.bf_map, self.bf_map_unnormalized, self.bf_color, self.db_values
@@ -0,0 +1,305 @@
+import multiprocessing as mp
+import queue
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from map_snapshot import MapSnapshot
+from utils.metrics import metrics
+
+SETTINGS_KEYS = ("sound_threshold", "frequency", "bandwidth")
+INTEGER_SETTINGS = ("frequency", "bandwidth")
+SOURCE_FIELDS = ("id", "x", "y", "level", "u", "v")
+METRICS_FORWARD_INTERVAL = 1.0
+
+class SharedSettingsView:
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, key, default=None):
+        if key not in SETTINGS_KEYS:
+            return default
+        value = self.values[SETTINGS_KEYS.index(key)]
+        return int(value) if key in INTEGER_SETTINGS else value
+
+class SharedMapBuffer:
+    HEADER_SIZE = 4
+
+    def __init__(self, layout, shared_memory_block):
+        # Header holds [sequence, active slot], followed by two slots with every array in layout
+        self.layout = layout
+        self._shared_memory = shared_memory_block
+        self._header = np.ndarray((self.HEADER_SIZE,), dtype=np.int64, buffer=shared_memory_block.buf)
+        self._slots = []
+
+        offset = self._header.nbytes
+        for _ in range(2):
+            slot = {}
+            for name, shape, dtype in layout:
+                array = np.ndarray(shape, dtype=dtype, buffer=shared_memory_block.buf, offset=offset)
+                slot[name] = array
+                offset += array.nbytes
+            self._slots.append(slot)
+
+    @classmethod
+    def _size(cls, layout):
+        slot_size = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in layout)
+        return cls.HEADER_SIZE * 8 + 2 * slot_size
+
+    @classmethod
+    def create(cls, layout):
+        buffer = cls(layout, shared_memory.SharedMemory(create=True, size=cls._size(layout)))
+        buffer._header.fill(0)
+        return buffer
+
+    @classmethod
+    def attach(cls, name, layout):
+        return cls(layout, shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self):
+        return self._shared_memory.name
+
+    @property
+    def sequence(self):
+        return int(self._header[0])
+
+    def publish(self, arrays):
+        sequence = int(self._header[0])
+        slot = 0 if sequence == 0 else 1 - int(self._header[1])
+        for name, array in arrays.items():
+            self._slots[slot][name][...] = array
+        self._header[1] = slot
+        self._header[0] = sequence + 1
+
+    def read(self, retries=3):
+        for _ in range(retries):
+            sequence = int(self._header[0])
+            if sequence == 0:
+                return 0, None
+            slot = int(self._header[1])
+            arrays = {name: array.copy() for name, array in self._slots[slot].items()}
+            # The next publish starts rewriting this slot, the copy is only whole if none happened meanwhile
+            if int(self._header[0]) == sequence:
+                return sequence, arrays
+        return 0, None
+
+    def close(self):
+        self._header = None
+        self._slots = []
+        try:
+            self._shared_memory.close()
+        except BufferError as e:
+            print(f"[SharedMapBuffer] Shared memory still in use: {e}")
+
+    def unlink(self):
+        self._shared_memory.unlink()
+
+def run_map_worker(beamformer_config, ring_info, settings_values, stop_event, ready_queue,
+                   frame_width, frame_height, update_interval, trigger_samples, source_tracker_config=None,
+                   metrics_queue=None):
+    from beamforming.sample_ring import SharedRingSamplesSource
+    from beamforming.source_tracking import SourceTracker
+    from beamformer_map import create_beamformer
+    from background_map_calculator import BackgroundMapCalculator
+
+    # Stage timings of this process are sent to the GUI process, which serves and logs them
+    if metrics_queue is not None:
+        metrics.enable()
+        metrics.forward_observations()
+    next_forward_time = time.monotonic() + METRICS_FORWARD_INTERVAL
+
+    source = SharedRingSamplesSource(**ring_info)
+    beamformer = create_beamformer(beamformer_config, samples_generator=source)
+    source_tracker = SourceTracker(**source_tracker_config) if source_tracker_config is not None else None
+    calculator = BackgroundMapCalculator(
+        beamformer=beamformer,
+        user_settings=SharedSettingsView(settings_values),
+        frame_width=frame_width,
+        frame_height=frame_height,
+        update_interval=update_interval,
+        trigger_samples=trigger_samples,
+        source_tracker=source_tracker
+    )
+
+    band_keys = [str(frequency) for frequency in beamformer.band_frequencies] + ["broadband"]
+    map_shape = tuple(beamformer.map_shape)
+    max_sources = source_tracker.max_sources if source_tracker is not None else 0
+    layout = [
+        ("bf_map", (frame_height, frame_width), "uint8"),
+        ("bf_map_unnormalized", map_shape, "float64"),
+        ("bf_color", (frame_height, frame_width, 3), "uint8"),
+        ("db_values", map_shape, "float64"),
+        ("band_levels", (len(band_keys),), "float64"),
+        ("sources", (max_sources, len(SOURCE_FIELDS)), "float64"),
+        ("map_info", (3,), "float64"),
+    ]
+    output = SharedMapBuffer.create(layout)
+    ready_queue.put((output.name, layout, band_keys))
+
+    def forward_metrics():
+        observations = metrics.take_observations()
+        if observations:
+            try:
+                metrics_queue.put_nowait(observations)
+            except queue.Full:
+                pass
+
+    def publish(result, sample_index, latency):
+        nonlocal next_forward_time
+        bf_map, unnormalized_bf_map, bf_color, db_values, band_levels, sources = result
+        sources = sources[:max_sources]
+        source_rows = np.zeros((max_sources, len(SOURCE_FIELDS)))
+        for row, source in zip(source_rows, sources):
+            row[:] = [source[field] for field in SOURCE_FIELDS]
+        output.publish({
+            "bf_map": bf_map,
+            "bf_map_unnormalized": unnormalized_bf_map,
+            "bf_color": bf_color,
+            "db_values": db_values,
+            "band_levels": [band_levels[key] for key in band_keys],
+            "sources": source_rows,
+            "map_info": [sample_index, np.nan if latency is None else latency, len(sources)],
+        })
+        if metrics_queue is not None:
+            if latency is not None:
+                metrics.observe("map_latency", latency)
+            if time.monotonic() >= next_forward_time:
+                next_forward_time = time.monotonic() + METRICS_FORWARD_INTERVAL
+                forward_metrics()
+
+    try:
+        calculator.run_paced(stop_event.is_set, publish)
+    finally:
+        source.stop()
+        output.close()
+        output.unlink()
+
+class ProcessMapCalculator:
+    def __init__(self, beamformer_config, samples_generator, user_settings, frame_width, frame_height, update_interval=0.5,
+                 trigger_samples=None, source_tracker_config=None):
+        self.beamformer_config = beamformer_config
+        self.samples_generator = samples_generator
+        self.user_settings = user_settings
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.update_interval = update_interval
+        self.trigger_samples = trigger_samples
+        # Keyword arguments of the SourceTracker created in the worker, None disables tracking
+        self.source_tracker_config = source_tracker_config
+
+        self._context = mp.get_context("spawn")
+        self._settings_values = self._context.Array('d', len(SETTINGS_KEYS), lock=False)
+        self._stop_event = self._context.Event()
+        self._ready_queue = self._context.Queue()
+        self._metrics_queue = self._context.Queue(maxsize=16)
+        self._output = None
+        self._band_keys = None
+        self.snapshot = None
+        self.process = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        if self.samples_generator.shared_memory_name is None:
+            raise ValueError("ProcessMapCalculator needs a samples generator created with shared_memory=True")
+
+        self._sync_settings()
+        ring_info = {
+            "shared_memory_name": self.samples_generator.shared_memory_name,
+            "capacity": self.samples_generator.capacity,
+            "num_channels": self.samples_generator.num_channels,
+            "precision": self.samples_generator.precision,
+            "sample_freq": float(self.samples_generator.sample_freq),
+            "block_size": self.samples_generator.block_size,
+        }
+        self._stop_event.clear()
+        self.process = self._context.Process(
+            target=run_map_worker,
+            args=(
+                self.beamformer_config, ring_info, self._settings_values, self._stop_event,
+                self._ready_queue, self.frame_width, self.frame_height, self.update_interval,
+                self.trigger_samples, self.source_tracker_config,
+                self._metrics_queue if metrics.enabled else None
+            ),
+            daemon=True
+        )
+        self.process.start()
+        self.running = True
+
+    def stop(self):
+        self.running = False
+        self._stop_event.set()
+        if self.process is not None:
+            self.process.join(timeout=2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+    def _sync_settings(self):
+        for i, key in enumerate(SETTINGS_KEYS):
+            self._settings_values[i] = float(self.user_settings.get(key))
+
+    def _attach_output(self):
+        if self._output is None:
+            try:
+                name, layout, self._band_keys = self._ready_queue.get_nowait()
+            except queue.Empty:
+                return False
+            self._output = SharedMapBuffer.attach(name, layout)
+        return True
+
+    def _receive_metrics(self):
+        while True:
+            try:
+                observations = self._metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            for stage, values in observations.items():
+                for value in values:
+                    metrics.observe(stage, value)
+
+    def get_latest_snapshot(self):
+        self._sync_settings()
+        if metrics.enabled:
+            self._receive_metrics()
+        if not self._attach_output():
+            return self.snapshot
+
+        # Arrays are only copied out of shared memory when the worker has published a new map
+        if self.snapshot is None or self._output.sequence != self.snapshot.generation:
+            sequence, arrays = self._output.read()
+            if arrays is not None:
+                self.snapshot = MapSnapshot(
+                    sequence,
+                    arrays["bf_map"],
+                    arrays["bf_map_unnormalized"],
+                    arrays["bf_color"],
+                    arrays["db_values"],
+                    dict(zip(self._band_keys, arrays["band_levels"].tolist())),
+                    sample_index=int(arrays["map_info"][0]),
+                    latency=None if np.isnan(arrays["map_info"][1]) else float(arrays["map_info"][1]),
+                    sources=self._read_sources(arrays["sources"], int(arrays["map_info"][2]))
+                )
+        return self.snapshot
+
+    @staticmethod
+    def _read_sources(rows, count):
+        sources = []
+        for row in rows[:count]:
+            source = dict(zip(SOURCE_FIELDS, row.tolist()))
+            source["id"] = int(source["id"])
+            sources.append(source)
+        return sources
+
+    def get_latest_map(self):
+        snapshot = self.get_latest_snapshot()
+        if snapshot is None:
+            return None, None, None, None
+        return snapshot.as_tuple()
+
+    def get_latest_band_levels(self):
+        snapshot = self.snapshot
+        return snapshot.band_levels if snapshot is not None else None
@@ -0,0 +1,70 @@
+from fractions import Fraction
+import av
+import numpy as np
+
+class ClipEncoder:
+    def __init__(self, filename, width, height, audio_rate, frame_rate=15,
+                 video_codec="libx264", preset="fast", crf=23, audio_bitrate=192000):
+        self.audio_rate = audio_rate
+        self.time_base = Fraction(1, 1000)
+        self.container = av.open(filename, mode="w", format="mp4", options={"movflags": "faststart"})
+
+        # Video pts come from the capture timestamps (milliseconds), so the clip keeps the real frame timing
+        self.video_stream = self.container.add_stream(video_codec, rate=frame_rate)
+        self.video_stream.width = width
+        self.video_stream.height = height
+        self.video_stream.pix_fmt = "yuv420p"
+        self.video_stream.options = {"preset": preset, "crf": str(crf)}
+        self.video_stream.codec_context.time_base = self.time_base
+
+        self.audio_stream = self.container.add_stream("aac", rate=audio_rate, layout="stereo")
+        self.audio_stream.bit_rate = audio_bitrate
+
+        self.start_time = None
+        self.last_video_pts = -1
+        self.audio_samples_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_video(self, frame, timestamp):
+        if self.start_time is None:
+            self.start_time = timestamp
+        pts = max(int(round((timestamp - self.start_time) * 1000)), self.last_video_pts + 1)
+        self.last_video_pts = pts
+
+        video_frame = av.VideoFrame.from_ndarray(frame, format="rgb24")
+        video_frame.pts = pts
+        video_frame.time_base = self.time_base
+        for packet in self.video_stream.encode(video_frame):
+            self.container.mux(packet)
+
+    def write_audio(self, samples):
+        if len(samples) == 0:
+            return
+        # Microphone channels are mixed down to a stereo track
+        mono = samples.astype(np.float32).mean(axis=1)
+        stereo = np.repeat(np.clip(mono, -32768, 32767).astype(np.int16), 2)
+
+        audio_frame = av.AudioFrame.from_ndarray(stereo.reshape(1, -1), format="s16", layout="stereo")
+        audio_frame.sample_rate = self.audio_rate
+        audio_frame.pts = self.audio_samples_written
+        audio_frame.time_base = Fraction(1, self.audio_rate)
+        self.audio_samples_written += len(samples)
+        for packet in self.audio_stream.encode(audio_frame):
+            self.container.mux(packet)
+
+    def close(self):
+        if self.container is None:
+            return
+        try:
+            for packet in self.video_stream.encode():
+                self.container.mux(packet)
+            for packet in self.audio_stream.encode():
+                self.container.mux(packet)
+        finally:
+            self.container.close()
+            self.container = None
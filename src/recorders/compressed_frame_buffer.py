@@ -0,0 +1,71 @@
+import collections
+import cv2
+from utils.metrics import metrics
+
+class CompressedFrameBuffer:
+    def __init__(self, max_bytes, max_seconds=None, jpeg_quality=85, drop_oldest=True):
+        # drop_oldest=True behaves like a ring (pre-roll), False keeps the start of the clip
+        # and refuses new frames once the budget is used up (post-roll)
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.jpeg_quality = jpeg_quality
+        self.drop_oldest = drop_oldest
+
+        self._frames = collections.deque()
+        self.total_bytes = 0
+        self.dropped_frames = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def append(self, timestamp, frame):
+        # Channel order is kept as is, imdecode hands back the same layout that was encoded
+        with metrics.timer("frame_compress"):
+            success, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not success:
+            self.dropped_frames += 1
+            return False
+        return self._append_encoded(timestamp, encoded)
+
+    def extend_from(self, other, since=None):
+        # Encoded frames are shared as they are, nothing is decoded or encoded again
+        for timestamp, encoded in list(other._frames):
+            if since is None or timestamp >= since:
+                self._append_encoded(timestamp, encoded)
+
+    def _append_encoded(self, timestamp, encoded):
+        if not self.drop_oldest and self.total_bytes + encoded.nbytes > self.max_bytes:
+            self.dropped_frames += 1
+            return False
+
+        self._frames.append((timestamp, encoded))
+        self.total_bytes += encoded.nbytes
+
+        while self.total_bytes > self.max_bytes and len(self._frames) > 1:
+            self._pop_oldest()
+            self.dropped_frames += 1
+        if self.max_seconds is not None:
+            self.prune(timestamp - self.max_seconds)
+        return True
+
+    def prune(self, cutoff):
+        while self._frames and self._frames[0][0] < cutoff:
+            self._pop_oldest()
+
+    def _pop_oldest(self):
+        _, encoded = self._frames.popleft()
+        self.total_bytes -= encoded.nbytes
+
+    def first_timestamp(self):
+        return self._frames[0][0] if self._frames else None
+
+    def last_timestamp(self):
+        return self._frames[-1][0] if self._frames else None
+
+    def frames(self):
+        for timestamp, encoded in list(self._frames):
+            yield timestamp, cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+
+    def clear(self):
+        self._frames.clear()
+        self.total_bytes = 0
@@ -0,0 +1,231 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from utils.metrics import metrics
+
+class MultipartFileStream:
+    # File-like multipart/form-data body with a known length, read in chunks by http.client
+    def __init__(self, fields, file_field, filepath, content_type="video/mp4"):
+        self.boundary = uuid.uuid4().hex
+        self.filepath = filepath
+
+        preamble = b""
+        for name, value in fields.items():
+            preamble += (
+                f"--{self.boundary}\r\n"
+                f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                f"{value}\r\n"
+            ).encode()
+        preamble += (
+            f"--{self.boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{file_field}\"; filename=\"{os.path.basename(filepath)}\"\r\n"
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        self._parts = [preamble, None, f"\r\n--{self.boundary}--\r\n".encode()]
+        self._length = len(preamble) + os.path.getsize(filepath) + len(self._parts[2])
+        self._part_index = 0
+        self._offset = 0
+        self._file = None
+        self.bytes_read = 0
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        chunks = []
+        while size > 0 and self._part_index < len(self._parts):
+            part = self._parts[self._part_index]
+            if part is None:
+                if self._file is None:
+                    self._file = open(self.filepath, "rb")
+                chunk = self._file.read(size)
+                if not chunk:
+                    self._file.close()
+                    self._part_index += 1
+                    continue
+            else:
+                chunk = part[self._offset:self._offset + size]
+                self._offset += len(chunk)
+                if self._offset >= len(part):
+                    self._part_index += 1
+                    self._offset = 0
+            chunks.append(chunk)
+            size -= len(chunk)
+
+        data = b"".join(chunks)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+class UploadQueue:
+    def __init__(self, backend_url, api_key, spool_dir="spool/events", initial_backoff=2.0, max_backoff=300.0, timeout=60):
+        # Without a backend_url clips are only spooled, they are uploaded once a backend is configured
+        self.upload_url = f"{backend_url}/api/sound-events/upload" if backend_url else None
+        self.api_key = api_key
+        self.spool_dir = spool_dir
+        self.rejected_dir = os.path.join(spool_dir, "rejected")
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._queue = queue.Queue()
+        self._stop_event = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.uploaded_count = 0
+        self.failed_attempts = 0
+        self.rejected_count = 0
+        self.bytes_uploaded = 0
+        self.upload_seconds = 0.0
+        self.last_throughput = None
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._thread = None
+        if self.upload_url is not None:
+            self._load_spool()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _load_spool(self):
+        # Clips that were not accepted before the last shutdown are uploaded first
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if name.endswith(".part"):
+                os.remove(path)
+            elif name.endswith(".mp4"):
+                self._queue.put(path)
+
+    def create_spool_path(self, prefix="event"):
+        return os.path.join(self.spool_dir, f"{prefix}_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}.mp4")
+
+    def enqueue(self, filepath, metadata=None):
+        if metadata:
+            with open(f"{filepath}.json.part", "w") as f:
+                json.dump(metadata, f)
+            os.replace(f"{filepath}.json.part", f"{filepath}.json")
+        if self._thread is not None:
+            self._queue.put(filepath)
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "uploaded_count": self.uploaded_count,
+                "failed_attempts": self.failed_attempts,
+                "rejected_count": self.rejected_count,
+                "bytes_uploaded": self.bytes_uploaded,
+                "average_throughput": self.bytes_uploaded / self.upload_seconds if self.upload_seconds > 0 else None,
+                "last_throughput": self.last_throughput,
+            }
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            # Wakes the worker, spool-only queues have none to wake
+            self._queue.put(None)
+            self._thread.join(timeout=5.0)
+        self.session.close()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            filepath = self._queue.get()
+            if filepath is None:
+                continue
+
+            attempt = 0
+            while not self._stop_event.is_set():
+                result = self._upload(filepath)
+                if result == "uploaded":
+                    self._remove(filepath)
+                    break
+                if result == "rejected":
+                    self._reject(filepath)
+                    break
+
+                # Exponential backoff with jitter, the clip stays spooled on disk meanwhile
+                delay = min(self.max_backoff, self.initial_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                print(f"Upload of {os.path.basename(filepath)} failed, retrying in {delay:.1f}s")
+                self._stop_event.wait(delay)
+
+    def _read_metadata(self, filepath):
+        metadata_path = f"{filepath}.json"
+        if not os.path.exists(metadata_path):
+            return {}
+        try:
+            with open(metadata_path, "r") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Failed to read upload metadata {metadata_path}: {e}")
+            return {}
+
+    def _upload(self, filepath):
+        if not os.path.exists(filepath):
+            return "rejected"
+
+        fields = {key: json.dumps(value) for key, value in self._read_metadata(filepath).items()}
+        body = MultipartFileStream(fields, "video", filepath)
+        headers = {"X-API-KEY": self.api_key, "Content-Type": body.content_type}
+        start_time = time.monotonic()
+        try:
+            response = self.session.post(self.upload_url, data=body, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"Exception during upload: {e}")
+            with self._stats_lock:
+                self.failed_attempts += 1
+            return "retry"
+        finally:
+            body.close()
+
+        elapsed = time.monotonic() - start_time
+        metrics.observe("upload", elapsed)
+        if response.status_code == 200:
+            print("✅ Video uploaded successfully.")
+            with self._stats_lock:
+                self.uploaded_count += 1
+                self.bytes_uploaded += len(body)
+                self.upload_seconds += elapsed
+                self.last_throughput = len(body) / elapsed if elapsed > 0 else None
+            return "uploaded"
+
+        print(f"❌ Upload failed: {response.status_code} - {response.text}")
+        with self._stats_lock:
+            self.failed_attempts += 1
+        # Client errors other than timeouts and rate limiting will not succeed on a retry
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            return "rejected"
+        return "retry"
+
+    def _remove(self, filepath):
+        for path in (filepath, f"{filepath}.json"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _reject(self, filepath):
+        with self._stats_lock:
+            self.rejected_count += 1
+        if not os.path.exists(filepath):
+            return
+        os.makedirs(self.rejected_dir, exist_ok=True)
+        for path in (filepath, f"{filepath}.json"):
+            if os.path.exists(path):
+                os.replace(path, os.path.join(self.rejected_dir, os.path.basename(path)))
@@ -1,222 +1,257 @@
-import collections
+import itertools
 import threading
 import time
-import cv2
 import os
-import requests
 import numpy as np
-import wave
-import subprocess
-import uuid
+from concurrent.futures import ThreadPoolExecutor
+from recorders.clip_encoder import ClipEncoder
+from recorders.compressed_frame_buffer import CompressedFrameBuffer
+from recorders.upload_queue import UploadQueue
+from utils.metrics import metrics
 
 class VideoEventRecorder:
-    def __init__(self, resolution, backend_url, api_key, sound_generator, buffer_seconds=2, post_seconds=10):
+    def __init__(self, resolution, backend_url, api_key, sound_generator, buffer_seconds=2, post_seconds=10,
+                 max_post_seconds=20, pre_roll_max_bytes=16 * 1024 * 1024, post_roll_max_bytes=48 * 1024 * 1024,
+                 jpeg_quality=85, spool_dir="spool/events", encode_workers=2, max_pending_clips=4, event_detector=None):
         self.frame_width, self.frame_height = resolution
         self.backend_url = backend_url
         self.api_key = api_key
         self.sound_generator = sound_generator
         self.buffer_seconds = buffer_seconds
         self.post_seconds = post_seconds
+        self.max_post_seconds = max(post_seconds, max_post_seconds)
+        self.pre_roll_max_bytes = pre_roll_max_bytes
+        self.post_roll_max_bytes = post_roll_max_bytes
+        self.jpeg_quality = jpeg_quality
 
-        self.audio_frequency = sound_generator.sample_freq
-        self.audio_samples_for_buffer = int(47 * self.buffer_seconds)
+        self.audio_frequency = float(sound_generator.sample_freq)
+        required_samples = int((buffer_seconds + self.max_post_seconds + 1) * self.audio_frequency)
+        if sound_generator.capacity < required_samples:
+            print(f"[VideoEventRecorder] Capture buffer holds {sound_generator.capacity} samples, "
+                  f"event clips need {required_samples}, the start of the clip audio will be silent")
 
-        self.pre_event_frames = collections.deque()
-        self.pre_event_audio = collections.deque(maxlen=self.audio_samples_for_buffer)
-        self.post_event_frames = []
-        self.post_event_audio = []
+        # Frames are kept JPEG compressed under a fixed memory budget, independent of the clip length
+        # Audio is not copied while recording, the clip's sample range is read from the capture buffer when it ends
+        self.pre_event_frames = self._create_pre_roll_buffer()
+        self.post_event_frames = self._create_post_roll_buffer()
+
+        # Encoding runs in a bounded worker pool, uploads are spooled to disk and retried
+        self.upload_queue = UploadQueue(backend_url, api_key, spool_dir=spool_dir)
+        self.encode_executor = ThreadPoolExecutor(max_workers=encode_workers)
+        self.clip_slots = threading.BoundedSemaphore(max_pending_clips)
 
         self.lock = threading.Lock()
         self.recording = False
         self.post_start_time = None
-        self.last_event_time = None
-        self.processing_event = False
+        self.post_end_time = None
+        self.event_band_levels = None
+        self.latest_band_levels = None
+        self.event_sources = None
+        self.latest_sources = ()
+        self.last_map_generation = None
+
+        self.event_count = 0
+        self.merged_triggers = 0
+        self.dropped_clips = 0
+
+        # With a block-rate detector, events come from the capture buffer instead of the map threshold
+        self.event_detector = event_detector
+        if event_detector is not None:
+            event_detector.add_listener(self._on_detection_event)
 
-        self.stop_audio_event = threading.Event()
-        self.audio_thread = threading.Thread(target=self._audio_loop, daemon=True)
-        self.audio_thread.start()
+    def _create_pre_roll_buffer(self):
+        return CompressedFrameBuffer(self.pre_roll_max_bytes, max_seconds=self.buffer_seconds, jpeg_quality=self.jpeg_quality)
 
-    def update(self, frame, bf_map, event_threshold=2.0):
+    def _create_post_roll_buffer(self):
+        return CompressedFrameBuffer(self.post_roll_max_bytes, jpeg_quality=self.jpeg_quality, drop_oldest=False)
 
-        now = time.time()
-        if not self.recording:
-            self.pre_event_frames.append((now, frame.copy()))
-            self.prune_old_entries(now)
+    def update(self, frame, map_snapshot, event_threshold=2.0, timestamp=None):
+        # Frames and map snapshots are read-only and kept by reference. Timestamps are time.monotonic(),
+        # the same clock the capture buffer maps sample indices to
+        now = time.monotonic() if timestamp is None else timestamp
 
-        if not self.recording and self.detect_sound_event(bf_map, event_threshold):
-            self.last_event_time = time.time()
-            self.start_post_event_capture()
+        new_map = map_snapshot is not None and map_snapshot.generation != self.last_map_generation
+        if new_map:
+            self.last_map_generation = map_snapshot.generation
+            self.latest_band_levels = map_snapshot.band_levels
+            self.latest_sources = map_snapshot.sources
+            if self.event_detector is None and self.detect_sound_event(map_snapshot.bf_map_unnormalized, event_threshold):
+                self.trigger_event(now, map_snapshot.band_levels, map_snapshot.sources)
+            elif self.recording and map_snapshot.sources:
+                # Sources that show up while the clip is recorded belong to the event as well
+                with self.lock:
+                    if self.recording:
+                        self.event_sources = self._merge_sources(self.event_sources, map_snapshot.sources)
 
         if self.recording:
-            self.post_event_frames.append((now, frame.copy()))
-            if self.post_start_time and (now - self.post_start_time > self.post_seconds): 
-                threading.Thread(target=self._finalize_event, daemon=True).start()
-
-    def _audio_loop(self):
-        while not self.stop_audio_event.is_set():
-            samples = next(self.sound_generator.result(1024)).copy()
-            with self.lock:
-                if self.recording:
-                    self.post_event_audio.append(samples)
-                else:
-                    self.pre_event_audio.append(samples)
-            time.sleep(0.02)
-      
-    def prune_old_entries(self, now):
-        cutoff = now - self.buffer_seconds
-        while self.pre_event_frames and self.pre_event_frames[0][0] < cutoff:
-            self.pre_event_frames.popleft()
-                
+            self.post_event_frames.append(now, frame)
+            if now >= self.post_end_time:
+                self._finalize_event()
+        else:
+            self.pre_event_frames.append(now, frame)
+
     def detect_sound_event(self, bf_map, event_threshold=2.0):
         if bf_map is None:
             return False
-        if self.processing_event:
-            return False
-        return np.max(bf_map) > event_threshold and (self.last_event_time is None or time.time() - self.last_event_time > 10.0)
+        return np.max(bf_map) > event_threshold
 
-    def start_post_event_capture(self):
+    def _on_detection_event(self, event):
+        # Called on the capture dispatcher thread. The end of a sound extends the clip by post_seconds as well,
+        # but never starts one, the clip may already have ended at max_post_seconds
+        if event.kind == "start":
+            self.trigger_event(event.timestamp, self.latest_band_levels, self.latest_sources)
+        else:
+            self.trigger_event(event.timestamp, extend_only=True)
+
+    def trigger_event(self, trigger_time=None, band_levels=None, sources=None, extend_only=False):
+        trigger_time = time.monotonic() if trigger_time is None else trigger_time
         with self.lock:
+            if extend_only and not self.recording:
+                return
             if self.recording:
+                # A trigger during the post-roll extends the current clip, up to max_post_seconds
+                self.post_end_time = min(
+                    max(self.post_end_time, trigger_time + self.post_seconds),
+                    self.post_start_time + self.max_post_seconds
+                )
+                self.event_band_levels = self._merge_band_levels(self.event_band_levels, band_levels)
+                self.event_sources = self._merge_sources(self.event_sources, sources)
+                self.merged_triggers += 1
                 return
+
+            self.event_count += 1
+            self.post_start_time = trigger_time
+            self.post_end_time = trigger_time + self.post_seconds
+            self.event_band_levels = dict(band_levels) if band_levels else None
+            self.event_sources = self._merge_sources(None, sources)
+            # Set last, update() reads the recording state without the lock
             self.recording = True
-            self.post_start_time = time.time()
-            self.post_event_frames.clear()
-            self.post_event_audio.clear()
+
+    @staticmethod
+    def _merge_band_levels(levels, new_levels):
+        if not levels:
+            return dict(new_levels) if new_levels else None
+        if not new_levels:
+            return levels
+        merged = dict(levels)
+        for key, value in new_levels.items():
+            merged[key] = max(merged.get(key, value), value)
+        return merged
+
+    @staticmethod
+    def _merge_sources(sources, new_sources):
+        # Keyed by track ID, every source keeps the map where it was loudest
+        if not new_sources:
+            return sources
+        merged = dict(sources) if sources else {}
+        for source in new_sources:
+            if source["id"] not in merged or source["level"] > merged[source["id"]]["level"]:
+                merged[source["id"]] = dict(source)
+        return merged
 
     def _finalize_event(self):
+        # Buffers are handed to the encode queue, capture continues with fresh ones right away
         with self.lock:
             if not self.recording:
                 return
             self.recording = False
-            self.processing_event = True
-            self.stop_audio_event.set()
-
-            timestamp = int(time.time())
-            video_filename = f"temp_video_{timestamp}.mp4"
-            audio_filename = f"temp_audio_{timestamp}.wav"
-            final_filename = f"event_{timestamp}.mp4"
-
-            self.save_video(video_filename)
-            self.save_audio(audio_filename)
-
-            try:
-                subprocess.run([
-                    'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
-                    '-i', video_filename,
-                    '-i', audio_filename,
-                    '-c:v', 'libx264',
-                    '-preset', 'fast',
-                    '-crf', '23',
-                    '-c:a', 'aac',
-                    '-b:a', '192k',
-                    '-ac', '2', 
-                    '-movflags', 'faststart',
-                    final_filename
-                ], check=True)
-
-                print("Uploading video...")
-                self.upload_video(final_filename)
-
-            except subprocess.CalledProcessError as e:
-                print(f"FFmpeg error when combining event audio and video: {e}")
-
-            finally:
-                if os.path.exists(video_filename):
-                    os.remove(video_filename)
-                if os.path.exists(audio_filename):
-                    os.remove(audio_filename)
-                if os.path.exists(final_filename):
-                    os.remove(final_filename)
-
-                self.post_start_time = None
-                self.post_event_frames.clear()
-                self.post_event_audio.clear()
-                self.pre_event_frames.clear()
-                self.pre_event_audio.clear()
-
-                self.stop_audio_event = threading.Event()
-                self.audio_thread = threading.Thread(target=self._audio_loop, daemon=True)
-                self.audio_thread.start()
-                self.processing_event = False
-
-    def save_video(self, filename):
-        all_frames = list(self.pre_event_frames) + self.post_event_frames
-        if not all_frames:
+            frame_buffers = (self.pre_event_frames, self.post_event_frames)
+            band_levels = self.event_band_levels
+            sources = sorted(self.event_sources.values(), key=lambda source: source["level"], reverse=True) \
+                if self.event_sources else None
+            self.event_sources = None
+
+            self.post_start_time = None
+            self.post_end_time = None
+            # The end of this clip is the pre-roll of the next one, so back-to-back events keep their context
+            self.pre_event_frames = self._create_pre_roll_buffer()
+            last_timestamp = self.post_event_frames.last_timestamp()
+            if last_timestamp is not None:
+                self.pre_event_frames.extend_from(self.post_event_frames, last_timestamp - self.buffer_seconds)
+            self.post_event_frames = self._create_post_roll_buffer()
+
+        start_time = next((buffer.first_timestamp() for buffer in frame_buffers if buffer.first_timestamp() is not None), None)
+        end_time = next((buffer.last_timestamp() for buffer in reversed(frame_buffers) if buffer.last_timestamp() is not None), None)
+        if start_time is None:
             print("No frames to save.")
             return
-        avg_fps = self.calculate_average_fps(all_frames)
-
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        folder = os.path.join(script_dir, f"temp_frames_{uuid.uuid4().hex}")
-        os.makedirs(folder, exist_ok=True)
-
-        input_txt_path = os.path.join(folder, "frames.txt")
-        with open(input_txt_path, 'w') as f:
-            for i, (timestamp, frame) in enumerate(all_frames):
-                frame_path = os.path.join(folder, f"frame_{i:04d}.png")
-                bgr_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                success = cv2.imwrite(frame_path, bgr_frame)
-                if not success:
-                    print(f"Failed to write frame to {frame_path}")
-                    continue
-                f.write(f"file '{frame_path}'\n")
-                if i > 0:
-                    prev_timestamp = all_frames[i - 1][0]
-                    duration = timestamp - prev_timestamp
-                    f.write(f"duration {duration:.6f}\n")
-
-            if len(all_frames) > 1:
-                duration = all_frames[-1][0] - all_frames[-2][0]
-                f.write(f"duration {duration:.6f}\n")
+        # Pending clips are bounded, a burst beyond that is dropped instead of blocking capture
+        if not self.clip_slots.acquire(blocking=False):
+            self.dropped_clips += 1
+            print("[VideoEventRecorder] Encode queue full, dropping event clip")
+            return
+
+        # Copied here, before the capture buffer wraps around, the encode queue may be behind
+        audio = self._read_audio(start_time, end_time)
+        future = self.encode_executor.submit(self._encode_and_queue, frame_buffers, audio, band_levels, sources)
+        future.add_done_callback(lambda _: self.clip_slots.release())
 
+    def _read_audio(self, start_time, end_time):
+        # Exact sample range covering the clip, starting at the first frame's capture time
+        generator = self.sound_generator
+        start = generator.sample_index_at(start_time)
+        stop = generator.sample_index_at(end_time)
+        if start is None or stop is None:
+            return np.zeros((0, generator.num_channels), dtype=np.int16)
+
+        stop = max(start, min(stop, generator.sample_index))
+        audio = np.zeros((stop - start, generator.num_channels), dtype=np.int16)
+        # Samples that are no longer (or were never) in the buffer stay silent, the rest keeps its alignment
+        available_start = min(max(start, generator.oldest_index), stop)
         try:
-            subprocess.run([
-                'ffmpeg', '-hide_banner', '-loglevel', 'warning', '-y',
-                '-r', str(round(avg_fps, 3)),
-                '-f', 'concat', '-safe', '0',
-                '-i', input_txt_path,
-                '-fps_mode', 'vfr',
-                '-pix_fmt', 'yuv420p',
-                filename
-            ], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"FFmpeg error while creating video: {e}")
-        finally:
-            import shutil
-            shutil.rmtree(folder)
-
-    def save_audio(self, filename):
-        combined_audio = np.concatenate(list(self.pre_event_audio) + self.post_event_audio, axis=0)
-        combined_audio = combined_audio.astype(np.int16)
-
-        with wave.open(filename, 'wb') as wav_file:
-            wav_file.setnchannels(self.sound_generator.num_channels)
-            wav_file.setsampwidth(2)
-            wav_file.setframerate(self.audio_frequency)
-            wav_file.writeframes(combined_audio.tobytes())
-
-    def upload_video(self, filepath):
+            audio[available_start - start:] = generator.read(available_start, stop)
+        except ValueError as e:
+            print(f"[VideoEventRecorder] Could not read clip audio: {e}")
+        return audio
+
+    def _encode_and_queue(self, frame_buffers, audio, band_levels, sources=None):
+        final_filename = self.upload_queue.create_spool_path()
+        part_filename = f"{final_filename}.part"
         try:
-            with open(filepath, 'rb') as f:
-                files = {'video': f}
-                headers = {'X-API-KEY': self.api_key}
-                response = requests.post(f"{self.backend_url}/api/sound-events/upload", files=files, headers=headers)
-
-            if response.status_code == 200:
-                print("✅ Video uploaded successfully.")
-            else:
-                print(f"❌ Upload failed: {response.status_code} - {response.text}")
+            with metrics.timer("clip_encode"):
+                self.encode_clip(part_filename, frame_buffers, audio)
+            os.replace(part_filename, final_filename)
+            metadata = {}
+            if band_levels:
+                metadata["bandLevels"] = band_levels
+            if sources:
+                metadata["sources"] = sources
+            self.upload_queue.enqueue(final_filename, metadata or None)
         except Exception as e:
-            print(f"Exception during upload: {e}")
+            print(f"Error when encoding event clip: {e}")
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+
+    def encode_clip(self, filename, frame_buffers, audio):
+        # Frames and audio go straight into a single H.264/AAC encoder, only the final MP4 touches the disk.
+        # audio[0] was captured at the first frame's timestamp
+        timestamps = [buffer.first_timestamp() for buffer in frame_buffers if buffer.first_timestamp() is not None]
+        if not timestamps:
+            raise ValueError("No frames to save.")
+        start_time = timestamps[0]
+
+        audio_offset = 0
+        with ClipEncoder(filename, self.frame_width, self.frame_height, int(self.audio_frequency)) as encoder:
+            for timestamp, frame in itertools.chain(*(buffer.frames() for buffer in frame_buffers)):
+                # Audio is written up to each frame's time so the muxer can interleave both tracks
+                audio_end = min(len(audio), int((timestamp - start_time) * self.audio_frequency))
+                if audio_end > audio_offset:
+                    encoder.write_audio(audio[audio_offset:audio_end])
+                    audio_offset = audio_end
+                encoder.write_video(frame, timestamp)
+            encoder.write_audio(audio[audio_offset:])
 
-    def calculate_average_fps(self, frames):
-        timestamps = [ts for ts, _ in frames]
-        if len(timestamps) < 2:
-            return 5.0
+    def get_stats(self):
+        stats = self.upload_queue.get_stats()
+        stats["event_count"] = self.event_count
+        stats["merged_triggers"] = self.merged_triggers
+        stats["dropped_clips"] = self.dropped_clips
+        stats["pre_roll_bytes"] = self.pre_event_frames.total_bytes
+        stats["post_roll_bytes"] = self.post_event_frames.total_bytes
+        return stats
 
-        durations = [t2 - t1 for t1, t2 in zip(timestamps[:-1], timestamps[1:])]
-        avg_duration = sum(durations) / len(durations)
-        return 1.0 / avg_duration if avg_duration > 0 else 5.0
-    
     def stop(self):
-        self.stop_audio_event.set()
+        if self.event_detector is not None:
+            self.event_detector.remove_listener(self._on_detection_event)
+        self.encode_executor.shutdown(wait=True)
+        self.upload_queue.stop()
@@ -0,0 +1,122 @@
+import struct
+import threading
+import numpy as np
+
+# Binary map message, little endian:
+#   magic "SSMP", version (uint8), source count (uint8, version 2), reserved (2 bytes), sequence (uint32),
+#   generation (uint32), width (uint16), height (uint16), offset (float32, dB), scale (float32, dB per step),
+#   timestamp (float64, time.monotonic() when the map was published)
+# followed by width * height uint8 values, row-major, top row first, in display orientation.
+# A value v stands for offset + v * scale dB. Cells more than the encoder's dynamic range below the maximum
+# (among them cells zeroed by the sound threshold) are sent as 0.
+# Version 2 appends one record per tracked source, strongest first: id (uint32), u and v (float32, position as a
+# fraction of the map's width and height, same orientation), level (float32, dB). Version 1 has no sources.
+MAP_MESSAGE_HEADER = struct.Struct("<4sBB2xIIHHffd")
+MAP_SOURCE_RECORD = struct.Struct("<Ifff")
+MAP_MESSAGE_MAGIC = b"SSMP"
+MAP_MESSAGE_VERSION = 2
+MAX_MESSAGE_SOURCES = 255
+DYNAMIC_RANGE_DB = 40.0
+
+def encode_map_message(db_values, sequence, generation=0, timestamp=0.0, sources=(), dynamic_range_db=DYNAMIC_RANGE_DB):
+    # Same orientation as the overlay drawn on the display
+    display_map = np.flipud(np.rot90(db_values, k=-1))
+    # Thresholded cells are around -350 dB, a range down to them would leave a few codes for the visible part
+    max_value = float(display_map.max())
+    offset = max(float(display_map.min()), max_value - dynamic_range_db)
+    scale = (max_value - offset) / 255.0
+    if scale > 0:
+        quantized = np.rint((np.maximum(display_map, offset) - offset) / scale).astype(np.uint8)
+    else:
+        quantized = np.zeros(display_map.shape, dtype=np.uint8)
+
+    height, width = quantized.shape
+    sources = sources[:MAX_MESSAGE_SOURCES]
+    header = MAP_MESSAGE_HEADER.pack(
+        MAP_MESSAGE_MAGIC, MAP_MESSAGE_VERSION, len(sources), sequence & 0xFFFFFFFF, generation & 0xFFFFFFFF,
+        width, height, offset, scale, timestamp
+    )
+    records = b"".join(
+        MAP_SOURCE_RECORD.pack(source["id"] & 0xFFFFFFFF, source["u"], source["v"], source["level"])
+        for source in sources
+    )
+    return header + np.ascontiguousarray(quantized).tobytes() + records
+
+def decode_map_message(message):
+    magic, version, source_count, sequence, generation, width, height, offset, scale, timestamp = \
+        MAP_MESSAGE_HEADER.unpack_from(message)
+    if magic != MAP_MESSAGE_MAGIC or version not in (1, MAP_MESSAGE_VERSION):
+        raise ValueError("Not a map message")
+    values = np.frombuffer(message, dtype=np.uint8, offset=MAP_MESSAGE_HEADER.size, count=width * height)
+    sources = []
+    if version >= 2:
+        sources_offset = MAP_MESSAGE_HEADER.size + width * height
+        for source_id, u, v, level in MAP_SOURCE_RECORD.iter_unpack(
+            message[sources_offset:sources_offset + source_count * MAP_SOURCE_RECORD.size]
+        ):
+            sources.append({"id": source_id, "u": u, "v": v, "level": level})
+    return {
+        "sequence": sequence,
+        "generation": generation,
+        "timestamp": timestamp,
+        "db_values": offset + values.reshape(height, width).astype(np.float32) * scale,
+        "sources": sources,
+    }
+
+class MapChannelBroadcaster:
+    def __init__(self, max_buffered_bytes=64 * 1024):
+        # Sends every new map to the "map" data channel of each viewer. Channels are unordered without
+        # retransmits, a late map is useless once the next one exists
+        self.max_buffered_bytes = max_buffered_bytes
+        self.channels = {}
+        self.sequence = 0
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.bytes_sent = 0
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def create_channel(self, session_id, pc):
+        channel = pc.createDataChannel("map", ordered=False, maxRetransmits=0)
+        with self._lock:
+            self.channels[session_id] = channel
+        return channel
+
+    def remove_channel(self, session_id):
+        with self._lock:
+            self.channels.pop(session_id, None)
+
+    def attach_loop(self, loop):
+        self._loop = loop
+
+    def publish(self, snapshot):
+        # Called from the GUI thread, the message is built here and sent on the WebRTC event loop
+        if self._loop is None or not self.channels:
+            return
+        self.sequence += 1
+        message = encode_map_message(
+            snapshot.db_values, self.sequence, snapshot.generation, snapshot.timestamp, snapshot.sources
+        )
+        self._loop.call_soon_threadsafe(self._send, message)
+
+    def _send(self, message):
+        with self._lock:
+            channels = list(self.channels.values())
+        for channel in channels:
+            if channel.readyState != "open":
+                continue
+            if channel.bufferedAmount > self.max_buffered_bytes:
+                self.messages_dropped += 1
+                continue
+            channel.send(message)
+            self.messages_sent += 1
+            self.bytes_sent += len(message)
+
+    def get_stats(self):
+        return {
+            "sequence": self.sequence,
+            "channels": len(self.channels),
+            "messages_sent": self.messages_sent,
+            "messages_dropped": self.messages_dropped,
+            "bytes_sent": self.bytes_sent,
+        }
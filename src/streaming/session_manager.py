@@ -0,0 +1,168 @@
+import asyncio
+import re
+import time
+from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer, RTCIceCandidate
+from aiortc.rtcrtpsender import RTCRtpSender
+
+DEFAULT_ICE_SERVERS = (
+    "stun:stun.l.google.com:19302",
+    "stun:stun1.l.google.com:19302",
+    "stun:stun2.l.google.com:19302",
+    "stun:stun3.l.google.com:19302",
+    "stun:stun4.l.google.com:19302",
+)
+
+class PeerSession:
+    def __init__(self, session_id, pc, track, sender):
+        self.session_id = session_id
+        self.pc = pc
+        self.track = track
+        self.sender = sender
+        self.created = time.monotonic()
+
+class WebRTCSessionManager:
+    def __init__(self, encoder, source_track=None, max_sessions=4, ice_servers=DEFAULT_ICE_SERVERS, map_broadcaster=None,
+                 stats_interval=5.0):
+        # One RTCPeerConnection per signaling session, all of them fed from the same encoder. With a
+        # map_broadcaster every session also gets a "map" data channel carrying the raw beamforming map
+        self.encoder = encoder
+        self.source_track = source_track
+        self.map_broadcaster = map_broadcaster
+        self.max_sessions = max_sessions
+        self.ice_servers = ice_servers
+        self.sessions = {}
+        self.rejected_sessions = 0
+        # Per-peer stats need the event loop, they are refreshed every stats_interval and get_stats() returns the copy
+        self.stats_interval = stats_interval
+        self.peer_stats = {}
+        self._stats_task = None
+
+    def create_peer_connection(self):
+        config = RTCConfiguration([RTCIceServer(urls=[url]) for url in self.ice_servers])
+        return RTCPeerConnection(configuration=config)
+
+    async def create_offer(self, session_id):
+        # A new offer for an existing session replaces its connection, other viewers are not affected
+        await self.close_session(session_id)
+        if len(self.sessions) >= self.max_sessions:
+            self.rejected_sessions += 1
+            print(f"[WebRTC] Rejecting session {session_id}, {self.max_sessions} viewers already connected")
+            return None
+
+        pc = self.create_peer_connection()
+        track = self.encoder.subscribe()
+        sender = pc.addTrack(track)
+        # Packets are pre-encoded H.264, the connection must not negotiate another codec
+        transceiver = next(t for t in pc.getTransceivers() if t.sender == sender)
+        h264_codecs = [codec for codec in RTCRtpSender.getCapabilities("video").codecs
+                       if codec.mimeType in ("video/H264", "video/rtx")]
+        transceiver.setCodecPreferences(h264_codecs)
+
+        session = PeerSession(session_id, pc, track, sender)
+        self.sessions[session_id] = session
+        if self.source_track is not None:
+            self.source_track.attach_sender(sender)
+        if self.map_broadcaster is not None:
+            self.map_broadcaster.create_channel(session_id, pc)
+        if self._stats_task is None or self._stats_task.done():
+            self._stats_task = asyncio.ensure_future(self._monitor_stats())
+
+        @pc.on("connectionstatechange")
+        async def on_connection_state_change():
+            print(f"[WebRTC] Session {session_id}: {pc.connectionState}")
+            if pc.connectionState in ("failed", "closed") and self.sessions.get(session_id) is session:
+                await self.close_session(session_id)
+
+        offer = await pc.createOffer()
+        await pc.setLocalDescription(offer)
+        return pc.localDescription
+
+    async def handle_answer(self, session_id, sdp, sdp_type="answer"):
+        session = self.sessions.get(session_id)
+        if session is None:
+            print(f"[WebRTC] Answer for unknown session {session_id}")
+            return
+        await session.pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type=sdp_type))
+
+    async def add_candidate(self, session_id, candidate_dict):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        candidate = self.dict_to_candidate(candidate_dict)
+        if candidate.ip:
+            await session.pc.addIceCandidate(candidate)
+
+    async def close_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        if self.source_track is not None:
+            self.source_track.detach_sender(session.sender)
+        if self.map_broadcaster is not None:
+            self.map_broadcaster.remove_channel(session_id)
+        session.track.stop()
+        await session.pc.close()
+
+    async def close_all(self):
+        for session_id in list(self.sessions):
+            await self.close_session(session_id)
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            self._stats_task = None
+
+    async def _monitor_stats(self):
+        try:
+            while self.sessions:
+                await asyncio.sleep(self.stats_interval)
+                self.peer_stats = await self.collect_peer_stats()
+            self.peer_stats = {}
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[WebRTC] Stats monitor stopped: {e}")
+
+    def get_stats(self):
+        stats = {"sessions": len(self.sessions), "rejected_sessions": self.rejected_sessions}
+        for session_id, peer_stats in list(self.peer_stats.items()):
+            prefix = re.sub(r"\W", "_", str(session_id))
+            stats.update({f"{prefix}_{key}": value for key, value in peer_stats.items()})
+        return stats
+
+    async def collect_peer_stats(self):
+        stats = {}
+        for session_id, session in list(self.sessions.items()):
+            peer_stats = {
+                "connected": session.pc.connectionState == "connected",
+                "connected_seconds": time.monotonic() - session.created,
+                "packets_sent": session.track.packets_sent,
+                "packets_dropped": session.track.packets_dropped,
+                "bytes_sent": session.track.bytes_sent,
+            }
+            report = await session.sender.getStats()
+            for entry in report.values():
+                if getattr(entry, "type", None) == "outbound-rtp":
+                    peer_stats["rtp_packets_sent"] = entry.packetsSent
+                    peer_stats["rtp_bytes_sent"] = entry.bytesSent
+                elif getattr(entry, "type", None) == "remote-inbound-rtp":
+                    peer_stats["packets_lost"] = entry.packetsLost
+                    peer_stats["round_trip_time"] = entry.roundTripTime
+                    peer_stats["jitter"] = entry.jitter
+            stats[session_id] = peer_stats
+        return stats
+
+    @staticmethod
+    def dict_to_candidate(data):
+        return RTCIceCandidate(
+            component=data["component"],
+            foundation=data["foundation"],
+            ip=data["ip"],
+            port=data["port"],
+            priority=data["priority"],
+            protocol=data["protocol"],
+            type=data["type"],
+            relatedAddress=data.get("relatedAddress"),
+            relatedPort=data.get("relatedPort"),
+            sdpMid=data["sdpMid"],
+            sdpMLineIndex=data["sdpMLineIndex"],
+            tcpType=data.get("tcpType"),
+        )
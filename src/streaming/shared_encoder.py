@@ -0,0 +1,148 @@
+import asyncio
+import fractions
+import av
+from aiortc.contrib.media import MediaStreamTrack
+from utils.metrics import metrics
+
+class EncodedVideoTrack(MediaStreamTrack):
+    kind = "video"
+
+    def __init__(self, encoder, queue_size=8):
+        # Hands already encoded av.Packets to the RTCRtpSender, which only packetizes them
+        super().__init__()
+        self.encoder = encoder
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self.waiting_for_keyframe = True
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self.bytes_sent = 0
+
+    def deliver(self, packet):
+        # A peer only starts (or restarts after falling behind) on a keyframe, anything else could not be decoded
+        if self.waiting_for_keyframe:
+            if not packet.is_keyframe:
+                self.packets_dropped += 1
+                return
+            self.waiting_for_keyframe = False
+
+        if self._queue.full():
+            self.packets_dropped += self._queue.qsize() + 1
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self.waiting_for_keyframe = True
+            self.encoder.request_keyframe()
+            return
+        self._queue.put_nowait(packet)
+
+    async def recv(self):
+        packet = await self._queue.get()
+        self.packets_sent += 1
+        self.bytes_sent += packet.size
+        return packet
+
+    def stop(self):
+        self.encoder.unsubscribe(self)
+        super().stop()
+
+class SharedVideoEncoder:
+    def __init__(self, source, bitrate=1500000, reference_size=(960, 540), gop_seconds=2.0, framerate=15):
+        # One H.264 encoder for all viewers. Frames come from source (paced and adapted already), the
+        # packets are fanned out to one EncodedVideoTrack per peer
+        self.source = source
+        self.bitrate = bitrate
+        self.reference_pixels = reference_size[0] * reference_size[1]
+        self.gop_size = max(1, int(gop_seconds * framerate))
+        self.framerate = framerate
+
+        self.codec = None
+        self.subscribers = []
+        self.frames_encoded = 0
+        self.bytes_encoded = 0
+        self.encode_time = 0.0
+        self._force_keyframe = False
+        self._task = None
+
+    def subscribe(self, queue_size=8):
+        track = EncodedVideoTrack(self, queue_size)
+        self.subscribers.append(track)
+        self.request_keyframe()
+        self.start()
+        return track
+
+    def unsubscribe(self, track):
+        if track in self.subscribers:
+            self.subscribers.remove(track)
+
+    def request_keyframe(self):
+        self._force_keyframe = True
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for track in list(self.subscribers):
+            track.stop()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                frame = await self.source.recv()
+                if not self.subscribers:
+                    continue
+                start_time = loop.time()
+                packets = await loop.run_in_executor(None, self._encode, frame)
+                elapsed = loop.time() - start_time
+                self.encode_time += elapsed
+                metrics.observe("webrtc_encode", elapsed)
+                for packet in packets:
+                    self.bytes_encoded += packet.size
+                    for track in list(self.subscribers):
+                        track.deliver(packet)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[SharedVideoEncoder] Encoder stopped: {e}")
+
+    def _open_codec(self, width, height):
+        # Same settings aiortc uses for its own H.264 encoder, so browsers accept the stream
+        codec = av.CodecContext.create("libx264", "w")
+        codec.width = width
+        codec.height = height
+        codec.pix_fmt = "yuv420p"
+        codec.bit_rate = int(self.bitrate * width * height / self.reference_pixels)
+        codec.framerate = fractions.Fraction(self.framerate, 1)
+        codec.time_base = fractions.Fraction(1, 90000)
+        codec.gop_size = self.gop_size
+        codec.options = {"level": "31", "tune": "zerolatency", "preset": "veryfast"}
+        codec.profile = "Baseline"
+        return codec
+
+    def _encode(self, frame):
+        # A resolution change from the adaptive source restarts the encoder, the first frame is a keyframe
+        if self.codec is None or (frame.width, frame.height) != (self.codec.width, self.codec.height):
+            self.codec = self._open_codec(frame.width, frame.height)
+
+        if self._force_keyframe:
+            self._force_keyframe = False
+            frame.pict_type = av.video.frame.PictureType.I
+        else:
+            frame.pict_type = av.video.frame.PictureType.NONE
+
+        packets = self.codec.encode(frame)
+        for packet in packets:
+            packet.time_base = self.codec.time_base
+        self.frames_encoded += 1
+        return packets
+
+    def get_stats(self):
+        return {
+            "frames_encoded": self.frames_encoded,
+            "bytes_encoded": self.bytes_encoded,
+            "average_encode_time": self.encode_time / self.frames_encoded if self.frames_encoded else None,
+            "subscribers": len(self.subscribers),
+        }
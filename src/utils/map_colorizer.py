@@ -0,0 +1,48 @@
+import numpy as np
+import cv2
+from matplotlib import cm
+
+class MapColorizer:
+    def __init__(self, frame_width, frame_height, gamma=20.0, threshold=0.4, colormap=cm.jet, overlay_alpha=0.3):
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.gamma = gamma
+        self.threshold = threshold
+        self.overlay_alpha = overlay_alpha
+        self.lut = (colormap(np.arange(256))[:, :3] * 255).astype(np.uint8)
+
+    def colorize(self, bf_map):
+        # Normalization, gamma and threshold run at grid resolution, only the uint8 index map is resized
+        bf_map = np.flipud(np.rot90(bf_map, k=-1))
+        bf_map = (bf_map - bf_map.min()) / (bf_map.max() - bf_map.min() + 1e-6)
+        bf_map = np.power(bf_map, self.gamma)
+        bf_map[bf_map < self.threshold] = 0
+
+        index_map = np.minimum(bf_map * 256, 255).astype(np.uint8)
+        index_map = cv2.resize(index_map, (self.frame_width, self.frame_height), interpolation=cv2.INTER_LINEAR)
+
+        bf_color = np.zeros((self.frame_height, self.frame_width, 3), dtype=np.uint8)
+        x, y, w, h = cv2.boundingRect(index_map)
+        if w > 0 and h > 0:
+            bf_color[y:y + h, x:x + w] = self.lut[index_map[y:y + h, x:x + w]]
+        return index_map, bf_color
+
+    def blend(self, frame, bf_color, index_map):
+        # Only the non-zero part of the map is blended, limited to its bounding box
+        x, y, w, h = cv2.boundingRect(index_map)
+        if w == 0 or h == 0:
+            return frame
+
+        frame_roi = frame[y:y + h, x:x + w]
+        blended = cv2.addWeighted(frame_roi, 1.0 - self.overlay_alpha, bf_color[y:y + h, x:x + w], self.overlay_alpha, 0)
+        np.copyto(frame_roi, blended, where=index_map[y:y + h, x:x + w, np.newaxis] > 0)
+        return frame
+
+    def draw_sources(self, frame, sources, radius=14):
+        # Tracked sources are marked with a ring and their ID, positions are fractions of the frame
+        for source in sources:
+            center = (int(round(source["u"] * (self.frame_width - 1))), int(round(source["v"] * (self.frame_height - 1))))
+            cv2.circle(frame, center, radius, (255, 255, 255), 2, cv2.LINE_AA)
+            cv2.putText(frame, str(source["id"]), (center[0] + radius, center[1] - radius),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2, cv2.LINE_AA)
+        return frame
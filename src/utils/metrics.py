@@ -0,0 +1,268 @@
+import bisect
+import collections
+import json
+import logging
+import logging.handlers
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+METRIC_PREFIX = "sonicsense"
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS, reservoir_size=1024):
+        # Cumulative buckets for Prometheus, the most recent samples for percentiles
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=reservoir_size)
+        # Set to a list by MetricsRegistry.forward_observations, new values are kept there until taken
+        self.pending = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.recent.append(value)
+            if self.pending is not None:
+                self.pending.append(value)
+
+    def take_pending(self):
+        with self._lock:
+            pending, self.pending = self.pending, []
+        return pending
+
+    def snapshot(self):
+        with self._lock:
+            recent = np.fromiter(self.recent, dtype=np.float64, count=len(self.recent))
+            snapshot = {
+                "count": self.count,
+                "sum": self.sum,
+                "bucket_counts": list(self.bucket_counts),
+            }
+        snapshot["quantiles"] = {q: float(np.quantile(recent, q)) for q in QUANTILES} if len(recent) else {}
+        return snapshot
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class MetricsRegistry:
+    def __init__(self, enabled=False):
+        # Disabled by default, timer() then hands out one shared no-op context manager and the
+        # other calls return after a single attribute check
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.collectors = []
+        self.forwarding = False
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def forward_observations(self):
+        # For registries in worker processes, take_observations() hands the new stage timings to the main process
+        with self._lock:
+            self.forwarding = True
+            for histogram in self.histograms.values():
+                histogram.pending = []
+
+    def take_observations(self):
+        with self._lock:
+            histograms = list(self.histograms.items())
+        observations = {}
+        for stage, histogram in histograms:
+            values = histogram.take_pending()
+            if values:
+                observations[stage] = values
+        return observations
+
+    def _histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = Histogram()
+                    if self.forwarding:
+                        histogram.pending = []
+                    self.histograms[stage] = histogram
+        return histogram
+
+    def timer(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self._histogram(stage))
+
+    def observe(self, stage, seconds):
+        if self.enabled:
+            self._histogram(stage).observe(seconds)
+
+    def increment(self, name, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def register_collector(self, collector):
+        # Collectors return {name: number} and only run when metrics are read, never on the hot path
+        self.collectors.append(collector)
+
+    def collect_gauges(self):
+        gauges = dict(self.gauges)
+        for collector in list(self.collectors):
+            try:
+                values = collector()
+            except Exception as e:
+                print(f"[Metrics] Collector failed: {e}")
+                continue
+            for name, value in values.items():
+                if isinstance(value, (bool, int, float, np.integer, np.floating)) and value == value:
+                    gauges[name] = float(value)
+        return gauges
+
+    def to_dict(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        return {
+            "timestamp": time.time(),
+            "stages": {
+                stage: {
+                    "count": snapshot["count"],
+                    "mean": snapshot["sum"] / snapshot["count"] if snapshot["count"] else None,
+                    **{f"p{int(q * 100)}": value for q, value in snapshot["quantiles"].items()},
+                }
+                for stage, snapshot in ((stage, histogram.snapshot()) for stage, histogram in histograms.items())
+            },
+            "counters": counters,
+            "gauges": self.collect_gauges(),
+        }
+
+    def to_prometheus(self):
+        lines = []
+        name = f"{METRIC_PREFIX}_stage_duration_seconds"
+        quantile_name = f"{METRIC_PREFIX}_stage_duration_quantile_seconds"
+        snapshots = {stage: histogram.snapshot() for stage, histogram in list(self.histograms.items())}
+
+        lines.append(f"# TYPE {name} histogram")
+        for stage, snapshot in snapshots.items():
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS + (float("inf"),), snapshot["bucket_counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {snapshot["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {snapshot["count"]}')
+
+        lines.append(f"# TYPE {quantile_name} gauge")
+        for stage, snapshot in snapshots.items():
+            for q, value in snapshot["quantiles"].items():
+                lines.append(f'{quantile_name}{{stage="{stage}",quantile="{q}"}} {value}')
+
+        with self._lock:
+            counters = dict(self.counters)
+        for counter, value in sorted(counters.items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{counter}_total counter")
+            lines.append(f"{METRIC_PREFIX}_{counter}_total {value}")
+        for gauge, value in sorted(self.collect_gauges().items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{gauge} gauge")
+            lines.append(f"{METRIC_PREFIX}_{gauge} {value}")
+        return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    def __init__(self, registry, host="127.0.0.1", port=9108):
+        # Prometheus text format on GET /metrics, served from a daemon thread
+        registry_ref = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_ref.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class JsonMetricsLogger:
+    def __init__(self, registry, path, interval=10.0, max_bytes=5 * 1024 * 1024, backup_count=3):
+        # One JSON line per interval, rotated by size
+        self.registry = registry
+        self.interval = interval
+        self._logger = logging.getLogger(f"{METRIC_PREFIX}.metrics.{id(self)}")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        self._logger.addHandler(self._handler)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join(timeout=2.0)
+        self._logger.removeHandler(self._handler)
+        self._handler.close()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self._logger.info(json.dumps(self.registry.to_dict()))
+            except Exception as e:
+                print(f"[Metrics] Could not write metrics log: {e}")
+
+metrics = MetricsRegistry()
@@ -0,0 +1,267 @@
+import threading
+import time
+import numpy as np
+import cv2
+
+class FramePool:
+    def __init__(self, width, height, count=4):
+        # Preallocated RGB frames, reused round-robin. A frame handed out stays valid until count - 1
+        # newer frames have been captured, consumers that keep frames longer have to copy them
+        self.frames = [np.zeros((height, width, 3), dtype=np.uint8) for _ in range(count)]
+        self._next = 0
+
+    def acquire(self):
+        frame = self.frames[self._next]
+        self._next = (self._next + 1) % len(self.frames)
+        # Consumers mark delivered frames read-only, the pool takes them back for writing
+        frame.flags.writeable = True
+        return frame
+
+class FrameSource:
+    def __init__(self, width, height, framerate, pool_size=4):
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        self.pool = FramePool(width, height, pool_size)
+
+        self._new_frame = threading.Condition()
+        self._latest = None
+        self._sequence = 0
+        self._read_sequence = 0
+        self.frame_count = 0
+        self.failed_reads = 0
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self._open()
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2.0)
+        self._close()
+
+    @property
+    def sequence(self):
+        return self._sequence
+
+    def read(self):
+        # Latest frame that was not read yet, (None, None) otherwise. Never blocks the caller
+        with self._new_frame:
+            if self._latest is None or self._sequence == self._read_sequence:
+                return None, None
+            self._read_sequence = self._sequence
+            return self._latest
+
+    def wait_for_frame(self, after_sequence, timeout=None):
+        # Blocks until a frame newer than after_sequence exists, returns (frame, timestamp, sequence)
+        with self._new_frame:
+            if not self._new_frame.wait_for(lambda: self._sequence > after_sequence or not self.running, timeout):
+                return None, None, after_sequence
+            if self._latest is None:
+                return None, None, after_sequence
+            frame, timestamp = self._latest
+            return frame, timestamp, self._sequence
+
+    def _run(self):
+        try:
+            while self.running:
+                frame = self.pool.acquire()
+                timestamp = self._capture(frame)
+                if timestamp is None:
+                    self.failed_reads += 1
+                    time.sleep(0.01)
+                    continue
+                with self._new_frame:
+                    self._latest = (frame, timestamp)
+                    self._sequence += 1
+                    self.frame_count += 1
+                    self._new_frame.notify_all()
+        except Exception as e:
+            print(f"[FrameSource] Capture stopped: {e}")
+        finally:
+            self.running = False
+            with self._new_frame:
+                self._new_frame.notify_all()
+
+    def _open(self):
+        pass
+
+    def _close(self):
+        pass
+
+    def _capture(self, frame):
+        # Writes the next RGB frame into frame and returns its capture time (time.monotonic()),
+        # None if no frame could be read
+        raise NotImplementedError
+
+class PacedFrameSource(FrameSource):
+    def __init__(self, width, height, framerate, pool_size=4):
+        super().__init__(width, height, framerate, pool_size)
+        self._next_frame_time = None
+
+    def _wait_for_next_frame(self):
+        now = time.monotonic()
+        if self._next_frame_time is None or now - self._next_frame_time > 1.0:
+            self._next_frame_time = now
+        elif self._next_frame_time > now:
+            time.sleep(self._next_frame_time - now)
+        timestamp = self._next_frame_time
+        self._next_frame_time += 1.0 / self.framerate
+        return timestamp
+
+class Picamera2FrameSource(FrameSource):
+    def __init__(self, width, height, framerate, camera_index=0, buffer_count=4, pool_size=4):
+        # The ISP scales to the output size, frames arrive at display resolution without any software scaling
+        super().__init__(width, height, framerate, pool_size)
+        self.camera_index = camera_index
+        self.buffer_count = buffer_count
+        self.camera = None
+
+    def _open(self):
+        try:
+            from picamera2 import Picamera2
+        except ImportError as e:
+            raise RuntimeError("Picamera2FrameSource needs the picamera2 package (python3-picamera2)") from e
+
+        self.camera = Picamera2(self.camera_index)
+        frame_duration = int(1e6 / self.framerate)
+        # libcamera's BGR888 is RGB byte order in memory
+        config = self.camera.create_video_configuration(
+            main={"size": (self.width, self.height), "format": "BGR888"},
+            controls={"FrameDurationLimits": (frame_duration, frame_duration)},
+            buffer_count=self.buffer_count
+        )
+        self.camera.configure(config)
+        self.camera.start()
+
+    def _close(self):
+        if self.camera is not None:
+            self.camera.stop()
+            self.camera.close()
+            self.camera = None
+
+    def _capture(self, frame):
+        from picamera2 import MappedArray
+
+        request = self.camera.capture_request()
+        try:
+            # One copy from the camera's DMA buffer into the pool frame, rows may be padded
+            with MappedArray(request, "main") as mapped:
+                np.copyto(frame, mapped.array[:self.height, :self.width, :3])
+            sensor_timestamp = request.get_metadata().get("SensorTimestamp")
+        finally:
+            request.release()
+
+        # SensorTimestamp is CLOCK_MONOTONIC in nanoseconds, the clock behind time.monotonic()
+        now = time.monotonic()
+        if sensor_timestamp is not None and abs(now - sensor_timestamp / 1e9) < 1.0:
+            return sensor_timestamp / 1e9
+        return now
+
+class OpenCVFrameSource(FrameSource):
+    def __init__(self, device, width, height, framerate, api_preference=cv2.CAP_V4L2, pool_size=4):
+        super().__init__(width, height, framerate, pool_size)
+        self.device = device
+        self.api_preference = api_preference
+        self.capture = None
+        self._bgr = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def _open(self):
+        self.capture = cv2.VideoCapture(self.device, self.api_preference)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"Could not open video device {self.device}")
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        self.capture.set(cv2.CAP_PROP_FPS, self.framerate)
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def _close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def _capture(self, frame):
+        if not self.capture.grab():
+            return None
+        timestamp = time.monotonic()
+        ret, bgr = self.capture.retrieve(self._bgr)
+        if not ret:
+            return None
+        if bgr.shape[:2] != (self.height, self.width):
+            bgr = cv2.resize(bgr, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=frame)
+        return timestamp
+
+class FileFrameSource(PacedFrameSource):
+    def __init__(self, path, width, height, framerate=None, loop=True, pool_size=4):
+        # Replays a video file in real time, frames are timestamped as if they were captured now
+        super().__init__(width, height, framerate or 0, pool_size)
+        self.path = path
+        self.loop = loop
+        self.capture = None
+
+    def _open(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"Could not open video file {self.path}")
+        if not self.framerate:
+            self.framerate = self.capture.get(cv2.CAP_PROP_FPS) or 15
+
+    def _close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def _capture(self, frame):
+        ret, bgr = self.capture.read()
+        if not ret:
+            if not self.loop:
+                self.running = False
+                return None
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, bgr = self.capture.read()
+            if not ret:
+                return None
+
+        timestamp = self._wait_for_next_frame()
+        if bgr.shape[:2] != (self.height, self.width):
+            bgr = cv2.resize(bgr, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=frame)
+        return timestamp
+
+class SyntheticFrameSource(PacedFrameSource):
+    def __init__(self, width, height, framerate=15, pool_size=4):
+        # Gradient background with a moving bar and a frame counter, no hardware needed
+        super().__init__(width, height, framerate, pool_size)
+        self._background = np.zeros((height, width, 3), dtype=np.uint8)
+        self._background[..., 0] = np.linspace(0, 255, width, dtype=np.uint8)[np.newaxis, :]
+        self._background[..., 2] = np.linspace(0, 255, height, dtype=np.uint8)[:, np.newaxis]
+        self._index = 0
+
+    def _capture(self, frame):
+        timestamp = self._wait_for_next_frame()
+        np.copyto(frame, self._background)
+        bar_width = max(1, self.width // 20)
+        x = (self._index * bar_width // 2) % self.width
+        frame[:, x:x + bar_width] = 255
+        cv2.putText(frame, str(self._index), (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
+        self._index += 1
+        return timestamp
+
+def create_frame_source(kind, width, height, framerate, **kwargs):
+    if kind == "picamera2":
+        return Picamera2FrameSource(width, height, framerate, **kwargs)
+    if kind == "opencv":
+        return OpenCVFrameSource(kwargs.pop("device", 0), width, height, framerate, **kwargs)
+    if kind == "file":
+        return FileFrameSource(kwargs.pop("path"), width, height, framerate, **kwargs)
+    if kind == "synthetic":
+        return SyntheticFrameSource(width, height, framerate, **kwargs)
+    raise ValueError(f"Unknown frame source '{kind}'")
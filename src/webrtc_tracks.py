@@ -2,33 +2,207 @@ import numpy as np
 from aiortc.contrib.media import MediaStreamTrack
 import asyncio
 from av import VideoFrame
+import cv2
+import threading
 import time
 import fractions
+from utils.metrics import metrics
+
+# (scale, frames per second), from best to lowest quality
+QUALITY_LEVELS = ((1.0, 15), (0.75, 15), (0.75, 10), (0.5, 10), (0.5, 5))
+
+class YuvFramePool:
+    def __init__(self, count=3):
+        # VideoFrames are reused round-robin, the sender encodes one frame before it asks for the next
+        self.count = count
+        self.width = None
+        self.height = None
+        self._frames = []
+        self._i420 = None
+        self._next = 0
+
+    def _allocate(self, width, height):
+        self.width = width
+        self.height = height
+        self._frames = [VideoFrame(width, height, "yuv420p") for _ in range(self.count)]
+        self._i420 = np.empty((height * 3 // 2, width), dtype=np.uint8)
+        self._next = 0
+
+    def convert(self, rgb, width, height):
+        if (width, height) != (self.width, self.height):
+            self._allocate(width, height)
+        if rgb.shape[1] != width or rgb.shape[0] != height:
+            rgb = cv2.resize(rgb, (width, height), interpolation=cv2.INTER_AREA)
+
+        # Single RGB -> I420 conversion, the planes are copied into the frame's own buffers
+        cv2.cvtColor(rgb, cv2.COLOR_RGB2YUV_I420, dst=self._i420)
+        frame = self._frames[self._next]
+        self._next = (self._next + 1) % self.count
+
+        chroma_size = (width // 2) * (height // 2)
+        sources = (
+            self._i420[:height].reshape(height, width),
+            self._i420[height:].reshape(-1)[:chroma_size].reshape(height // 2, width // 2),
+            self._i420[height:].reshape(-1)[chroma_size:].reshape(height // 2, width // 2),
+        )
+        for plane, source in zip(frame.planes, sources):
+            rows, columns = source.shape
+            target = np.frombuffer(plane, dtype=np.uint8).reshape(-1, plane.line_size)[:rows, :columns]
+            np.copyto(target, source)
+        return frame
 
 class OpenCVVideoStreamTrack(MediaStreamTrack):
     kind = "video"
 
-    def __init__(self, app):
+    def __init__(self, framerate=15, quality_levels=QUALITY_LEVELS, stats_interval=2.0):
         super().__init__()
-        self.app = app
-        self.frame = None
-        self.start = time.time()
-        self.timestamp = 0
         self.time_base = fractions.Fraction(1, 90000)  # 90kHz clock rate
-        self.frame_interval = 1 / 30  # target ~30 fps
+        self.framerate = framerate
+        self.quality_levels = [(scale, min(fps, framerate)) for scale, fps in quality_levels]
+        self.quality_index = 0
+        self.stats_interval = stats_interval
+
+        self._lock = threading.Lock()
+        self._latest = None
+        self._sequence = 0
+        self._sent_sequence = 0
+        self._loop = None
+        self._frame_event = None
+
+        self._pool = YuvFramePool()
+        self._first_timestamp = None
+        self._last_pts = -1
+        self._last_sent_time = None
+        self._monitor_task = None
+        self._senders = []
+        self._good_intervals = 0
+
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.fraction_lost = None
+        self.round_trip_time = None
+
+    def push_frame(self, frame, timestamp):
+        # Called from the GUI thread for every new frame, wakes up a waiting recv()
+        with self._lock:
+            self._latest = (frame, timestamp)
+            self._sequence += 1
+            loop, event = self._loop, self._frame_event
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(event.set)
+
+    async def _next_frame(self):
+        if self._frame_event is None:
+            with self._lock:
+                self._frame_event = asyncio.Event()
+                self._loop = asyncio.get_running_loop()
+
+        while True:
+            with self._lock:
+                if self._sequence != self._sent_sequence and self._latest is not None:
+                    self._sent_sequence = self._sequence
+                    self._frame_event.clear()
+                    return self._latest
+                self._frame_event.clear()
+            await self._frame_event.wait()
 
     async def recv(self):
-        await asyncio.sleep(self.frame_interval)
-        if self.frame is None:
-            return
+        while True:
+            frame, timestamp = await self._next_frame()
+            scale, fps = self.quality_levels[self.quality_index]
+            # Frames arriving faster than the current rate are dropped before any conversion
+            if self._last_sent_time is not None and timestamp - self._last_sent_time < 0.9 / fps:
+                self.frames_skipped += 1
+                continue
+            break
+        self._last_sent_time = timestamp
 
-        frame = VideoFrame.from_ndarray(self.frame, format="rgb24")
+        height, width = frame.shape[:2]
+        width = max(2, int(width * scale) // 2 * 2)
+        height = max(2, int(height * scale) // 2 * 2)
+        with metrics.timer("webrtc_convert"):
+            video_frame = self._pool.convert(frame, width, height)
 
-        self.timestamp += int(self.frame_interval * 90000)
-        frame.pts = self.timestamp
-        frame.time_base = self.time_base
+        # PTS follow the capture timestamps, not the rate frames are asked for
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+        pts = max(int((timestamp - self._first_timestamp) * 90000), self._last_pts + 1)
+        self._last_pts = pts
+        video_frame.pts = pts
+        video_frame.time_base = self.time_base
+        self.frames_sent += 1
+        return video_frame
 
-        return frame
+    def attach_sender(self, sender):
+        # Receiver reports of every attached sender drive the quality level, the worst viewer decides
+        self._senders.append(sender)
+        if self._monitor_task is None or self._monitor_task.done():
+            self._monitor_task = asyncio.ensure_future(self._monitor_senders())
+
+    def detach_sender(self, sender):
+        if sender in self._senders:
+            self._senders.remove(sender)
+
+    async def _monitor_senders(self):
+        try:
+            while self.readyState == "live":
+                await asyncio.sleep(self.stats_interval)
+                losses, round_trip_times = [], []
+                for sender in list(self._senders):
+                    report = await sender.getStats()
+                    for stats in report.values():
+                        if getattr(stats, "type", None) == "remote-inbound-rtp":
+                            losses.append(self._loss(stats))
+                            if stats.roundTripTime is not None:
+                                round_trip_times.append(stats.roundTripTime)
+                if losses:
+                    self._adapt(max(losses), max(round_trip_times, default=None))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[VideoTrack] Stats monitor stopped: {e}")
+
+    @staticmethod
+    def _loss(stats):
+        fraction_lost = getattr(stats, "fractionLost", None) or 0
+        # aiortc reports RTCP's raw 8 bit fixed point value, 1 is about 0.4 % loss
+        return fraction_lost / 256
+
+    def _adapt(self, fraction_lost, round_trip_time=None):
+        self.fraction_lost = fraction_lost
+        self.round_trip_time = round_trip_time
+
+        congested = fraction_lost > 0.1 or (self.round_trip_time is not None and self.round_trip_time > 0.5)
+        if congested:
+            self._good_intervals = 0
+            if self.quality_index < len(self.quality_levels) - 1:
+                self.quality_index += 1
+                print(f"[VideoTrack] Lowering quality to {self.quality_levels[self.quality_index]} "
+                      f"(loss {fraction_lost:.2f}, rtt {self.round_trip_time})")
+        elif fraction_lost < 0.02:
+            # Step back up only after a few clean reports in a row
+            self._good_intervals += 1
+            if self._good_intervals >= 3 and self.quality_index > 0:
+                self._good_intervals = 0
+                self.quality_index -= 1
+                print(f"[VideoTrack] Raising quality to {self.quality_levels[self.quality_index]}")
+
+    def get_stats(self):
+        scale, fps = self.quality_levels[self.quality_index]
+        return {
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped,
+            "scale": scale,
+            "fps": fps,
+            "fraction_lost": self.fraction_lost,
+            "round_trip_time": self.round_trip_time,
+        }
+
+    def stop(self):
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            self._monitor_task = None
+        super().stop()
 
 
 class DummyVideoStreamTrack(MediaStreamTrack):
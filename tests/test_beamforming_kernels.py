@@ -0,0 +1,53 @@
+import numpy as np
+import acoular as ac
+from conftest import MIC_FILE
+from beamforming.beamforming_kernels import beamform_band, get_band_indices
+from beamforming.csm_accumulator import CsmAccumulator
+
+BLOCK_SIZE = 1024
+NUM_BLOCKS = 8
+SAMPLE_FREQ = 48000.0
+
+def create_samples(mics):
+    # One correlated source on top of uncorrelated noise, delayed per mic by whole samples
+    rng = np.random.default_rng(0)
+    num_samples = BLOCK_SIZE * NUM_BLOCKS
+    samples = rng.normal(0, 1, (num_samples, mics.num_mics))
+    source = rng.normal(0, 3, num_samples + 64)
+    distances = np.linalg.norm(np.array([[0.1], [-0.05], [0.5]]) - mics.pos, axis=0)
+    delays = np.round((distances - distances.min()) / 343.0 * SAMPLE_FREQ).astype(int)
+    for mic, delay in enumerate(delays):
+        samples[:, mic] += source[64 - delay:64 - delay + num_samples]
+    return samples
+
+def check_parity(r_diag):
+    ac.config.global_caching = "none"
+    mics = ac.MicGeom(file=MIC_FILE)
+    samples = create_samples(mics)
+    grid = ac.RectGrid(x_min=-0.3, x_max=0.3, y_min=-0.2, y_max=0.2, z=0.5, increment=0.05)
+    steering_vector = ac.SteeringVector(grid=grid, mics=mics)
+
+    spectra = ac.PowerSpectra(source=ac.TimeSamples(data=samples, sample_freq=SAMPLE_FREQ),
+                              block_size=BLOCK_SIZE, window="Hanning", overlap="None", precision="complex128")
+    beamformer = ac.BeamformerBase(freq_data=spectra, steer=steering_vector, r_diag=r_diag)
+
+    # Plain mean over all blocks, like acoular
+    accumulator = CsmAccumulator(mics.num_mics, SAMPLE_FREQ, BLOCK_SIZE, averaging_blocks=NUM_BLOCKS)
+    for block in samples.reshape(NUM_BLOCKS, BLOCK_SIZE, mics.num_mics):
+        accumulator.push_block(block)
+
+    for frequency, bandwidth in ((1000, 1), (2000, 3), (4000, 0)):
+        expected = beamformer.synthetic(frequency, bandwidth)
+
+        indices = get_band_indices(accumulator.freqs, frequency, bandwidth)
+        csm, _ = accumulator.get_csm(indices)
+        steering = np.array([steering_vector.steer_vector(freq) for freq in accumulator.freqs[indices]])
+        result = beamform_band(csm, steering, r_diag=r_diag).reshape(grid.shape)
+
+        assert np.allclose(result, expected, rtol=1e-6, atol=1e-6 * expected.max())
+
+def test_band_maps_match_acoular_with_diagonal_removal():
+    check_parity(r_diag=True)
+
+def test_band_maps_match_acoular_without_diagonal_removal():
+    check_parity(r_diag=False)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from conftest import MIC_FILE
+
+pytest.importorskip("numba")
+from beamforming.time_domain_beamformer import TimeDomainBeamformer
+from background_map_calculator import BackgroundMapCalculator
+
+class FixedSettings:
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+class FillingSource:
+    # Capture buffer that has not yet received enough samples for a window
+    sample_freq = 48000.0
+
+    def __init__(self, num_samples):
+        self.sample_index = num_samples
+
+    def latest(self, num, copy=True):
+        raise AssertionError("latest() must not be called before the window is full")
+
+def test_compute_map_before_window_is_full():
+    beamformer = TimeDomainBeamformer(66, 41, 0.5, mic_file=MIC_FILE, increment=0.05, samples_generator=FillingSource(100))
+    calculator = BackgroundMapCalculator(
+        beamformer, FixedSettings({"sound_threshold": 0.0, "frequency": 1000, "bandwidth": 1}), 96, 54
+    )
+
+    index_map, bf_map, bf_color, db_values, band_levels, sources = calculator.compute_map()
+
+    assert bf_map.shape == beamformer.map_shape
+    assert not bf_map.any()
+    assert set(band_levels) == {str(frequency) for frequency in beamformer.band_frequencies} | {"broadband"}
+    assert all(np.isfinite(level) for level in band_levels.values())
+    assert sources == []
@@ -0,0 +1,13 @@
+import os
+from recorders.upload_queue import UploadQueue
+
+def test_spool_only_queue_is_empty_after_stop(tmp_path):
+    upload_queue = UploadQueue(None, "", spool_dir=str(tmp_path / "spool"))
+    path = upload_queue.create_spool_path()
+    with open(path, "wb") as f:
+        f.write(b"clip")
+    upload_queue.enqueue(path, {"level": 80.0})
+    upload_queue.stop()
+
+    assert upload_queue.get_stats()["queue_depth"] == 0
+    assert os.path.exists(path) and os.path.exists(f"{path}.json")